@@ -1,18 +1,69 @@
 #!/usr/bin/env python
+from __future__ import print_function
+
 import argparse
-import codecs
+import hashlib
+import io
 import os
+import posixpath
 import shutil
+import socket
 import sys
-from tempfile import mkdtemp
+import tarfile
+import threading
+import time
 
 from docker import Client
+from docker import errors as docker_errors
 
 from jinja2 import Environment, FileSystemLoader
 
 import six
+from six.moves import shlex_quote
 
+from dbuild import batch
+from dbuild import bench
+from dbuild import cache
+from dbuild import checkpoint as checkpoints
+from dbuild import control
 from dbuild import exceptions
+from dbuild import graph
+from dbuild import logs
+from dbuild import metrics
+from dbuild import proxy as proxies
+from dbuild import scheduler
+from dbuild import service
+from dbuild import transport as transports
+from dbuild import watchdog as watchdogs
+from dbuild.pool import ContainerPool  # noqa
+from dbuild.session import DbuildSession  # noqa
+
+PATH = os.path.dirname(os.path.abspath(__file__))
+
+# Labels set on every container dbuild creates: the kind of build, and the
+# host and pid of the dbuild process which created it
+CONTAINER_LABEL = 'dbuild'
+OWNER_LABEL = 'dbuild.owner'
+
+# Bumped when a change to dbuild invalidates cached build results
+RESULT_CACHE_VERSION = '1'
+
+# Exit codes of the two halves of a pipeline build
+PIPELINE_SOURCE_FAILED = 1
+PIPELINE_BINARY_FAILED = 2
+
+# Where apt keeps downloaded packages, and where an apt archive cache shared
+# by build containers is mounted next to it
+APT_DIR = '/var/cache/apt/archives'
+APT_ARCHIVE_DIR = '/var/cache/dbuild/apt-archives'
+
+# Where builds run with a scratch workspace, and the kinds of workspace
+SCRATCH_DIR = '/scratch'
+SCRATCH_KINDS = ('tmpfs', 'disk')
+
+# How the build directory gets to the build containers: bind mounted, or
+# streamed in and the artifacts streamed back with the archive API
+TRANSPORTS = ('bind', 'archive')
 
 
 def docker_client(url='unix://var/run/docker.sock'):
@@ -20,10 +71,17 @@ def docker_client(url='unix://var/run/docker.sock'):
     return Client(url)
 
 
-def build_image(docker_client, path, tag, nocache=False):
-    """ Build docker image"""
-    for line in docker_client.build(path=path, rm=True, forcerm=True,
-                                    tag=tag, decode=True, nocache=nocache):
+def build_image(docker_client, path, tag, nocache=False, fileobj=None):
+    """
+    Build docker image from the directory path, or from fileobj, a tar
+    archive of the build context
+    """
+    if fileobj is not None:
+        context = dict(fileobj=fileobj, custom_context=True)
+    else:
+        context = dict(path=path)
+    for line in docker_client.build(rm=True, forcerm=True, tag=tag, decode=True,
+                                    nocache=nocache, **context):
         if 'stream' in line:
             yield line['stream']
         if 'error' in line:
@@ -31,20 +89,28 @@ def build_image(docker_client, path, tag, nocache=False):
 
 
 def create_container(docker_client, image, name=None, command=None, env=None,
-                     disable_network=False, shared_volumes=None, cwd=None):
-    """ create docker containers """
+                     disable_network=False, shared_volumes=None, cwd=None,
+                     labels=None, tmpfs=None, resources=None):
+    """
+    create docker containers, with resources as further create_host_config
+    arguments, such as cpuset_cpus and mem_limit
+    """
+    host_config_args = {}
+    volumes = None
     if shared_volumes:
         volumes = list(shared_volumes.values())
-        binds = ['{}:{}'.format(k, v) for k, v in six.iteritems(shared_volumes)]
-        host_config = docker_client.create_host_config(binds=binds)
-    else:
-        volumes = None
-        host_config = None
+        host_config_args['binds'] = ['{}:{}'.format(k, v) for k, v in six.iteritems(shared_volumes)]
+    if tmpfs:
+        host_config_args['tmpfs'] = tmpfs
+    host_config_args.update(resources or {})
+    host_config = None
+    if host_config_args:
+        host_config = docker_client.create_host_config(**host_config_args)
 
     container = docker_client.create_container(
         image=image, name=name, command=command, environment=env,
         network_disabled=disable_network, volumes=volumes,
-        working_dir=cwd, host_config=host_config)
+        working_dir=cwd, host_config=host_config, labels=labels)
     return container
 
 
@@ -72,37 +138,452 @@ def remove_container(docker_client, container, force=False):
     return docker_client.remove_container(container=container, force=force)
 
 
-def create_dockerfile(dist, release, docker_dir, proxy=""):
-    """Create docker directory and populate it"""
-    PATH = os.path.dirname(os.path.abspath(__file__))
+def container_labels(kind):
+    """ Labels for a dbuild container of the given kind """
+    return {CONTAINER_LABEL: kind,
+            OWNER_LABEL: '%s:%d' % (socket.gethostname(), os.getpid())}
+
+
+def render_template(name, ctxt):
+    """Render one of the templates shipped with dbuild"""
     TMPL_ENV = Environment(
         autoescape=False,
         loader=FileSystemLoader(os.path.join(PATH, 'templates')),
         trim_blocks=False)
+    return TMPL_ENV.get_template(name).render(ctxt)
 
-    dockerfile = os.path.join(docker_dir, 'Dockerfile')
+
+def render_dockerfile(dist, release, proxy="", ccache=False):
+    """Render the Dockerfile for the dbuild image"""
     ctxt = {'dist': dist, 'release': release, 'http_proxy': proxy, 'https_proxy': proxy,
-            'maintainer': 'dbuild, dbuild@test.com'}
+            'maintainer': 'dbuild, dbuild@test.com', 'ccache': ccache}
+    return render_template('dockerfile.jinja', ctxt)
+
+
+def create_dockerfile(dist, release, docker_dir, proxy="", ccache=False):
+    """Create docker directory and populate it"""
+    dockerfile = os.path.join(docker_dir, 'Dockerfile')
 
     # Write Dockerfile under docker_dir
     with open(dockerfile, 'w') as d:
-        dockerdata = TMPL_ENV.get_template('dockerfile.jinja').render(ctxt)
-        d.write(dockerdata)
+        d.write(render_dockerfile(dist, release, proxy, ccache))
     # Copy scripts under docker_dir
     shutil.copytree(os.path.join(PATH, 'scripts'),
                     os.path.join(docker_dir, 'scripts'))
 
 
+def tar_context(files):
+    """
+    Build context holding files, a list of (name, data, mode) tuples, as an
+    uncompressed tar archive in memory. Times and owners are fixed, so equal
+    files always give the same archive.
+    """
+    buf = io.BytesIO()
+    tar = tarfile.open(fileobj=buf, mode='w')
+    for name, data, mode in files:
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mode = mode
+        tar.addfile(info, io.BytesIO(data))
+    tar.close()
+    return buf.getvalue()
+
+
+_build_contexts = {}
+_build_contexts_lock = threading.Lock()
+
+
+def build_context(dist, release, proxy="", ccache=False):
+    """
+    Build context of the dbuild image, with the rendered Dockerfile and the
+    helper scripts, as a tar archive. Memoized, as it only depends on the
+    arguments.
+    """
+    key = (dist, release, proxy, ccache)
+    with _build_contexts_lock:
+        if key not in _build_contexts:
+            files = [('Dockerfile', render_dockerfile(dist, release, proxy, ccache).encode('utf-8'),
+                      0o644)]
+            scripts_dir = os.path.join(PATH, 'scripts')
+            for name in sorted(os.listdir(scripts_dir)):
+                path = os.path.join(scripts_dir, name)
+                with open(path, 'rb') as fp:
+                    files.append(('scripts/' + name, fp.read(), os.stat(path).st_mode & 0o777))
+            _build_contexts[key] = tar_context(files)
+        return _build_contexts[key]
+
+
+def image_hash(dist, release, proxy="", ccache=False):
+    """
+    Content hash of everything that goes into the dbuild image: the rendered
+    Dockerfile, the helper scripts and the template inputs.
+    """
+    h = hashlib.sha256()
+    for value in (dist, release, proxy, render_dockerfile(dist, release, proxy, ccache)):
+        h.update(value.encode('utf-8'))
+        h.update(b'\0')
+    scripts_dir = os.path.join(PATH, 'scripts')
+    for name in sorted(os.listdir(scripts_dir)):
+        h.update(name.encode('utf-8'))
+        h.update(b'\0')
+        with open(os.path.join(scripts_dir, name), 'rb') as fp:
+            h.update(fp.read())
+    return h.hexdigest()
+
+
+def image_tag(dist, release, proxy="", ccache=False):
+    """ Content addressed tag of the dbuild image """
+    return 'dbuild-%s/%s:%s' % (dist, release, image_hash(dist, release, proxy, ccache)[:12])
+
+
+def prepare_image(docker_client, dist, release, proxy="", build_cache=True,
+                  docker_url='unix://var/run/docker.sock', image_index=None,
+                  output=None, ccache=False, timer=None, session=None):
+    """
+    Make sure the dbuild image exists on the docker host and return its tag.
+    The docker build is skipped entirely if image_index already records the
+    image for docker_url, or if the images of session (a DbuildSession)
+    include it, unless build_cache is False. With ccache, the image has
+    ccache installed. timer is a metrics.PhaseTimer to record the time taken
+    in.
+    """
+    tag = image_tag(dist, release, proxy, ccache)
+    if build_cache and image_index is not None and (docker_url, tag) in image_index:
+        return tag
+    if build_cache and session is not None and session.image_exists(tag, docker_url):
+        if image_index is not None:
+            image_index.add(docker_url, tag)
+        return tag
+
+    with metrics.timed(timer, 'render-dockerfile'):
+        context = build_context(dist, release, proxy, ccache)
+    try:
+        with metrics.timed(timer, 'build-image'):
+            for l in build_image(docker_client, None, tag=tag, nocache=not build_cache,
+                                 fileobj=io.BytesIO(context)):
+                print(l, file=output)
+    finally:
+        if session is not None:
+            session.invalidate(docker_url)
+
+    if image_index is not None:
+        image_index.add(docker_url, tag)
+    return tag
+
+
+def _read_build_file(build_dir, name):
+    """ Contents of a file in build_dir, or None if there is no such file """
+    path = os.path.join(build_dir, name)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as fp:
+        return fp.read()
+
+
+def apt_prepare_command(build_dir, extra_repos_file='repos',
+                        extra_repo_keys_file='keys', no_default_sources=False,
+                        markers=False):
+    """
+    Shell command prefix which configures the extra repos and keys found in
+    build_dir and brings the container's apt indexes and packages up to date.
+    With markers, the update and the upgrade are marked as build phases.
+    """
+    command = ''
+
+    if no_default_sources:
+        command += '> /etc/apt/sources.list && '
+
+    if os.path.exists(os.path.join(build_dir, extra_repos_file)):
+        command += 'cp /build/%s \
+        /etc/apt/sources.list.d/dbuild-extra-repos.list && ' % extra_repos_file
+
+    if os.path.exists(os.path.join(build_dir, extra_repo_keys_file)):
+        command += 'apt-key add /build/%s && ' % extra_repo_keys_file
+
+    mark = metrics.phase_marker if markers else (lambda name: '')
+    command += 'export DEBIAN_FRONTEND=noninteractive; %sapt-get -y update \
+                   && %sapt-get -y dist-upgrade && ' % (mark('apt-update'), mark('apt-upgrade'))
+    return command
+
+
+def apt_archive_command():
+    """
+    Shell command prefix which makes apt keep downloaded packages, and
+    links those of the shared apt archive cache into apt's own archive
+    directory, so apt finds them without downloading them again. Opens the
+    lock of the shared cache as fd 9, see apt_archive_publish_command.
+    """
+    return ('rm -f /etc/apt/apt.conf.d/docker-clean && '
+            'echo \'Binary::apt::APT::Keep-Downloaded-Packages "true";\' '
+            '> /etc/apt/apt.conf.d/90dbuild-keep-debs && '
+            'exec 9>%s/%s && '
+            'find %s -maxdepth 1 -name \'*.deb\' -exec ln -sf -t %s {} + && ' % (
+                APT_ARCHIVE_DIR, cache.APT_ARCHIVE_LOCK, APT_ARCHIVE_DIR, APT_DIR))
+
+
+def apt_archive_publish_command():
+    """
+    Shell command prefix copying the packages apt downloaded into the
+    shared apt archive cache. Each container runs apt on an archive
+    directory of its own, so only this copy takes turns on the cache's
+    lock, and failing to copy doesn't fail the build.
+    """
+    return ('{ flock 9 && find %s -maxdepth 1 -type f -name \'*.deb\' -exec cp -n -t %s {} + ; '
+            'flock -u 9 ; true ; } && ' % (APT_DIR, APT_ARCHIVE_DIR))
+
+
+def sources_digest(build_dir, extra_repos_file='repos', extra_repo_keys_file='keys',
+                   no_default_sources=False):
+    """ Hash of the apt sources configuration a build_dir asks for """
+    h = hashlib.sha256()
+    h.update(('no_default_sources=%d\0' % bool(no_default_sources)).encode('utf-8'))
+    for name in (extra_repos_file, extra_repo_keys_file):
+        data = _read_build_file(build_dir, name)
+        h.update(b'-' if data is None else b'+' + hashlib.sha256(data).digest())
+    return h.hexdigest()
+
+
+def apt_layer_tag(base_image, dist, release, build_dir, extra_repos_file='repos',
+                  extra_repo_keys_file='keys', no_default_sources=False):
+    """
+    Content addressed tag of the apt layer image for a build_dir: keyed on
+    the base image and the contents of the extra repos and keys files.
+    """
+    h = hashlib.sha256()
+    h.update(base_image.encode('utf-8'))
+    h.update(b'\0')
+    h.update(sources_digest(build_dir, extra_repos_file, extra_repo_keys_file,
+                            no_default_sources).encode('utf-8'))
+    return 'dbuild-%s/%s-apt:%s' % (dist, release, h.hexdigest()[:12])
+
+
+def prepare_apt_layer(docker_client, base_image, dist, release, build_dir,
+                      extra_repos_file='repos', extra_repo_keys_file='keys',
+                      no_default_sources=False, ttl=86400,
+                      docker_url='unix://var/run/docker.sock', image_index=None,
+                      output=None):
+    """
+    Make sure an image derived from base_image with the extra repos and keys
+    installed and the apt indexes and upgrades baked in exists on the docker
+    host, and return its tag. The image is rebuilt from scratch once it is
+    older than ttl seconds.
+    """
+    tag = apt_layer_tag(base_image, dist, release, build_dir, extra_repos_file,
+                        extra_repo_keys_file, no_default_sources)
+    info = image_index.get(docker_url, tag) if image_index is not None else None
+    if info is not None and time.time() - info['built'] < ttl:
+        return tag
+
+    repos = _read_build_file(build_dir, extra_repos_file)
+    keys = _read_build_file(build_dir, extra_repo_keys_file)
+
+    # The refreshed label changes on every rebuild, so docker's layer cache
+    # can't hand back stale indexes.
+    dockerfile = render_template('apt-layer.jinja', {
+        'base_image': base_image, 'no_default_sources': no_default_sources,
+        'repos': repos is not None, 'keys': keys is not None,
+        'refreshed': int(time.time())})
+    files = [('Dockerfile', dockerfile.encode('utf-8'), 0o644)]
+    files += [(name, data, 0o644) for name, data in (('repos', repos), ('keys', keys))
+              if data is not None]
+    for l in build_image(docker_client, None, tag=tag, fileobj=io.BytesIO(tar_context(files))):
+        print(l, file=output)
+
+    if image_index is not None:
+        image_index.add(docker_url, tag)
+    return tag
+
+
+def print_container_logs(docker_client, container, include_timestamps=True, output=None,
+                         sinks=()):
+    """
+    Stream container output to output, stdout by default, and to any
+    further logs.LogSink in sinks
+    """
+    pipeline = logs.LogPipeline([logs.StreamSink(output)] + list(sinks))
+    with pipeline:
+        for chunk in docker_client.logs(container=container, stream=True,
+                                        timestamps=include_timestamps):
+            pipeline.feed(chunk)
+
+
+def builddep_tag(base_image, dist, release, builddeps, sources='', kind='deps'):
+    """
+    Content addressed tag of the build dependency image, or of another kind
+    of image keyed on the same. sources is the sources_digest of the build
+    if its apt sources are not part of base_image already.
+    """
+    h = hashlib.sha256()
+    h.update(base_image.encode('utf-8'))
+    h.update(b'\0')
+    h.update(sources.encode('utf-8'))
+    for dep in builddeps:
+        h.update(b'\0')
+        h.update(dep.encode('utf-8'))
+    return 'dbuild-%s/%s-%s:%s' % (dist, release, kind, h.hexdigest()[:12])
+
+
+def evict_builddep_images(docker_client, image_index, max_size,
+                          docker_url='unix://var/run/docker.sock', keep=()):
+    """
+    Remove the least recently used build dependency images from the docker
+    host until those recorded in image_index fit in max_size bytes.
+    """
+    images = image_index.load().get(docker_url, {})
+    max_size -= sum(images[tag].get('size', 0) for tag in keep if tag in images)
+    entries = [(tag, info.get('size', 0), info.get('used', info['built']))
+               for tag, info in six.iteritems(images) if tag not in keep]
+    for tag in cache.lru_victims(entries, max_size):
+        try:
+            docker_client.remove_image(tag)
+        except docker_errors.NotFound:
+            pass
+        except docker_errors.APIError:
+            # Still in use by a container, try again next time
+            continue
+        image_index.discard(docker_url, tag)
+
+
+def prepare_builddep_image(docker_client, base_image, dist, release, build_dir,
+                           builddeps, apt_command='', force_rm=False,
+                           include_timestamps=True, shared_volumes=None,
+                           docker_url='unix://var/run/docker.sock',
+                           image_index=None, base_built=0, max_size=None,
+                           sources='', build_files=None, timeout=None, stall_timeout=None,
+                           output=None):
+    """
+    Make sure an image derived from base_image with builddeps installed
+    exists on the docker host and return its tag. The image is built by
+    running apt_command and pbuilder-satisfydepends in a container and
+    committing it. It is rebuilt if base_image was built after it.
+    shared_volumes are mounted in addition to build_dir, and sources is
+    passed on to builddep_tag. If build_files is given, those files of
+    build_dir are copied into the container instead of mounting build_dir.
+    timeout and stall_timeout are as for docker_build.
+    """
+    tag = builddep_tag(base_image, dist, release, builddeps, sources)
+    info = image_index.get(docker_url, tag) if image_index is not None else None
+    if info is not None and info['built'] >= base_built:
+        image_index.touch(docker_url, tag)
+        return tag
+
+    control_data = 'Source: dbuild-builddeps\nBuild-Depends: %s\n' % ', '.join(builddeps)
+    volumes = {build_dir: '/build'} if build_files is None else {}
+    volumes.update(shared_volumes or {})
+    satisfy_command = '/usr/lib/pbuilder/pbuilder-satisfydepends --control /tmp/dbuild-control && '
+    if APT_ARCHIVE_DIR in volumes.values():
+        satisfy_command += apt_archive_publish_command()
+    command = (apt_command + 'export DEBIAN_FRONTEND=noninteractive; '
+               'printf %%s %s > /tmp/dbuild-control && %strue'
+               % (shlex_quote(control_data), satisfy_command))
+    container = create_container(docker_client, base_image, cwd='/build',
+                                 command=['bash', '-c', command],
+                                 shared_volumes=volumes,
+                                 labels=container_labels('builddeps'))
+    if build_files is not None:
+        transports.put_build_dir(docker_client, container, build_dir,
+                                 transports.archive_members(build_dir, 'builddeps',
+                                                            extra_files=build_files))
+    print("Installing build dependencies into %s" % tag, file=output)
+    watchdog = watchdogs.Watchdog(lambda: watchdogs.kill_container(docker_client, container),
+                                  timeout, stall_timeout)
+    start_container(docker_client, container)
+    with watchdog:
+        print_container_logs(docker_client, container, include_timestamps, output, [watchdog])
+        rv = wait_container(docker_client, container)
+
+    if rv != 0:
+        if watchdog.reason is not None:
+            print('%s, killed container %s' % (watchdog.reason, container.get('Id')), file=output)
+        if force_rm:
+            remove_container(docker_client, container, force=True)
+        if watchdog.reason is not None:
+            raise exceptions.DbuildBuildTimeoutException(watchdog.reason)
+        raise exceptions.DbuildBinaryBuildFailedException(
+            'Build dependency installation FAILED')
+
+    repository, _, image_version = tag.rpartition(':')
+    docker_client.commit(container.get('Id'), repository=repository, tag=image_version)
+    remove_container(docker_client, container, force=True)
+
+    if image_index is not None:
+        size = (docker_client.inspect_image(tag).get('Size', 0) -
+                docker_client.inspect_image(base_image).get('Size', 0))
+        image_index.add(docker_url, tag, size=max(size, 0), used=time.time())
+        if max_size is not None:
+            evict_builddep_images(docker_client, image_index, max_size,
+                                  docker_url=docker_url, keep=[tag])
+    return tag
+
+
+def owner_ids(build_owner, build_dir):
+    """
+    (uid, gid) to run builds as for build_owner, a uid or uid:gid; the gid
+    defaults to the group of build_dir. Returns None for a user name, which
+    build containers can't be expected to know.
+    """
+    uid, _, gid = str(build_owner).partition(':')
+    if not uid.isdigit() or not (gid.isdigit() or gid == ''):
+        return None
+    if not gid:
+        gid = os.stat(build_dir).st_gid
+    return int(uid), int(gid)
+
+
+def owner_setup_command(owner, ccache=False):
+    """
+    Shell command prefix giving the uid and gid of owner a user and group
+    in the container, so tools which look them up work, and handing the
+    ccache directory over to that user, along with anything in it which
+    root made there
+    """
+    uid, gid = owner
+    command = ('(getent group %d > /dev/null || groupadd -g %d dbuild) && '
+               '(getent passwd %d > /dev/null || useradd -u %d -g %d -d /tmp -M dbuild) && '
+               % (gid, gid, uid, uid, gid))
+    if ccache:
+        command += 'find /ccache ! -user %d -exec chown %d:%d {} + && ' % (uid, uid, gid)
+    return command
+
+
+def link_orig_command(from_dir, to_dir):
+    """
+    Shell command linking the upstream tarballs in from_dir, if any, into
+    to_dir, for a source build of a copy of the source tree in to_dir
+    """
+    names = ' -o '.join('-name %s' % shlex_quote(p) for p in cache.ORIG_TARBALL_PATTERNS)
+    return 'find %s -maxdepth 1 -type f \\( %s \\) -exec ln -sf -t %s {} +' % (
+        from_dir, names, to_dir)
+
+
+def copy_back_command(from_dir, to_dir):
+    """
+    Shell command copying the build artifacts in from_dir, and nothing
+    else, to to_dir
+    """
+    names = ' -o '.join('-name %s' % shlex_quote(p) for p in cache.ARTIFACT_PATTERNS)
+    return 'mkdir -p %s && find %s -maxdepth 1 -type f \\( %s \\) -exec cp -p -t %s {} +' % (
+        to_dir, from_dir, names, to_dir)
+
+
 def docker_build(build_dir, build_type, source_dir='source', force_rm=False,
                  docker_url='unix://var/run/docker.sock', dist='ubuntu',
                  release='trusty', extra_repos_file='repos',
                  extra_repo_keys_file='keys', build_cache=True, proxy="",
                  build_owner=None, parallel=1, no_default_sources=False,
-                 include_timestamps=True, **kwargs):
+                 include_timestamps=True, cache_dir=None, apt_layer_ttl=None,
+                 builddep_cache=False, builddep_cache_size=None,
+                 apt_archive_cache=None, apt_archive_cache_size=None, output=None,
+                 client=None, extra_volumes=None, ccache_dir=None, ccache_size='5G',
+                 log_archive=None, write_metrics=False, metrics_textfile=None, session=None,
+                 scratch=None, scratch_size='8g', transport='bind', pool=None, resume=False,
+                 checkpoint_keep=5, checkpoint_ttl=3 * 24 * 3600, allocator=None,
+                 memory_per_cpu=None, timeout=None, stall_timeout=None, **kwargs):
     """
     build_dir:  build directory, this directory will be mounted to /build in
                 container
-    build_type: Type of builds, - source or binary
+    build_type: Type of builds, - source or binary, or pipeline to do the
+                source build, unpack and binary build in a single container
     source_dir: a relative path to the subdirectory of build_dir in which the
                 source code is kept
     force_rm:   If True, remove the container even on build failure, if not
@@ -118,108 +599,586 @@ def docker_build(build_dir, build_type, source_dir='source', force_rm=False,
     build_cache:    Whether to use docker build cache or not
     proxy:          value of proxy to be passed when used behind proxy settings
                     otherwise it will be default empty
-    build_owner:    user id which will own all build files
-    parallel:       how many processes to run in parallel
+    build_owner:    user which will own all build files. A uid, or uid:gid
+                    with the group of build_dir as default, runs the build
+                    steps as that user; a user name chowns /build after the
+                    build instead
+    parallel:       how many processes to run in parallel, or 'auto' for
+                    the build's share of the CPUs of the docker host
     no_default_sources: only use sources from extra_repos_file
     include_timestamps: show timestamps
+    cache_dir:      directory for dbuild's local state, such as the index of
+                    images already built on each docker host
+    apt_layer_ttl:  if set, run the build in a cached image which already has
+                    the extra repos and keys installed and apt updated and
+                    upgraded, refreshing that image once it is older than
+                    this many seconds
+    builddep_cache: for binary builds, install the build dependencies from
+                    the .dsc once into an image keyed on the normalized
+                    Build-Depends and reuse it for later builds
+    builddep_cache_size: disk budget in bytes for build dependency images,
+                    least recently used ones are removed beyond it
+    apt_archive_cache: host directory shared by all build containers as
+                    their apt archive cache, so downloaded packages are kept
+                    across builds
+    apt_archive_cache_size: size limit in bytes for apt_archive_cache, least
+                    recently used packages are removed after each build
+    output:         file object for progress messages and build logs, stdout
+                    by default
+    client:         docker client to use instead of connecting to docker_url
+    extra_volumes:  dict of further host paths to bind mount into the build
+                    containers, to their path in the container
+    ccache_dir:     for binary builds, compile with ccache, keeping the cache
+                    in a subdirectory of this host directory per package,
+                    dist, release and architecture
+    ccache_size:    maximum size of each ccache cache, as for ccache -M
+    log_archive:    file to append the build log to, relative to build_dir
+                    unless absolute; gzip or zstd compressed if its name ends
+                    in .gz or .zst
+    write_metrics:  time the phases of the build and write them to
+                    dbuild-<build_type>.metrics.json in build_dir
+    metrics_textfile: time the phases of the build and add them to the
+                    totals in this Prometheus textfile
+    session:        DbuildSession whose view of the images on the docker host
+                    to use and keep up to date
+    scratch:        unpack and build in a workspace local to the container
+                    instead of in build_dir, copying only the artifacts back
+                    to build_dir: 'tmpfs' for a tmpfs of scratch_size, 'disk'
+                    for the container's own filesystem
+    scratch_size:   size of the scratch tmpfs, as for mount -o size
+    transport:      'bind' to bind mount build_dir on /build, or 'archive' to
+                    stream what the build needs of build_dir into the
+                    container and the artifacts back out, for docker hosts
+                    which can't see build_dir
+    pool:           ContainerPool to take a warm container from and run the
+                    build in with docker exec, which implies the archive
+                    transport
+    resume:         start binary builds from the checkpoint of an earlier
+                    failed build with the same build dependencies, if there
+                    is one, skipping the apt update and dependency install
+    checkpoint_keep: how many checkpoints to keep: a failed binary build
+                    which got its dependencies installed is committed as a
+                    checkpoint image. 0 disables checkpoints.
+    checkpoint_ttl: seconds after their last use to remove checkpoints
+    allocator:      scheduler.ResourceAllocator to get CPUs, and memory, for
+                    the build from: it waits until the docker host has them
+                    free, runs in a container pinned to its CPUs and makes
+                    parallel their number. parallel='auto' uses the
+                    allocator shared by the builds of this process unless
+                    given one.
+    memory_per_cpu: with an allocator, memory limit in bytes of the build
+                    container per CPU it gets
+    timeout:        kill the build container once it has run this many
+                    seconds, and raise DbuildBuildTimeoutException; the
+                    container is kept or removed as for a failed build
+    stall_timeout:  likewise once the build has logged nothing for this many
+                    seconds
     kwargs:         dict of unknown arguments. Ignored. For forward compatibility.
     """
+    build_args = dict(source_dir=source_dir, force_rm=force_rm, docker_url=docker_url,
+                      dist=dist, release=release, extra_repos_file=extra_repos_file,
+                      extra_repo_keys_file=extra_repo_keys_file, build_cache=build_cache,
+                      proxy=proxy, build_owner=build_owner, no_default_sources=no_default_sources,
+                      include_timestamps=include_timestamps, cache_dir=cache_dir,
+                      apt_layer_ttl=apt_layer_ttl, builddep_cache=builddep_cache,
+                      builddep_cache_size=builddep_cache_size,
+                      apt_archive_cache=apt_archive_cache,
+                      apt_archive_cache_size=apt_archive_cache_size, output=output,
+                      extra_volumes=extra_volumes, ccache_dir=ccache_dir,
+                      ccache_size=ccache_size, log_archive=log_archive,
+                      write_metrics=write_metrics, metrics_textfile=metrics_textfile,
+                      session=session, scratch=scratch, scratch_size=scratch_size,
+                      transport=transport, pool=pool, resume=resume,
+                      checkpoint_keep=checkpoint_keep, checkpoint_ttl=checkpoint_ttl,
+                      timeout=timeout, stall_timeout=stall_timeout)
+    if allocator is None and parallel != 'auto':
+        return _docker_build(build_dir, build_type, parallel=parallel, client=client, **build_args)
+    allocator = allocator or scheduler.default_allocator()
+    client = client or (pool.client if pool is not None else docker_client(docker_url))
+    allocation = allocator.acquire(client, docker_url, parallel, memory_per_cpu)
+    print('Allocated %s' % allocation, file=output)
+    try:
+        return _docker_build(build_dir, build_type, parallel=allocation.cpus, client=client,
+                             allocation=allocation, **build_args)
+    finally:
+        allocator.release(allocation)
 
-    command = ''
 
-    if no_default_sources:
-        command += '> /etc/apt/sources.list && '
+def _docker_build(build_dir, build_type, source_dir='source', force_rm=False,
+                  docker_url='unix://var/run/docker.sock', dist='ubuntu',
+                  release='trusty', extra_repos_file='repos',
+                  extra_repo_keys_file='keys', build_cache=True, proxy="",
+                  build_owner=None, parallel=1, no_default_sources=False,
+                  include_timestamps=True, cache_dir=None, apt_layer_ttl=None,
+                  builddep_cache=False, builddep_cache_size=None,
+                  apt_archive_cache=None, apt_archive_cache_size=None, output=None,
+                  client=None, extra_volumes=None, ccache_dir=None, ccache_size='5G',
+                  log_archive=None, write_metrics=False, metrics_textfile=None, session=None,
+                  scratch=None, scratch_size='8g', transport='bind', pool=None, resume=False,
+                  checkpoint_keep=5, checkpoint_ttl=3 * 24 * 3600, allocation=None,
+                  timeout=None, stall_timeout=None, **kwargs):
+    """ docker_build, with the resources of allocation if given """
+    started = time.time()
+    if pool is not None:
+        # Pool containers were created before this build, so build_dir
+        # can't be mounted into them
+        transport = 'archive'
+        if scratch == 'tmpfs':
+            raise exceptions.DbuildException(
+                'A tmpfs scratch workspace needs a container of its own, not a pool one')
+    timer = None
+    mark = (lambda name: '')
+    if write_metrics or metrics_textfile:
+        timer = metrics.PhaseTimer()
+        mark = metrics.phase_marker
 
-    if os.path.exists(os.path.join(build_dir, extra_repos_file)):
-        command += 'cp /build/%s \
-        /etc/apt/sources.list.d/dbuild-extra-repos.list && ' % extra_repos_file
+    # Pool containers have the default sources freshly updated already
+    pool_fresh = (pool is not None and not no_default_sources and
+                  not os.path.exists(os.path.join(build_dir, extra_repos_file)) and
+                  not os.path.exists(os.path.join(build_dir, extra_repo_keys_file)))
+    if apt_layer_ttl is None and not pool_fresh:
+        apt_command = apt_prepare_command(build_dir, extra_repos_file,
+                                          extra_repo_keys_file, no_default_sources,
+                                          markers=timer is not None)
+    else:
+        apt_command = ''
 
-    if os.path.exists(os.path.join(build_dir, extra_repo_keys_file)):
-        command += 'apt-key add /build/%s && ' % extra_repo_keys_file
+    # With an apt layer the sources are part of the base image already
+    deps_sources = ''
+    if apt_layer_ttl is None:
+        deps_sources = sources_digest(build_dir, extra_repos_file, extra_repo_keys_file,
+                                      no_default_sources)
+
+    if transport not in TRANSPORTS:
+        raise exceptions.DbuildException('Unknown transport: %s' % transport)
+    shared_volumes = {build_dir: '/build'} if transport == 'bind' else {}
+    shared_volumes.update(extra_volumes or {})
+    if apt_archive_cache:
+        if not os.path.isdir(apt_archive_cache):
+            os.makedirs(apt_archive_cache)
+        shared_volumes[apt_archive_cache] = APT_ARCHIVE_DIR
+        apt_command = apt_archive_command() + (
+            apt_command + apt_archive_publish_command() if apt_command else '')
+
+    source_fields = None
+    if build_type == 'binary' and control.find_dsc(build_dir):
+        source_fields = control.read_control(control.find_dsc(build_dir))
+    elif build_type == 'pipeline':
+        # The source package doesn't exist yet, go by the source tree
+        source_control = os.path.join(build_dir, source_dir, 'debian', 'control')
+        if os.path.exists(source_control):
+            source_fields = control.read_control(source_control)
+
+    builddeps = None
+    if builddep_cache and source_fields is not None:
+        builddeps = control.build_depends(source_fields)
+
+    c = client or (pool.client if pool is not None else docker_client(docker_url))
+
+    ccache_path = None
+    if ccache_dir and source_fields is not None:
+        ccache_path = os.path.join(ccache_dir, '%s_%s_%s_%s' % (
+            source_fields.get('Source'), dist, release, c.version().get('Arch', 'unknown')))
+        if not os.path.isdir(ccache_path):
+            os.makedirs(ccache_path)
+        shared_volumes[ccache_path] = '/ccache'
+
+    if pool is not None:
+        unmounted = [path for path, target in shared_volumes.items()
+                     if pool.shared_volumes.get(path) != target]
+        if unmounted:
+            raise exceptions.DbuildException(
+                'Pool containers do not mount %s' % ', '.join(sorted(unmounted)))
+
+    # A failed build leaves a checkpoint after installing the build
+    # dependencies, for later builds to resume from. Only the bind
+    # transport keeps /build out of the committed container.
+    checkpoint_tag = None
+    checkpoint_index = cache.ImageIndex(cache.index_path(cache_dir, 'checkpoints.json'))
+    no_checkpoint = None
+    if not checkpoint_keep:
+        no_checkpoint = 'checkpoints are disabled'
+    elif builddeps is not None:
+        no_checkpoint = 'the build dependencies come from the build dependency image'
+    elif transport != 'bind':
+        no_checkpoint = 'checkpoints need the bind transport, not a pool or the archive transport'
+    elif source_fields is None:
+        no_checkpoint = 'there is no source package to read the build dependencies of'
+    if no_checkpoint is None and build_type != 'source':
+        checkpoint_tag = checkpoints.checkpoint_tag(
+            dist, release, control.build_depends(source_fields),
+            sources_digest(build_dir, extra_repos_file, extra_repo_keys_file, no_default_sources),
+            proxy, bool(ccache_dir))
+    resumed = None
+    if resume and checkpoint_tag is not None:
+        resumed = checkpoints.find(c, checkpoint_index, checkpoint_tag, docker_url, checkpoint_ttl)
+        print('Resuming from checkpoint %s' % resumed if resumed else 'No checkpoint to resume from',
+              file=output)
+    elif resume and build_type != 'source':
+        print('Not resuming, %s' % no_checkpoint, file=output)
+
+    # Build dependencies (and apt updates) are already in the builddeps
+    # image, or the checkpoint
+    deps_ready = builddeps is not None or resumed is not None
+    prepare_command = apt_command if not deps_ready else ''
+
+    # With a numeric build_owner, everything which writes to /build runs as
+    # that user, so no chown is needed afterwards; apt stays with root.
+    owner = owner_ids(build_owner, build_dir) if build_owner else None
+    if owner is not None:
+        prepare_command += owner_setup_command(owner, ccache_path is not None)
+
+    def unprivileged(command, cwd):
+        command = 'cd %s && %s' % (cwd, command)
+        if owner is None:
+            return command
+        return 'chroot --userspec=%d:%d / env HOME=/tmp bash -c %s' % (
+            owner[0], owner[1], shlex_quote(command))
+
+    # ccache creates its cache directories as whoever runs it first, so it
+    # runs as the build does
+    if ccache_path:
+        prepare_command += unprivileged('ccache -M %s' % shlex_quote(ccache_size), '/') + ' && '
+
+    # With a scratch workspace, the build happens in its copy of the
+    # sources and only the artifacts are written to /build at the end
+    if scratch is not None and scratch not in SCRATCH_KINDS:
+        raise exceptions.DbuildException('Unknown scratch workspace: %s' % scratch)
+    workdir = SCRATCH_DIR if scratch else '/build'
+    source_out = posixpath.dirname(posixpath.join(workdir, source_dir))
+    dsc_dir = source_out if scratch and build_type == 'pipeline' else '/build'
+    if scratch:
+        if resumed is not None:
+            # Leftovers of the failed build the checkpoint was taken from
+            prepare_command += 'rm -rf %s && ' % SCRATCH_DIR
+        prepare_command += 'mkdir -p %s && chmod 1777 %s && ' % (SCRATCH_DIR, SCRATCH_DIR)
+    # The archive transport fetches the artifacts from their own directory
+    result_dir = '/build'
+    if transport == 'archive':
+        result_dir = transports.OUT_DIR
+        prepare_command += 'mkdir -p %s && chmod 1777 %s && ' % (result_dir, result_dir)
 
-    command += 'export DEBIAN_FRONTEND=noninteractive; apt-get -y update \
-                   && apt-get -y dist-upgrade && '
+    source_command = mark('source-build')
+    if scratch:
+        source_command += unprivileged('mkdir -p %s && cp -a /build/%s/. %s/ && %s' % (
+            source_dir, source_dir, source_dir,
+            link_orig_command(posixpath.dirname(posixpath.join('/build', source_dir)), source_out)),
+            SCRATCH_DIR) + ' && '
+    source_command += unprivileged('dpkg-buildpackage -S -I -nc -uc -us',
+                                   posixpath.join(workdir, source_dir))
+    binary_command = (mark('unpack-source') +
+                      unprivileged('dpkg-source -x %s/*.dsc %s/pkgbuild/' % (dsc_dir, workdir),
+                                   workdir) +
+                      ' && cd %s/pkgbuild && ' % workdir)
+    if not deps_ready:
+        satisfy_command = "/usr/lib/pbuilder/pbuilder-satisfydepends && "
+        if apt_archive_cache:
+            satisfy_command += apt_archive_publish_command()
+        binary_command += mark('build-deps') + satisfy_command
+        if checkpoint_tag is not None:
+            binary_command += checkpoints.marker_command()
+    binary_command += mark('binary-build') + unprivileged(
+        "dpkg-buildpackage -b -uc -us -j{}".format(parallel), '%s/pkgbuild' % workdir)
 
     if build_type == 'source':
-        command += 'dpkg-buildpackage -S -I -nc -uc -us'
+        command = prepare_command + source_command
         cwd = '/build/' + source_dir
     elif build_type == 'binary':
-        command += "dpkg-source -x /build/*.dsc /build/pkgbuild/ && \
-                      cd /build/pkgbuild && \
-                      /usr/lib/pbuilder/pbuilder-satisfydepends && \
-                      dpkg-buildpackage -b -uc -us -j{}".format(parallel)
+        command = prepare_command + binary_command
+        cwd = '/build'
+    elif build_type == 'pipeline':
+        # Source and binary build in one container. A failure in the binary
+        # half exits with PIPELINE_BINARY_FAILED so it can be told apart.
+        command = prepare_command + '(%s) || exit %d; (%s) || exit %d' % (
+            source_command, PIPELINE_SOURCE_FAILED, binary_command, PIPELINE_BINARY_FAILED)
         cwd = '/build'
     else:
         raise exceptions.DbuildBuildFailedException(
             'Unknown build_type: %s' % build_type)
 
-    if build_owner:
-        command += ' ; rv=$? ; chown -R %s /build ; exit $rv' % build_owner
+    if scratch or result_dir != '/build':
+        # Copy back whatever was built even if the build failed, but fail
+        # a build whose artifacts could not be copied back
+        copies = []
+        if build_type != 'binary':
+            copies.append((source_out, posixpath.dirname(posixpath.join(result_dir, source_dir))))
+        if build_type != 'source' and (workdir, result_dir) not in copies:
+            copies.append((workdir, result_dir))
+        copy_command = ' && '.join(unprivileged(copy_back_command(from_dir, to_dir), '/')
+                                   for from_dir, to_dir in copies)
+        command = '(%s) ; rv=$? ; %s%s || { [ $rv -ne 0 ] || rv=%d ; } ; exit $rv' % (
+            command, mark('copy-back'), copy_command,
+            PIPELINE_SOURCE_FAILED if build_type == 'source' else PIPELINE_BINARY_FAILED)
 
-    c = docker_client(docker_url)
-    print("Starting %s Package Build" % build_type)
+    if ccache_path:
+        command = 'export PATH=/usr/lib/ccache:$PATH CCACHE_DIR=/ccache && (%s) ; rv=$? ; %s%s ; exit $rv' % (
+            command, mark('ccache-stats'), unprivileged('ccache -s', '/'))
 
-    # Create docker_dir - a temporary directory which will have Dockerfile and
-    # scripts to build the container.
-    docker_path = mkdtemp()
+    if build_owner and owner is None:
+        command = '(%s) ; rv=$? ; %schown -R %s /build ; exit $rv' % (
+            command, mark('chown'), build_owner)
 
-    try:
-        create_dockerfile(dist, release, docker_path, proxy)
-        image_tag = 'dbuild-' + dist + '/' + release
-        for l in build_image(c, docker_path, tag=image_tag, nocache=not build_cache):
-            print(l)
-    finally:
-        shutil.rmtree(docker_path)
+    if timer is not None:
+        command = metrics.exit_marker() + command
 
-    container = create_container(c, image_tag, cwd=cwd,
-                                 command=['bash', '-c', command],
-                                 shared_volumes={build_dir: '/build'})
-    print(container)
+    print("Starting %s Package Build" % build_type, file=output)
+
+    image_index = cache.ImageIndex(cache.index_path(cache_dir, 'images.json'))
+    builddep_index = cache.ImageIndex(cache.index_path(cache_dir, 'builddeps.json'))
+
+    def prepare():
+        tags = [prepare_image(c, dist, release, proxy, build_cache=build_cache,
+                              docker_url=docker_url, image_index=image_index,
+                              output=output, ccache=bool(ccache_dir), timer=timer,
+                              session=session)]
+        if resumed is not None:
+            # The checkpoint has everything up to the build dependencies
+            tags.append(resumed)
+        elif apt_layer_ttl is not None:
+            with metrics.timed(timer, 'apt-layer'):
+                tags.append(prepare_apt_layer(c, tags[-1], dist, release, build_dir,
+                                              extra_repos_file, extra_repo_keys_file,
+                                              no_default_sources, ttl=apt_layer_ttl,
+                                              docker_url=docker_url, image_index=image_index,
+                                              output=output))
+        if builddeps is not None:
+            base_built = image_index.get(docker_url, tags[-1])['built']
+            with metrics.timed(timer, 'builddep-image'):
+                tags.append(prepare_builddep_image(c, tags[-1], dist, release, build_dir,
+                                                   builddeps, apt_command, force_rm=force_rm,
+                                                   include_timestamps=include_timestamps,
+                                                   shared_volumes=shared_volumes,
+                                                   docker_url=docker_url,
+                                                   image_index=builddep_index,
+                                                   base_built=base_built,
+                                                   max_size=builddep_cache_size,
+                                                   sources=deps_sources,
+                                                   build_files=build_files,
+                                                   timeout=timeout,
+                                                   stall_timeout=stall_timeout,
+                                                   output=output))
+        if session is not None:
+            for tag in tags:
+                session.add_image(tag, docker_url)
+        return tags
+
+    # What the archive transport sends into the containers
+    build_files = None
+    if transport == 'archive':
+        build_files = [extra_repos_file, extra_repo_keys_file]
 
-    start_container(c, container)
+    tags = prepare()
+    container_args = dict(cwd=cwd, command=['bash', '-c', command],
+                          shared_volumes=shared_volumes,
+                          labels=container_labels(build_type))
+    if allocation is not None:
+        # Pool containers exist already, their builds only get parallel
+        container_args['resources'] = allocation.host_config()
+        container_args['labels'].update(allocation.labels())
+    if scratch == 'tmpfs':
+        container_args['tmpfs'] = {SCRATCH_DIR: 'rw,exec,mode=1777,size=%s' % scratch_size}
 
-    if sys.version_info.major == 2:
-        stdout = codecs.getwriter('utf-8')(sys.stdout)
+    def create():
+        if pool is not None:
+            return pool.acquire(tags[-1])
+        return create_container(c, tags[-1], **container_args)
+
+    try:
+        with metrics.timed(timer, 'create-container'):
+            created = create()
+    except docker_errors.NotFound:
+        # The image was removed from the docker host behind our back
+        for tag in tags:
+            image_index.discard(docker_url, tag)
+            builddep_index.discard(docker_url, tag)
+            checkpoint_index.discard(docker_url, tag)
+        if session is not None:
+            session.invalidate(docker_url)
+        tags = prepare()
+        with metrics.timed(timer, 'create-container'):
+            created = create()
+    pooled = created if pool is not None else None
+    container = pooled.container if pooled is not None else created
+    print(container, file=output)
+
+    if transport == 'archive':
+        with metrics.timed(timer, 'upload'):
+            transports.put_build_dir(c, container, build_dir,
+                                     transports.archive_members(build_dir, build_type, source_dir,
+                                                                build_files),
+                                     owner)
+
+    sinks = []
+    if log_archive:
+        sinks.append(logs.file_sink(os.path.join(build_dir, log_archive)))
+    if timer is not None:
+        phases = metrics.PhaseSink()
+        sinks.append(phases)
+    checkpoint_marks = checkpoints.MarkerSink()
+    if checkpoint_tag is not None and resumed is None:
+        sinks.append(checkpoint_marks)
+    # Killing the container ends the log stream and the wait below
+    watchdog = watchdogs.Watchdog(lambda: watchdogs.kill_container(c, container),
+                                  timeout, stall_timeout)
+    sinks.append(watchdog)
+    if pooled is not None:
+        with metrics.timed(timer, 'run-container'), watchdog:
+            rv = pool.run(pooled, command, cwd, [logs.StreamSink(output)] + sinks)
     else:
-        stdout = sys.stdout
+        with metrics.timed(timer, 'start-container'):
+            start_container(c, container)
+        with metrics.timed(timer, 'run-container'), watchdog:
+            print_container_logs(c, container, include_timestamps, output, sinks)
+            rv = wait_container(c, container)
+    if watchdog.reason is not None:
+        print('%s, killed container %s' % (watchdog.reason, container.get('Id')), file=output)
+
+    if transport == 'archive':
+        with metrics.timed(timer, 'download'):
+            try:
+                fetched = transports.get_artifacts(c, container, build_dir)
+            except docker_errors.NotFound:
+                # The build failed before making the artifacts directory
+                if rv == 0:
+                    raise
+                fetched = []
+        print('Fetched %s' % (', '.join(fetched) or 'no artifacts'), file=output)
+
+    if apt_archive_cache and apt_archive_cache_size is not None:
+        cache.prune_apt_archive(apt_archive_cache, apt_archive_cache_size)
 
-    for l in container_logs(c, container,
-                            include_timestamps=include_timestamps):
-        stdout.write(l.decode('utf-8'))
-        stdout.write('\n')
+    if rv != 0 and checkpoint_marks.seen:
+        with metrics.timed(timer, 'checkpoint'):
+            checkpoints.commit(c, container, checkpoint_tag, checkpoint_index, docker_url)
+        print('Saved checkpoint %s, use --resume to build from it' % checkpoint_tag, file=output)
+    if checkpoint_tag is not None:
+        checkpoints.prune(c, checkpoint_index, checkpoint_keep, checkpoint_ttl, docker_url)
 
-    rv = wait_container(c, container)
+    def remove():
+        with metrics.timed(timer, 'remove-container'):
+            if pooled is not None:
+                pool.release(pooled)
+            else:
+                remove_container(c, container, force=True)
 
     if rv == 0:
         print('Build successful (build type: %s), removing container %s' % (
-            build_type, container.get('Id')))
-        remove_container(c, container, force=True)
+            build_type, container.get('Id')), file=output)
+        remove()
         build_rv = True
     else:
         if force_rm:
             print("Build failed (build type: %s), Removing container %s" % (
-                build_type, container.get('Id')))
-            remove_container(c, container, force=True)
+                build_type, container.get('Id')), file=output)
+            remove()
             build_rv = False
         else:
             print("Build failed (build type: %s), keeping container %s" % (
-                build_type, container.get('Id')))
+                build_type, container.get('Id')), file=output)
+            if pooled is not None:
+                pool.release(pooled, keep=True)
             build_rv = False
 
+    if timer is not None:
+        phases.add_phases(timer)
+        fields = control.source_control(build_dir, source_dir) or {}
+        finished = time.time()
+        record = {'build_dir': os.path.abspath(build_dir), 'build_type': build_type,
+                  'source': fields.get('Source'), 'dist': dist, 'release': release,
+                  'docker_url': docker_url, 'image': tags[-1], 'exit_code': rv,
+                  'success': build_rv, 'started': started, 'finished': finished,
+                  'duration': finished - started, 'phases': timer.phases}
+        if write_metrics:
+            metrics.write_record(os.path.join(build_dir, 'dbuild-%s.metrics.json' % build_type),
+                                 record)
+        if metrics_textfile:
+            metrics.update_textfile(metrics_textfile, record, cache_dir)
+
     if build_rv:
         return build_rv
-    elif build_type == 'source':
+    elif watchdog.reason is not None:
+        raise exceptions.DbuildBuildTimeoutException(watchdog.reason)
+    elif build_type == 'source' or (build_type == 'pipeline' and rv != PIPELINE_BINARY_FAILED):
         raise exceptions.DbuildSourceBuildFailedException(
             'Source build FAILED')
-    elif build_type == 'binary':
+    else:
         raise exceptions.DbuildBinaryBuildFailedException(
             'Binary build FAILED')
 
 
-def main(argv=sys.argv[1:]):
-    ap = argparse.ArgumentParser(
-        description='Build debian packages in docker container')
-    ap.add_argument('build_dir', type=str, help='package build directory')
+def result_key(build_dir, source_dir='source', dist='ubuntu', release='trusty',
+               extra_repos_file='repos', extra_repo_keys_file='keys',
+               no_default_sources=False, cache_dir=None, docker_url='unix://var/run/docker.sock',
+               client=None, pool=None, **kwargs):
+    """
+    Result cache key of a package build: a hash of the source tree, the
+    apt sources, the architecture of the docker host and the options which
+    can change the artifacts.
+    """
+    c = client or (pool.client if pool is not None else docker_client(docker_url))
+    arch = c.version().get('Arch', 'unknown')
+    fingerprints = cache.FingerprintStore(cache.index_path(cache_dir, 'fingerprints.json'))
+    h = hashlib.sha256()
+    for value in (RESULT_CACHE_VERSION, dist, release, arch, source_dir,
+                  sources_digest(build_dir, extra_repos_file, extra_repo_keys_file,
+                                 no_default_sources),
+                  fingerprints.tree_digest(os.path.join(build_dir, source_dir))):
+        h.update(value.encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def build_package(build_dir, pipeline=False, parallel=1, result_cache=False,
+                  result_cache_size=None, **kwargs):
+    """
+    Build the source and then the binary packages in build_dir, or both in
+    one container if pipeline is True. Takes the same arguments as
+    docker_build and raises its exceptions.
+
+    With result_cache, the artifacts of successful builds are kept in a
+    cache under cache_dir, bounded to result_cache_size bytes, and a later
+    build of identical inputs restores them without running any container.
+    """
+    if result_cache:
+        results = cache.ResultCache(cache.index_path(kwargs.get('cache_dir'), 'results'),
+                                    max_size=result_cache_size)
+        key = result_key(build_dir, **kwargs)
+        restored = results.restore(key, build_dir)
+        stats = results.stats()
+        if restored is not None:
+            print('Result cache hit, restored %s (%d hits, %d misses)' % (
+                ', '.join(restored), stats['hits'], stats['misses']), file=kwargs.get('output'))
+            return True
+        print('Result cache miss (%d hits, %d misses)' % (stats['hits'], stats['misses']),
+              file=kwargs.get('output'))
+        before = cache.artifacts_snapshot(build_dir)
+
+    if pipeline:
+        rv = docker_build(build_dir=build_dir, build_type='pipeline',
+                          parallel=parallel, **kwargs)
+    else:
+        docker_build(build_dir=build_dir, build_type='source', **kwargs)
+        rv = docker_build(build_dir=build_dir, build_type='binary',
+                          parallel=parallel, **kwargs)
+
+    if result_cache:
+        after = cache.artifacts_snapshot(build_dir)
+        results.store(key, build_dir, [name for name in after if before.get(name) != after[name]])
+    return rv
+
+
+def parallel_type(value):
+    """ argparse type of --parallel: a number of processes, or auto """
+    if value == 'auto':
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected a number or 'auto': %r" % value)
+
+
+def add_build_arguments(ap):
+    """ Add the command line options for build settings to parser ap """
     ap.add_argument('--source-dir', type=str, default='source',
                     help='subdirectory of build_dir where sources kept')
     ap.add_argument('--force-rm', action='store_true', default=False,
@@ -243,52 +1202,163 @@ def main(argv=sys.argv[1:]):
     ap.add_argument('--proxy', type=str, default="",
                     help='Value of proxy to be passed when used behind proxy'
                          'otherwise it will be default empty')
-    ap.add_argument('--build-owner', action='store', type=int,
-                    help='uid to reassign everything to')
-    ap.add_argument('--parallel', '-j', action='store', type=int,
-                    default=1, help='how many processes to run in parallel')
+    ap.add_argument('--apt-proxy-cache', type=str, default=None, metavar='DIR',
+                    help='Run a caching apt proxy for the builds, keeping the '
+                         'packages in DIR; needs a local docker host')
+    ap.add_argument('--apt-proxy-cache-size', type=int, default=10 << 30, metavar='BYTES',
+                    help='Size limit of the apt proxy cache (default: 10 GiB)')
+    ap.add_argument('--apt-proxy-port', type=int, default=proxies.DEFAULT_PORT, metavar='PORT',
+                    help='Port of the apt proxy on the docker bridge (default: %d)'
+                         % proxies.DEFAULT_PORT)
+    ap.add_argument('--build-owner', action='store', type=str, metavar='UID[:GID]',
+                    help='Run the build steps as this uid (and gid, by default '
+                         'the group of the build directory), so the results '
+                         'belong to it')
+    ap.add_argument('--parallel', '-j', action='store', type=parallel_type,
+                    default=1, help='how many processes to run in parallel, or '
+                                    'auto for a share of the CPUs of the docker '
+                                    'host, limiting the build to them')
+    ap.add_argument('--memory-per-cpu', type=int, default=2 << 30, metavar='BYTES',
+                    help='With --parallel auto, memory limit of the build '
+                         'container per CPU it gets (default: 2 GiB), 0 for none')
     ap.add_argument('--no-default-sources', action='store_true',
                     help='Discard existing sources, only use the ones '
                          'passed in')
     ap.add_argument('--no-include-timestamps', dest='include_timestamps',
                     action='store_false',
                     help='Don\'t include timestamps in output')
+    ap.add_argument('--cache-dir', type=str, default=None,
+                    help='Directory for dbuild\'s local state (default: '
+                         '~/.cache/dbuild)')
+    ap.add_argument('--apt-layer-ttl', type=int, default=None, metavar='SECONDS',
+                    help='Build in a cached image with apt already updated and '
+                         'upgraded, refreshed after this many seconds')
+    ap.add_argument('--builddep-cache', action='store_true', default=False,
+                    help='Reuse an image with the build dependencies installed '
+                         'for binary builds with the same Build-Depends')
+    ap.add_argument('--builddep-cache-size', type=int, default=None, metavar='BYTES',
+                    help='Disk budget for build dependency images')
+    ap.add_argument('--apt-archive-cache', type=str, default=None, metavar='DIR',
+                    help='Host directory to share between builds as apt '
+                         'package cache')
+    ap.add_argument('--apt-archive-cache-size', type=int, default=None, metavar='BYTES',
+                    help='Size limit of the apt package cache')
+    ap.add_argument('--pipeline', action='store_true', default=False,
+                    help='Do the source and binary builds in a single container')
+    ap.add_argument('--result-cache', action='store_true', default=False,
+                    help='Skip builds whose inputs are unchanged since a '
+                         'previous successful build, restoring its artifacts')
+    ap.add_argument('--result-cache-size', type=int, default=None, metavar='BYTES',
+                    help='Size limit of the build result cache')
+    ap.add_argument('--ccache-dir', type=str, default=None, metavar='DIR',
+                    help='Compile binary packages with ccache, keeping the '
+                         'caches under DIR on the docker host')
+    ap.add_argument('--ccache-size', type=str, default='5G', metavar='SIZE',
+                    help='Maximum size of each ccache cache (default: 5G)')
+    ap.add_argument('--log-archive', type=str, default=None, metavar='FILE',
+                    help='Also append the build log to FILE, relative to the '
+                         'build directory; compressed if FILE ends in .gz or .zst')
+    ap.add_argument('--metrics', action='store_true', default=False, dest='write_metrics',
+                    help='Time the phases of each build and write them to '
+                         'dbuild-<build type>.metrics.json in the build directory')
+    ap.add_argument('--metrics-textfile', type=str, default=None, metavar='FILE',
+                    help='Keep totals of the build phase timings in FILE, a '
+                         'Prometheus textfile')
+    ap.add_argument('--scratch', type=str, default=None, choices=SCRATCH_KINDS,
+                    help='Unpack and build in a workspace inside the container, '
+                         'a tmpfs or its own filesystem, and only copy the '
+                         'artifacts back to the build directory')
+    ap.add_argument('--scratch-size', type=str, default='8g', metavar='SIZE',
+                    help='Size of the --scratch tmpfs (default: 8g)')
+    ap.add_argument('--resume', action='store_true', default=False,
+                    help='Start binary builds from the checkpoint a failed '
+                         'build with the same build dependencies left')
+    ap.add_argument('--checkpoint-keep', type=int, default=5, metavar='N',
+                    help='Checkpoints of failed builds to keep, 0 to take '
+                         'none (default: 5)')
+    ap.add_argument('--checkpoint-ttl', type=int, default=3 * 24 * 3600, metavar='SECONDS',
+                    help='Remove checkpoints unused for this long (default: 3 days)')
+    ap.add_argument('--timeout', type=int, default=None, metavar='SECONDS',
+                    help='Kill builds running for longer than this')
+    ap.add_argument('--stall-timeout', type=int, default=None, metavar='SECONDS',
+                    help='Kill builds which have logged nothing for this long')
+    ap.add_argument('--transport', type=str, default='bind', choices=TRANSPORTS,
+                    help='bind: mount the build directory in the containers; '
+                         'archive: copy it in and the artifacts out, for '
+                         'docker hosts without access to it (default: bind)')
+
+
+def build_arguments(args):
+    """ build_package keyword arguments from options parsed by add_build_arguments """
+    return dict(source_dir=args.source_dir,
+                force_rm=args.force_rm, docker_url=args.docker_url,
+                dist=args.dist, release=args.release,
+                extra_repos_file=args.extra_repos_file,
+                extra_repo_keys_file=args.extra_repo_keys_file,
+                build_cache=args.build_cache, proxy=args.proxy,
+                build_owner=args.build_owner, parallel=args.parallel,
+                no_default_sources=args.no_default_sources,
+                include_timestamps=args.include_timestamps,
+                cache_dir=args.cache_dir,
+                apt_layer_ttl=args.apt_layer_ttl,
+                builddep_cache=args.builddep_cache,
+                builddep_cache_size=args.builddep_cache_size,
+                apt_archive_cache=args.apt_archive_cache,
+                apt_archive_cache_size=args.apt_archive_cache_size,
+                pipeline=args.pipeline,
+                result_cache=args.result_cache,
+                result_cache_size=args.result_cache_size,
+                ccache_dir=args.ccache_dir,
+                ccache_size=args.ccache_size,
+                log_archive=args.log_archive,
+                write_metrics=args.write_metrics,
+                metrics_textfile=args.metrics_textfile,
+                scratch=args.scratch,
+                scratch_size=args.scratch_size,
+                transport=args.transport,
+                resume=args.resume,
+                checkpoint_keep=args.checkpoint_keep,
+                checkpoint_ttl=args.checkpoint_ttl,
+                memory_per_cpu=args.memory_per_cpu or None,
+                timeout=args.timeout,
+                stall_timeout=args.stall_timeout)
+
+
+def main(argv=sys.argv[1:]):
+    if argv[:1] == ['batch']:
+        return batch.main(argv[1:])
+    if argv[:1] == ['graph']:
+        return graph.main(argv[1:])
+    if argv[:1] == ['bench']:
+        return bench.main(argv[1:])
+    if argv[:1] == ['serve']:
+        return service.main(argv[1:])
+    if argv[:1] == ['sweep']:
+        return watchdogs.main(argv[1:])
+
+    ap = argparse.ArgumentParser(
+        description='Build debian packages in docker container')
+    ap.add_argument('build_dir', type=str, help='package build directory')
+    add_build_arguments(ap)
     args = ap.parse_args(argv)
 
     try:
-        docker_build(build_dir=args.build_dir,
-                     build_type='source', source_dir=args.source_dir,
-                     force_rm=args.force_rm, docker_url=args.docker_url,
-                     dist=args.dist, release=args.release,
-                     extra_repos_file=args.extra_repos_file,
-                     extra_repo_keys_file=args.extra_repo_keys_file,
-                     build_cache=args.build_cache, proxy=args.proxy,
-                     build_owner=args.build_owner,
-                     no_default_sources=args.no_default_sources,
-                     include_timestamps=args.include_timestamps)
+        with proxies.from_args(build_arguments(args), args) as build_args:
+            build_package(args.build_dir, **build_args)
     except exceptions.DbuildSourceBuildFailedException:
         print('ERROR | Source build failed for build directory: %s'
               % args.build_dir)
         return False
-
-    try:
-        docker_build(build_dir=args.build_dir,
-                     build_type='binary', source_dir=args.source_dir,
-                     force_rm=args.force_rm, docker_url=args.docker_url,
-                     dist=args.dist, release=args.release,
-                     extra_repos_file=args.extra_repos_file,
-                     extra_repo_keys_file=args.extra_repo_keys_file,
-                     build_cache=args.build_cache, proxy=args.proxy,
-                     build_owner=args.build_owner,
-                     parallel=args.parallel,
-                     no_default_sources=args.no_default_sources,
-                     include_timestamps=args.include_timestamps)
     except exceptions.DbuildBinaryBuildFailedException:
         print('ERROR | Binary build failed for build directory: %s'
               % args.build_dir)
         return False
+    except exceptions.DbuildBuildTimeoutException as e:
+        print('ERROR | %s for build directory: %s' % (e, args.build_dir))
+        return False
 
     return True
 
+
 if __name__ == "__main__":
     sys.exit(not main(sys.argv[1:]))
@@ -0,0 +1,239 @@
+import argparse
+import codecs
+import json
+import multiprocessing
+import os
+import threading
+import time
+
+from six.moves import queue
+
+import dbuild
+from dbuild import cache
+from dbuild import exceptions
+from dbuild import proxy
+from dbuild import scheduler
+
+
+class BuildResult(object):
+    """ Outcome of one build of a batch """
+
+    def __init__(self, build_dir, log_file):
+        self.build_dir = build_dir
+        self.log_file = log_file
+        self.success = None
+        self.failed_phase = None
+        self.error = None
+        self.started = None
+        self.finished = None
+
+    @property
+    def duration(self):
+        if self.started is None or self.finished is None:
+            return None
+        return self.finished - self.started
+
+    def as_dict(self):
+        return {'build_dir': self.build_dir, 'log_file': self.log_file,
+                'success': self.success, 'failed_phase': self.failed_phase,
+                'error': self.error, 'started': self.started,
+                'finished': self.finished, 'duration': self.duration}
+
+
+def log_path(log_dir, index, build_dir):
+    """ Log file of the index'th build of a batch """
+    if log_dir is None:
+        return os.path.join(build_dir, 'dbuild.log')
+    name = os.path.basename(os.path.normpath(build_dir))
+    return os.path.join(log_dir, '%03d-%s.log' % (index, name))
+
+
+def run_job(result, build_args, hosts=None):
+    """
+    Build result.build_dir, logging to result.log_file, and fill in result.
+    The build is placed on one of hosts, a scheduler.HostPool, if given.
+    """
+    result.started = time.time()
+    try:
+        with codecs.open(result.log_file, 'w', 'utf-8') as output:
+            if hosts is not None:
+                hosts.run(dbuild.build_package, result.build_dir, output=output, **build_args)
+            else:
+                dbuild.build_package(result.build_dir, output=output, **build_args)
+        result.success = True
+    except exceptions.DbuildSourceBuildFailedException as e:
+        result.success, result.failed_phase, result.error = False, 'source', str(e)
+    except exceptions.DbuildBinaryBuildFailedException as e:
+        result.success, result.failed_phase, result.error = False, 'binary', str(e)
+    except exceptions.DbuildBuildTimeoutException as e:
+        result.success, result.failed_phase, result.error = False, 'timeout', str(e)
+    except Exception as e:
+        # Docker connection problems and the like; keep the batch going
+        result.success, result.error = False, '%s: %s' % (type(e).__name__, e)
+    result.finished = time.time()
+    return result
+
+
+def prepare_shared_image(build_args, hosts=None):
+    """
+    Build the dbuild image once up front, on every host of a HostPool if
+    given, so the jobs of a batch don't all race to build it. Returns
+    build_args for the jobs.
+    """
+    image_index = cache.ImageIndex(cache.index_path(build_args.get('cache_dir'), 'images.json'))
+
+    def prepare(client, docker_url):
+        dbuild.prepare_image(client, build_args.get('dist', 'ubuntu'),
+                             build_args.get('release', 'trusty'), build_args.get('proxy', ''),
+                             build_cache=build_args.get('build_cache', True),
+                             docker_url=docker_url, image_index=image_index,
+                             ccache=bool(build_args.get('ccache_dir')))
+
+    if hosts is None:
+        docker_url = build_args.get('docker_url', 'unix://var/run/docker.sock')
+        prepare(build_args.get('client') or dbuild.docker_client(docker_url), docker_url)
+    else:
+        for host in hosts.hosts:
+            try:
+                prepare(hosts.client(host), host.url)
+            except scheduler.HOST_ERRORS:
+                hosts.mark_down(host)
+    # The image is fresh now, jobs mustn't rebuild it again
+    return dict(build_args, build_cache=True)
+
+
+def share_resources(build_args, workers, hosts=None):
+    """
+    build_args with a scheduler.ResourceAllocator sharing the CPUs of each
+    docker host among workers builds, or the slots of hosts, when they
+    ask for parallel='auto'
+    """
+    if build_args.get('parallel') != 'auto' or build_args.get('allocator') is not None:
+        return build_args
+    concurrency = workers
+    if hosts is not None and hosts.hosts:
+        concurrency = max(host.slots for host in hosts.hosts)
+    return dict(build_args, allocator=scheduler.ResourceAllocator(concurrency=concurrency))
+
+
+def batch_build(build_dirs, workers=None, log_dir=None, hosts=None, **build_args):
+    """
+    Build the packages in build_dirs on a pool of workers threads.
+
+    build_dirs: package build directories
+    workers:    how many builds to run concurrently, by default the number of
+                slots of hosts or 1
+    log_dir:    directory for per-build log files, by default each build
+                logs to dbuild.log in its build_dir
+    hosts:      a scheduler.HostPool to spread the builds over, instead of
+                building everything on build_args['docker_url']
+    build_args: arguments for dbuild.build_package
+
+    Returns a list of BuildResult, in the order of build_dirs.
+    """
+    if log_dir is not None and not os.path.isdir(log_dir):
+        os.makedirs(log_dir)
+    results = [BuildResult(build_dir, log_path(log_dir, i, build_dir))
+               for i, build_dir in enumerate(build_dirs)]
+    if not results:
+        return results
+
+    if hosts is not None:
+        build_args.pop('docker_url', None)
+        build_args.pop('client', None)
+    if workers is None:
+        workers = hosts.slots if hosts is not None else 1
+    build_args = share_resources(prepare_shared_image(build_args, hosts), workers, hosts)
+
+    jobs = queue.Queue()
+    for result in results:
+        jobs.put(result)
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            try:
+                result = jobs.get_nowait()
+            except queue.Empty:
+                return
+            run_job(result, build_args, hosts)
+            with lock:
+                print('%s %s (%.1fs, log: %s)' % ('OK    ' if result.success else 'FAILED',
+                                                  result.build_dir, result.duration,
+                                                  result.log_file))
+
+    threads = [threading.Thread(target=worker) for _ in range(min(workers, len(results)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def format_summary(results):
+    """ Human readable summary of timings and failures of a batch """
+    failed = [r for r in results if not r.success]
+    durations = [r.duration for r in results if r.duration is not None]
+    lines = ['%d builds, %d succeeded, %d failed' % (len(results), len(results) - len(failed),
+                                                     len(failed))]
+    if durations:
+        ran = [r for r in results if r.duration is not None]
+        wall = max(r.finished for r in ran) - min(r.started for r in ran)
+        lines.append('wall time %.1fs, build time total %.1fs, mean %.1fs, max %.1fs' % (
+            wall, sum(durations), sum(durations) / len(durations), max(durations)))
+    for r in failed:
+        lines.append('FAILED %s: %s (log: %s)' % (r.build_dir, r.error or r.failed_phase,
+                                                  r.log_file))
+    return '\n'.join(lines)
+
+
+def add_batch_arguments(ap):
+    """ Add the command line options for running many builds to parser ap """
+    ap.add_argument('build_dirs', type=str, nargs='+', help='package build directories')
+    ap.add_argument('--workers', '-w', type=int, default=None,
+                    help='how many builds to run concurrently (default: the '
+                         'total slots of --docker-host, or the number of CPUs)')
+    ap.add_argument('--docker-host', type=str, action='append', default=[],
+                    metavar='URL[=SLOTS]', dest='docker_hosts',
+                    help='Spread the builds over this docker host, running up '
+                         'to SLOTS (default 1) builds on it at once. May be '
+                         'given several times.')
+    ap.add_argument('--log-dir', type=str, default=None,
+                    help='Directory for per-build logs (default: dbuild.log in '
+                         'each build directory)')
+    ap.add_argument('--results', type=str, default=None, metavar='FILE',
+                    help='Write the build results to FILE as JSON')
+    dbuild.add_build_arguments(ap)
+
+
+def batch_arguments(args):
+    """ batch_build keyword arguments from options parsed by add_batch_arguments """
+    hosts = None
+    workers = args.workers
+    if args.docker_hosts:
+        hosts = scheduler.HostPool([scheduler.DockerHost.parse(h) for h in args.docker_hosts])
+    elif workers is None:
+        workers = multiprocessing.cpu_count()
+    return dict(dbuild.build_arguments(args), workers=workers, log_dir=args.log_dir,
+                hosts=hosts)
+
+
+def report(results, results_file=None):
+    """ Print the summary of a batch and optionally save its results as JSON """
+    print(format_summary(results))
+    if results_file:
+        with open(results_file, 'w') as fp:
+            json.dump([r.as_dict() for r in results], fp, indent=2)
+    return all(r.success for r in results)
+
+
+def main(argv):
+    ap = argparse.ArgumentParser(
+        prog='dbuild batch',
+        description='Build many debian packages in docker containers concurrently')
+    add_batch_arguments(ap)
+    args = ap.parse_args(argv)
+
+    with proxy.from_args(batch_arguments(args), args) as build_args:
+        results = batch_build(args.build_dirs, **build_args)
+    return report(results, args.results)
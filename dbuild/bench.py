@@ -0,0 +1,265 @@
+import argparse
+import collections
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import six
+
+import dbuild
+from dbuild import batch
+from dbuild import fakedocker
+from dbuild import logs
+from dbuild import scheduler
+
+
+def synthetic_log(lines=200000, line_length=100, chunk_size=None):
+    """
+    Log stream of a chatty build as a list of byte chunks: one chunk per
+    line like a process writing line by line, or chunk_size bytes each like
+    one writing through a full stdio buffer.
+    """
+    line = (u'[%06d] ' + u'x' * max(line_length - 9, 0) + u'\xe9\n')
+    data = [(line % i).encode('utf-8') for i in range(lines)]
+    if not chunk_size:
+        return data
+    data = b''.join(data)
+    return [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+
+
+def make_sink(kind, tmpdir):
+    if kind == 'null':
+        return logs.NullSink()
+    if kind == 'stream':
+        # A terminal, without the terminal
+        return logs.StreamSink(io.StringIO())
+    suffix = {'file': '', 'gz': '.gz', 'zst': '.zst'}[kind]
+    return logs.file_sink(os.path.join(tmpdir, 'build.log' + suffix))
+
+
+def log_throughput(lines=200000, line_length=100, chunk_size=None, sinks=('stream',)):
+    """
+    Time a LogPipeline over a synthetic log with the given kinds of sinks
+    (null, stream, file, gz, zst). Returns a dict of the figures.
+    """
+    chunks = synthetic_log(lines, line_length, chunk_size)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        pipeline = logs.LogPipeline([make_sink(kind, tmpdir) for kind in sinks])
+        started = time.time()
+        with pipeline:
+            for chunk in chunks:
+                pipeline.feed(chunk)
+        seconds = time.time() - started
+    finally:
+        shutil.rmtree(tmpdir)
+    return {'lines': pipeline.lines, 'bytes': pipeline.bytes, 'seconds': seconds,
+            'lines_per_second': pipeline.lines / seconds if seconds else None,
+            'mb_per_second': pipeline.bytes / seconds / 1e6 if seconds else None}
+
+
+def legacy_log_throughput(lines=200000, line_length=100):
+    """
+    Time the former way of printing build logs, decoding and writing every
+    line on its own, for comparison with log_throughput
+    """
+    chunks = synthetic_log(lines, line_length)
+    stream = io.StringIO()
+    started = time.time()
+    for chunk in chunks:
+        stream.write(chunk.strip().decode('utf-8'))
+        stream.write(u'\n')
+    seconds = time.time() - started
+    size = sum(len(chunk) for chunk in chunks)
+    return {'lines': lines, 'bytes': size, 'seconds': seconds,
+            'lines_per_second': lines / seconds if seconds else None,
+            'mb_per_second': size / seconds / 1e6 if seconds else None}
+
+
+def bench_logs(lines=200000, line_length=100, chunk_size=None, sinks=('stream',)):
+    """ Seconds to pass a synthetic log through the log pipeline """
+    return log_throughput(lines, line_length, chunk_size, sinks)
+
+
+def bench_logs_legacy(lines=200000, line_length=100, **kwargs):
+    """ The same with the former line by line log printing, for reference """
+    return legacy_log_throughput(lines, line_length)
+
+
+def bench_orchestration(builds=50, log_lines=100, **kwargs):
+    """
+    Seconds of dbuild's own work per build, running builds against a fake
+    docker host which answers instantly
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        client = fakedocker.FakeDockerClient(log_lines=log_lines)
+        args = dict(cache_dir=os.path.join(tmpdir, 'cache'), client=client,
+                    output=six.StringIO())
+        # Warm up the image index, as for any build but the very first
+        dbuild.docker_build(tmpdir, 'source', **args)
+        started = time.time()
+        for _ in range(builds):
+            dbuild.docker_build(tmpdir, 'source', **args)
+        seconds = (time.time() - started) / builds
+    finally:
+        shutil.rmtree(tmpdir)
+    return {'seconds': seconds, 'builds': builds, 'calls': len(client.calls)}
+
+
+def bench_batch(builds=16, workers=4, run_latency=0.05, **kwargs):
+    """
+    Seconds a batch of builds takes beyond the time its containers run,
+    spread over a fake docker host with workers slots
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        client = fakedocker.FakeDockerClient(run_latency=run_latency)
+        hosts = scheduler.HostPool([scheduler.DockerHost('fake://', workers)],
+                                   client_factory=lambda url: client, poll_interval=0.01)
+        build_dirs = []
+        for i in range(builds):
+            build_dirs.append(os.path.join(tmpdir, 'pkg%d' % i))
+            os.makedirs(build_dirs[-1])
+        # batch_build reports on stdout
+        stdout, sys.stdout = sys.stdout, six.StringIO()
+        started = time.time()
+        try:
+            results = batch.batch_build(build_dirs, workers=workers, hosts=hosts, pipeline=True,
+                                        log_dir=os.path.join(tmpdir, 'logs'),
+                                        cache_dir=os.path.join(tmpdir, 'cache'))
+        finally:
+            wall = time.time() - started
+            sys.stdout = stdout
+    finally:
+        shutil.rmtree(tmpdir)
+    ideal = -(-builds // workers) * run_latency
+    return {'seconds': wall - ideal, 'wall': wall, 'ideal': ideal,
+            'failed': len([r for r in results if not r.success])}
+
+
+def bench_cache_hit(files=500, hits=20, **kwargs):
+    """
+    Seconds per build restored from the result cache, for a source tree of
+    files files
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        build_dir = os.path.join(tmpdir, 'pkg')
+        source = os.path.join(build_dir, 'source')
+        os.makedirs(source)
+        for i in range(files):
+            with open(os.path.join(source, 'file%d.c' % i), 'wb') as fp:
+                fp.write(b'int x;\n' * 100)
+        client = fakedocker.FakeDockerClient(artifacts=['pkg_1.0.dsc', 'pkg_1.0_amd64.deb'])
+        args = dict(cache_dir=os.path.join(tmpdir, 'cache'), client=client, pipeline=True,
+                    result_cache=True, output=six.StringIO())
+        dbuild.build_package(build_dir, **args)
+        started = time.time()
+        for _ in range(hits):
+            dbuild.build_package(build_dir, **args)
+        seconds = (time.time() - started) / hits
+    finally:
+        shutil.rmtree(tmpdir)
+    return {'seconds': seconds, 'files': files, 'containers': client.calls.count('start')}
+
+
+# Benchmarks of the suite. Each returns a dict of figures whose 'seconds'
+# entry, lower is better, is what gets compared with the baseline.
+BENCHMARKS = collections.OrderedDict([
+    ('logs', bench_logs),
+    ('logs-legacy', bench_logs_legacy),
+    ('orchestration', bench_orchestration),
+    ('batch', bench_batch),
+    ('cache-hit', bench_cache_hit),
+])
+
+
+def run_suite(names=None, repeat=3, **options):
+    """
+    Run the benchmarks in names, all by default, repeat times each and
+    return the figures of the fastest run of each by name
+    """
+    results = collections.OrderedDict()
+    for name in names or BENCHMARKS:
+        runs = [BENCHMARKS[name](**options) for _ in range(repeat)]
+        results[name] = min(runs, key=lambda figures: figures['seconds'])
+    return results
+
+
+def compare(results, baseline, tolerance=0.25):
+    """
+    Compare results with baseline results. Returns (name, baseline seconds,
+    seconds, regressed) for each benchmark in both, regressed if it got more
+    than tolerance slower.
+    """
+    comparison = []
+    for name, figures in results.items():
+        if name in baseline:
+            before = baseline[name]['seconds']
+            comparison.append((name, before, figures['seconds'],
+                               figures['seconds'] > before * (1 + tolerance)))
+    return comparison
+
+
+def format_figures(name, figures, before=None, regressed=False):
+    line = '%-16s %10.6fs  %s' % (name, figures['seconds'], ' '.join(
+        '%s=%s' % (k, round(v, 6) if isinstance(v, float) else v)
+        for k, v in sorted(figures.items()) if k != 'seconds'))
+    if before is not None:
+        line += '  (baseline %.6fs, %+.0f%%%s)' % (
+            before, (figures['seconds'] / before - 1) * 100 if before else 0,
+            ', REGRESSION' if regressed else '')
+    return line
+
+
+def main(argv):
+    ap = argparse.ArgumentParser(
+        prog='dbuild bench',
+        description='Measure the overhead of dbuild itself against a fake docker '
+                    'host, optionally comparing with a baseline')
+    ap.add_argument('benchmarks', type=str, nargs='*',
+                    help='benchmarks to run, of %s (default: all)' % ', '.join(BENCHMARKS))
+    ap.add_argument('--repeat', type=int, default=3,
+                    help='runs of each benchmark, the fastest counts (default: 3)')
+    ap.add_argument('--baseline', type=str, default=None, metavar='FILE',
+                    help='JSON results of an earlier run to compare with')
+    ap.add_argument('--save-baseline', action='store_true', default=False,
+                    help='Save the results to the --baseline file instead')
+    ap.add_argument('--tolerance', type=float, default=0.25,
+                    help='Slowdown over the baseline reported as a regression '
+                         '(default: 0.25)')
+    ap.add_argument('--lines', type=int, default=200000, help='lines of log to generate')
+    ap.add_argument('--line-length', type=int, default=100, help='length of each line')
+    ap.add_argument('--chunk-size', type=int, default=None, metavar='BYTES',
+                    help='feed the log in chunks of BYTES (default: a chunk per line)')
+    ap.add_argument('--sink', type=str, action='append', default=[],
+                    choices=['null', 'stream', 'file', 'gz', 'zst'],
+                    help='sink to write to, may be given several times (default: stream)')
+    args = ap.parse_args(argv)
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        ap.error('unknown benchmarks: %s' % ', '.join(unknown))
+
+    results = run_suite(args.benchmarks, args.repeat, lines=args.lines,
+                        line_length=args.line_length, chunk_size=args.chunk_size,
+                        sinks=args.sink or ['stream'])
+    if args.save_baseline:
+        if not args.baseline:
+            ap.error('--save-baseline needs --baseline')
+        with open(args.baseline, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+
+    baseline = {}
+    if args.baseline and not args.save_baseline:
+        with open(args.baseline, 'r') as fp:
+            baseline = json.load(fp)
+    comparison = dict((name, (before, regressed))
+                      for name, before, _, regressed in compare(results, baseline, args.tolerance))
+    for name, figures in results.items():
+        print(format_figures(name, figures, *comparison.get(name, (None, False))))
+    return not any(regressed for _, regressed in comparison.values())
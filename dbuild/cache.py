@@ -0,0 +1,291 @@
+import contextlib
+import fcntl
+import fnmatch
+import hashlib
+import json
+import os
+import shutil
+import stat
+import tempfile
+import time
+
+
+def default_cache_dir():
+    """ Return the directory dbuild keeps its local state in """
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'dbuild')
+
+
+class JSONIndex(object):
+    """
+    A small JSON document on disk, shared between concurrent dbuild
+    processes. Readers get a consistent snapshot since the file is always
+    replaced atomically, and writers serialise on a lock file next to it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as fp:
+                return json.load(fp)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _save(self, data):
+        dirname = os.path.dirname(self.path)
+        fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'w') as fp:
+                json.dump(data, fp, sort_keys=True)
+            os.rename(tmp, self.path)
+        except Exception:
+            os.unlink(tmp)
+            raise
+
+    @contextlib.contextmanager
+    def update(self):
+        """ Lock the index and yield its data, saving it on exit """
+        dirname = os.path.dirname(self.path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.lockf(lock, fcntl.LOCK_EX)
+            try:
+                data = self.load()
+                yield data
+                self._save(data)
+            finally:
+                fcntl.lockf(lock, fcntl.LOCK_UN)
+
+
+class ImageIndex(JSONIndex):
+    """
+    Record of the dbuild images known to exist on each docker daemon, so a
+    warm build can skip the docker build step altogether.
+    """
+
+    def __init__(self, path=None):
+        super(ImageIndex, self).__init__(path or os.path.join(default_cache_dir(), 'images.json'))
+
+    def get(self, docker_url, tag):
+        return self.load().get(docker_url, {}).get(tag)
+
+    def __contains__(self, key):
+        return self.get(*key) is not None
+
+    def add(self, docker_url, tag, **info):
+        info['built'] = time.time()
+        with self.update() as data:
+            data.setdefault(docker_url, {})[tag] = info
+
+    def discard(self, docker_url, tag):
+        with self.update() as data:
+            data.get(docker_url, {}).pop(tag, None)
+
+    def touch(self, docker_url, tag):
+        """ Mark an image as used now, for LRU eviction """
+        with self.update() as data:
+            info = data.get(docker_url, {}).get(tag)
+            if info is not None:
+                info['used'] = time.time()
+
+
+def lru_victims(entries, max_size):
+    """
+    Given (key, size, last_used) tuples, return the keys to evict, least
+    recently used first, to bring the total size down to max_size.
+    """
+    total = sum(size for _, size, _ in entries)
+    victims = []
+    for key, size, _ in sorted(entries, key=lambda e: e[2]):
+        if total <= max_size:
+            break
+        victims.append(key)
+        total -= size
+    return victims
+
+
+# Lock file in a shared apt archive cache, which the build containers using
+# it take turns on for copying packages into it
+APT_ARCHIVE_LOCK = '.dbuild-lock'
+
+
+def prune_apt_archive(path, max_size):
+    """
+    Remove the least recently used .deb files from a shared apt archive
+    cache until it fits in max_size bytes. The pass holds the lock build
+    containers take turns on, so it never races with a container which is
+    copying packages in; if that is busy it does nothing. Returns the list
+    of removed files.
+    """
+    try:
+        turns = open(os.path.join(path, APT_ARCHIVE_LOCK), 'a')
+    except (IOError, OSError):
+        return []
+    with turns:
+        try:
+            # flock(1) in the containers
+            fcntl.flock(turns, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            return []
+        entries = []
+        for name in os.listdir(path):
+            if not name.endswith('.deb'):
+                continue
+            st = os.stat(os.path.join(path, name))
+            entries.append((name, st.st_size, max(st.st_atime, st.st_mtime)))
+        removed = []
+        for name in lru_victims(entries, max_size):
+            try:
+                os.unlink(os.path.join(path, name))
+            except OSError:
+                continue
+            removed.append(name)
+        return removed
+
+
+def index_path(cache_dir, name):
+    """ Path of index file name in cache_dir, or in the default cache dir """
+    return os.path.join(cache_dir or default_cache_dir(), name)
+
+
+# Version control directories, which dpkg-buildpackage -I leaves out of the
+# source package
+VCS_DIRS = ('.git', '.svn', '.bzr', '.hg', 'CVS', '_darcs', '.arch-ids', '{arch}')
+
+
+class FingerprintStore(JSONIndex):
+    """
+    Remembers the content hash of every file of the trees it has hashed,
+    along with the file's mtime, ctime, size and inode, so that rehashing a
+    tree only needs to read the files which changed.
+    """
+
+    def tree_digest(self, root, exclude=VCS_DIRS):
+        root = os.path.abspath(root)
+        known = self.load().get(root, {})
+        fingerprints = {}
+        h = hashlib.sha256()
+
+        def add(rel, kind, digest):
+            h.update(('%s\0%s\0%s\0' % (rel, kind, digest)).encode('utf-8'))
+
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = sorted(d for d in dirnames if d not in exclude)
+            names = filenames + [d for d in dirnames if os.path.islink(os.path.join(dirpath, d))]
+            for name in sorted(names):
+                path = os.path.join(dirpath, name)
+                rel = os.path.relpath(path, root)
+                st = os.lstat(path)
+                if stat.S_ISLNK(st.st_mode):
+                    add(rel, 'l', os.readlink(path))
+                    continue
+                fingerprint = [st.st_mtime, st.st_ctime, st.st_size, st.st_ino]
+                entry = known.get(rel)
+                if entry is not None and entry[:4] == fingerprint:
+                    digest = entry[4]
+                else:
+                    digest = file_digest(path)
+                fingerprints[rel] = fingerprint + [digest]
+                add(rel, 'x' if st.st_mode & stat.S_IXUSR else 'f', digest)
+
+        if fingerprints != known:
+            with self.update() as data:
+                data[root] = fingerprints
+        return h.hexdigest()
+
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+# Files a package build leaves in build_dir
+ARTIFACT_PATTERNS = ('*.dsc', '*.tar.*', '*.diff.gz', '*.changes', '*.buildinfo',
+                     '*.deb', '*.udeb', '*.ddeb')
+
+# Upstream tarballs of a non-native source package, which dpkg-source looks
+# for next to the source tree
+ORIG_TARBALL_PATTERNS = ('*.orig.tar.*', '*.orig-*.tar.*')
+
+
+def artifacts_snapshot(build_dir):
+    """ mtime and size of the build artifacts present in build_dir """
+    snapshot = {}
+    for name in os.listdir(build_dir):
+        path = os.path.join(build_dir, name)
+        if os.path.isfile(path) and any(fnmatch.fnmatch(name, p) for p in ARTIFACT_PATTERNS):
+            st = os.stat(path)
+            snapshot[name] = (st.st_mtime, st.st_size)
+    return snapshot
+
+
+class ResultCache(object):
+    """
+    Content addressed store of build artifacts. Each entry is a directory
+    named after its key; index.json records the entries' files, size and
+    last use, and the hit and miss counts. Beyond max_size bytes the least
+    recently used entries are removed.
+    """
+
+    def __init__(self, path, max_size=None):
+        self.path = path
+        self.max_size = max_size
+        self.index = JSONIndex(os.path.join(path, 'index.json'))
+
+    def _entry_dir(self, key):
+        return os.path.join(self.path, key)
+
+    def restore(self, key, build_dir):
+        """
+        Copy the artifacts stored under key into build_dir and return their
+        names, or return None on a cache miss.
+        """
+        with self.index.update() as data:
+            entries = data.setdefault('entries', {})
+            stats = data.setdefault('stats', {'hits': 0, 'misses': 0})
+            entry = entries.get(key)
+            if entry is None or not os.path.isdir(self._entry_dir(key)):
+                entries.pop(key, None)
+                stats['misses'] += 1
+                return None
+            for name in entry['files']:
+                shutil.copy2(os.path.join(self._entry_dir(key), name),
+                             os.path.join(build_dir, name))
+            stats['hits'] += 1
+            entry['used'] = time.time()
+            return entry['files']
+
+    def store(self, key, build_dir, files):
+        """ Store files from build_dir under key """
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        tmp = tempfile.mkdtemp(dir=self.path, prefix='.tmp-')
+        try:
+            size = 0
+            for name in files:
+                shutil.copy2(os.path.join(build_dir, name), tmp)
+                size += os.path.getsize(os.path.join(tmp, name))
+            with self.index.update() as data:
+                entries = data.setdefault('entries', {})
+                if os.path.isdir(self._entry_dir(key)):
+                    shutil.rmtree(self._entry_dir(key))
+                os.rename(tmp, self._entry_dir(key))
+                entries[key] = {'files': sorted(files), 'size': size, 'used': time.time()}
+                if self.max_size is not None:
+                    candidates = [(k, e['size'], e['used']) for k, e in entries.items() if k != key]
+                    for victim in lru_victims(candidates, self.max_size - size):
+                        shutil.rmtree(self._entry_dir(victim), ignore_errors=True)
+                        del entries[victim]
+        finally:
+            if os.path.isdir(tmp):
+                shutil.rmtree(tmp)
+
+    def stats(self):
+        """ Hit and miss counts """
+        return self.index.load().get('stats', {'hits': 0, 'misses': 0})
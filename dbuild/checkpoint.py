@@ -0,0 +1,83 @@
+import time
+
+from docker import errors as docker_errors
+
+import dbuild
+from dbuild import logs
+
+# Build containers print this once the build dependencies are installed
+CHECKPOINT_MARKER = '@@dbuild-checkpoint'
+
+
+def marker_command():
+    """ Shell command prefix announcing that the build dependencies are in """
+    return 'echo %s && ' % CHECKPOINT_MARKER
+
+
+class MarkerSink(logs.LogSink):
+    """ Log sink noticing whether a build got past its dependency install """
+
+    def __init__(self):
+        self.seen = False
+
+    def write(self, text):
+        if CHECKPOINT_MARKER in text:
+            self.seen = True
+
+
+def checkpoint_tag(dist, release, builddeps, sources='', proxy='', ccache=False):
+    """
+    Tag of the checkpoint of builds of dist and release with builddeps and
+    the apt sources whose sources_digest is sources. Builds with the same
+    dependencies share it.
+    """
+    return dbuild.builddep_tag(dbuild.image_tag(dist, release, proxy, ccache), dist, release,
+                               builddeps, sources, kind='checkpoint')
+
+
+def find(docker_client, index, tag, docker_url='unix://var/run/docker.sock', ttl=None):
+    """
+    tag, if that checkpoint exists on the docker host and was used in the
+    last ttl seconds, None otherwise
+    """
+    info = index.get(docker_url, tag)
+    if info is None or (ttl is not None and time.time() - info.get('used', info['built']) > ttl):
+        return None
+    try:
+        docker_client.inspect_image(tag)
+    except docker_errors.NotFound:
+        index.discard(docker_url, tag)
+        return None
+    index.touch(docker_url, tag)
+    return tag
+
+
+def commit(docker_client, container, tag, index, docker_url='unix://var/run/docker.sock'):
+    """ Commit the container of a failed build as checkpoint tag """
+    repository, _, version = tag.rpartition(':')
+    docker_client.commit(container.get('Id'), repository=repository, tag=version)
+    index.add(docker_url, tag)
+
+
+def prune(docker_client, index, keep=5, ttl=None, docker_url='unix://var/run/docker.sock'):
+    """
+    Remove the checkpoints of docker_url last used more than ttl seconds
+    ago, and all but the keep most recently used ones. Returns their tags.
+    """
+    now = time.time()
+    entries = sorted(index.load().get(docker_url, {}).items(),
+                     key=lambda item: item[1].get('used', item[1]['built']), reverse=True)
+    removed = []
+    for i, (tag, info) in enumerate(entries):
+        if i < keep and (ttl is None or now - info.get('used', info['built']) <= ttl):
+            continue
+        try:
+            docker_client.remove_image(tag)
+        except docker_errors.NotFound:
+            pass
+        except docker_errors.APIError:
+            # Still used by a kept container, try again next time
+            continue
+        index.discard(docker_url, tag)
+        removed.append(tag)
+    return removed
@@ -0,0 +1,98 @@
+import glob
+import os
+import re
+
+BUILD_DEPENDS_FIELDS = ('Build-Depends', 'Build-Depends-Indep', 'Build-Depends-Arch')
+
+
+def parse_deb822(text):
+    """
+    Parse deb822 formatted text (debian/control, .dsc) into a list of
+    paragraphs, each a dict of field name to value. Continuation lines are
+    joined with newlines and any PGP armour around a signed .dsc is dropped.
+    """
+    paragraphs = []
+    fields = {}
+    name = None
+    in_armour_header = False
+    in_signature = False
+    for line in text.splitlines():
+        if line.startswith('-----BEGIN PGP SIGNED MESSAGE'):
+            # Armour headers ("Hash: ...") run up to the first blank line
+            in_armour_header = True
+            continue
+        if in_armour_header:
+            in_armour_header = bool(line.strip())
+            continue
+        if line.startswith('-----BEGIN PGP SIGNATURE'):
+            in_signature = True
+        if in_signature:
+            in_signature = not line.startswith('-----END PGP SIGNATURE')
+            continue
+        if line.startswith('#'):
+            continue
+        if not line.strip():
+            if fields:
+                paragraphs.append(fields)
+                fields = {}
+                name = None
+            continue
+        if line[0] in ' \t':
+            if name is not None:
+                fields[name] += '\n' + line.strip()
+            continue
+        name, _, value = line.partition(':')
+        name = name.strip()
+        fields[name] = value.strip()
+    if fields:
+        paragraphs.append(fields)
+    return paragraphs
+
+
+def read_control(path):
+    """ Return the first (source) paragraph of a control or .dsc file """
+    with open(path, 'r') as fp:
+        paragraphs = parse_deb822(fp.read())
+    return paragraphs[0] if paragraphs else {}
+
+
+def normalize_relations(value):
+    """
+    Split a relationship field into a sorted list of unique relations with
+    whitespace collapsed, so that formatting differences don't matter.
+    """
+    relations = set()
+    for relation in value.split(','):
+        relation = ' '.join(relation.split())
+        relation = re.sub(r'\s*\|\s*', ' | ', relation)
+        relation = re.sub(r'\(\s*', '(', relation)
+        relation = re.sub(r'\s*\)', ')', relation)
+        if relation:
+            relations.add(relation)
+    return sorted(relations)
+
+
+def build_depends(fields):
+    """ Normalized build dependencies of a source paragraph """
+    return normalize_relations(','.join(fields.get(f, '') for f in BUILD_DEPENDS_FIELDS))
+
+
+def find_dsc(build_dir):
+    """ Path of the source package in build_dir, or None """
+    dscs = sorted(glob.glob(os.path.join(build_dir, '*.dsc')))
+    return dscs[0] if dscs else None
+
+
+def source_control(build_dir, source_dir='source'):
+    """
+    Source paragraph for the package in build_dir: read from the source
+    package if there is one, otherwise from the unpacked source tree.
+    Returns None if neither exists.
+    """
+    dsc = find_dsc(build_dir)
+    if dsc:
+        return read_control(dsc)
+    control = os.path.join(build_dir, source_dir, 'debian', 'control')
+    if os.path.exists(control):
+        return read_control(control)
+    return None
@@ -29,3 +29,7 @@ class DbuildSourceBuildFailedException(DbuildException):
 
 class DbuildBinaryBuildFailedException(DbuildException):
     pass
+
+
+class DbuildBuildTimeoutException(DbuildException):
+    pass
@@ -0,0 +1,301 @@
+import hashlib
+import io
+import itertools
+import os
+import posixpath
+import tarfile
+import threading
+import time
+
+from docker import errors as docker_errors
+
+
+def _id(container):
+    """ Id of a container given as a dict, as dbuild passes them, or an id """
+    return container.get('Id') if isinstance(container, dict) else container
+
+
+def _error(cls, message):
+    """ A docker.errors exception without an HTTP response behind it """
+    return cls(message, None, explanation=message)
+
+
+class FakeContainer(object):
+    def __init__(self, id, image, command, labels, host_config):
+        self.id = id
+        self.image = image
+        self.command = command
+        self.labels = labels or {}
+        self.host_config = host_config or {}
+        self.binds = self.host_config.get('binds') or []
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.killed = False
+        # Files the build left for fetching with get_archive, by path
+        self.files = {}
+
+
+class FakeDockerClient(object):
+    """
+    In-process stand-in for the docker.Client calls dbuild makes, for tests
+    and benchmarks without a docker host.
+
+    Every call takes latency seconds. docker build takes build_latency
+    seconds and always succeeds; a started container runs for run_latency
+    seconds, during which its log stream produces log_lines lines of
+    line_length characters, in chunks of chunk_size bytes (a chunk per line
+    by default), and then exits with exit_code, or 137 if killed first. On
+    a normal exit it creates the files named in artifacts in the host
+    directory mounted on /build, or, without one, in /dbuild-out for
+    get_archive. The paths of everything put into containers are kept in
+    uploaded.
+
+    Containers running sleep infinity, like pool containers, run until
+    removed. Commands exec'd in them succeed at once, except builds, those
+    running dpkg-buildpackage, which behave like a build container.
+
+    Images are only known once built or committed, so creating a container
+    from anything else raises docker.errors.NotFound like docker does.
+
+    The host has cpus CPUs and memory bytes of memory.
+    """
+
+    def __init__(self, latency=0, build_latency=0, run_latency=0, log_lines=0,
+                 line_length=80, chunk_size=None, exit_code=0, artifacts=(), arch='amd64',
+                 cpus=4, memory=8 << 30):
+        self.latency = latency
+        self.build_latency = build_latency
+        self.run_latency = run_latency
+        self.log_lines = log_lines
+        self.line_length = line_length
+        self.chunk_size = chunk_size
+        self.exit_code = exit_code
+        self.artifacts = artifacts
+        self.arch = arch
+        self.cpus = cpus
+        self.memory = memory
+        self.image_store = {}
+        self.containers_by_id = {}
+        self.calls = []
+        self.uploaded = []
+        self.execs = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _call(self, name):
+        with self._lock:
+            self.calls.append(name)
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _container(self, container):
+        try:
+            return self.containers_by_id[_id(container)]
+        except KeyError:
+            raise _error(docker_errors.NotFound, 'No such container: %s' % _id(container))
+
+    def version(self):
+        self._call('version')
+        return {'Arch': self.arch, 'ApiVersion': '1.21'}
+
+    def info(self):
+        self._call('info')
+        return {'NCPU': self.cpus, 'MemTotal': self.memory}
+
+    def build(self, path=None, tag=None, fileobj=None, custom_context=False, **kwargs):
+        self._call('build')
+        yield {'stream': 'Step 1 : FROM fake\n'}
+        if self.build_latency:
+            time.sleep(self.build_latency)
+        with self._lock:
+            self.image_store[tag] = {'Id': hashlib.sha256(tag.encode('utf-8')).hexdigest(), 'Size': 0}
+        yield {'stream': 'Successfully built %s\n' % self.image_store[tag]['Id'][:12]}
+
+    def inspect_image(self, image):
+        self._call('inspect_image')
+        try:
+            return self.image_store[image]
+        except KeyError:
+            raise _error(docker_errors.NotFound, 'No such image: %s' % image)
+
+    def images(self, **kwargs):
+        self._call('images')
+        with self._lock:
+            return [{'Id': info['Id'], 'RepoTags': [tag], 'Size': info['Size']}
+                    for tag, info in self.image_store.items()]
+
+    def pull(self, repository, tag=None, stream=False, decode=False, **kwargs):
+        self._call('pull')
+        image = '%s:%s' % (repository, tag or 'latest')
+        with self._lock:
+            self.image_store[image] = {'Id': hashlib.sha256(image.encode('utf-8')).hexdigest(),
+                                       'Size': 0}
+        status = [{'status': 'Downloaded newer image for %s' % image}]
+        return iter(status) if stream else status
+
+    def remove_image(self, image, **kwargs):
+        self._call('remove_image')
+        with self._lock:
+            self.image_store.pop(image, None)
+
+    def commit(self, container, repository=None, tag=None, **kwargs):
+        self._call('commit')
+        image = '%s:%s' % (repository, tag) if tag else repository
+        with self._lock:
+            self.image_store[image] = {'Id': 'sha256:%d' % next(self._ids), 'Size': 0}
+        return {'Id': self.image_store[image]['Id']}
+
+    def create_host_config(self, **kwargs):
+        return kwargs
+
+    def create_container(self, image, command=None, labels=None, host_config=None, **kwargs):
+        self._call('create_container')
+        if image not in self.image_store:
+            raise _error(docker_errors.NotFound, 'No such image: %s' % image)
+        container = FakeContainer('%064x' % next(self._ids), image, command, labels, host_config)
+        with self._lock:
+            self.containers_by_id[container.id] = container
+        return {'Id': container.id, 'Warnings': None}
+
+    def start(self, container, **kwargs):
+        self._call('start')
+        c = self._container(container)
+        c.started = time.time()
+        if c.command == ['sleep', 'infinity']:
+            c.finished = float('inf')
+        else:
+            c.finished = c.started + self.run_latency
+
+    def _run(self, c):
+        """ Wait for container c to finish """
+        if c.finished is None:
+            raise _error(docker_errors.APIError, 'Container %s is not running' % c.id)
+        # In short sleeps, so that kill() cuts the run short
+        while c.finished > time.time():
+            time.sleep(min(c.finished - time.time(), 0.01))
+
+    def _exit(self, c):
+        self._run(c)
+        if not c.killed:
+            self._write_artifacts(c)
+
+    def _write_artifacts(self, c):
+        for bind in c.binds:
+            host_path, _, path = bind.partition(':')
+            if path == '/build':
+                for name in self.artifacts:
+                    with open(os.path.join(host_path, name), 'wb') as fp:
+                        fp.write(c.id.encode('utf-8'))
+                return
+        for name in self.artifacts:
+            c.files['/dbuild-out/' + name] = c.id.encode('utf-8')
+
+    def put_archive(self, container, path, data):
+        self._call('put_archive')
+        self._container(container)
+        if not isinstance(data, bytes):
+            data = b''.join(data)
+        with tarfile.open(fileobj=io.BytesIO(data), mode='r:*') as tar:
+            self.uploaded.extend(posixpath.join(path, m.name) for m in tar.getmembers())
+        return True
+
+    def get_archive(self, container, path):
+        """ Like docker, a tar of path named after its basename, as a stream of chunks """
+        self._call('get_archive')
+        c = self._container(container)
+        base = path.rstrip('/')
+        files = sorted((name, data) for name, data in c.files.items()
+                       if name.startswith(base + '/'))
+        if not files and base != '/dbuild-out':
+            raise _error(docker_errors.NotFound, 'No such container:path: %s:%s' % (c.id, path))
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode='w') as tar:
+            for name, data in files:
+                info = tarfile.TarInfo(posixpath.basename(base) + name[len(base):])
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+        data = buf.getvalue()
+        chunks = (data[i:i + 4096] for i in range(0, len(data), 4096))
+        return chunks, {'name': posixpath.basename(base)}
+
+    def _log_chunks(self):
+        line = ('x' * max(self.line_length - 1, 0) + '\n').encode('utf-8')
+        if self.chunk_size:
+            data = line * self.log_lines
+            return (data[i:i + self.chunk_size] for i in range(0, len(data), self.chunk_size))
+        return itertools.repeat(line, self.log_lines)
+
+    def logs(self, container, stream=False, timestamps=False, **kwargs):
+        self._call('logs')
+        c = self._container(container)
+        chunks = self._log_chunks()
+        if not stream:
+            return b''.join(chunks)
+        return self._stream_logs(c, chunks)
+
+    def _stream_logs(self, c, chunks):
+        for chunk in chunks:
+            yield chunk
+        # The stream ends when the container exits
+        self._run(c)
+
+    def wait(self, container, **kwargs):
+        self._call('wait')
+        c = self._container(container)
+        self._exit(c)
+        return 137 if c.killed else self.exit_code
+
+    def kill(self, container, **kwargs):
+        self._call('kill')
+        c = self._container(container)
+        if c.finished is None or c.finished <= time.time():
+            raise _error(docker_errors.APIError, 'Container %s is not running' % c.id)
+        c.killed = True
+        c.finished = time.time()
+
+    def exec_create(self, container, cmd, **kwargs):
+        self._call('exec_create')
+        c = self._container(container)
+        exec_id = '%064x' % next(self._ids)
+        with self._lock:
+            self.execs[exec_id] = {'container': c, 'cmd': cmd, 'exit_code': None}
+        return {'Id': exec_id}
+
+    def exec_start(self, exec_id, stream=False, **kwargs):
+        self._call('exec_start')
+        e = self.execs[_id(exec_id)]
+        chunks = self._exec(e)
+        return chunks if stream else b''.join(chunks)
+
+    def _exec(self, e):
+        if 'dpkg-buildpackage' not in ' '.join(e['cmd']):
+            e['exit_code'] = 0
+            return
+        for chunk in self._log_chunks():
+            yield chunk
+        if self.run_latency:
+            time.sleep(self.run_latency)
+        self._write_artifacts(e['container'])
+        e['exit_code'] = self.exit_code
+
+    def exec_inspect(self, exec_id):
+        self._call('exec_inspect')
+        e = self.execs[_id(exec_id)]
+        return {'ExitCode': e['exit_code'], 'Running': e['exit_code'] is None}
+
+    def remove_container(self, container, force=False, **kwargs):
+        self._call('remove_container')
+        with self._lock:
+            self.containers_by_id.pop(_id(container), None)
+
+    def containers(self, all=False, filters=None, **kwargs):
+        """ Running containers, or all, filtered on label names as dbuild does """
+        self._call('containers')
+        now = time.time()
+        label = (filters or {}).get('label')
+        with self._lock:
+            running = [c for c in self.containers_by_id.values()
+                       if all or (c.started is not None and c.finished > now)]
+        return [{'Id': c.id, 'Image': c.image, 'Labels': c.labels, 'Created': int(c.created)}
+                for c in running if label is None or label in c.labels]
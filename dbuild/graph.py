@@ -0,0 +1,277 @@
+import argparse
+import glob
+import hashlib
+import os
+import shutil
+import threading
+
+from six.moves import queue
+
+import dbuild
+from dbuild import batch
+from dbuild import control
+from dbuild import exceptions
+from dbuild import proxy
+
+# Where the local repository is mounted in build containers
+LOCAL_REPO_PATH = '/dbuild-localrepo'
+
+# Repos file written into the build_dir of packages built against the local
+# repository, relative to build_dir
+GRAPH_REPOS_FILE = 'dbuild-graph-repos'
+
+
+def relation_names(relations):
+    """ Package names mentioned in a list of relations, alternatives included """
+    names = set()
+    for relation in relations:
+        for alternative in relation.split('|'):
+            words = alternative.split()
+            if words:
+                # Drop any architecture qualifier, as in python:any
+                names.add(words[0].split(':')[0])
+    return names
+
+
+class Package(object):
+    """ A source package to build, as described by its debian/control """
+
+    def __init__(self, build_dir, source_dir='source'):
+        self.build_dir = build_dir
+        with open(os.path.join(build_dir, source_dir, 'debian', 'control'), 'r') as fp:
+            paragraphs = control.parse_deb822(fp.read())
+        if not paragraphs:
+            raise exceptions.DbuildException('Empty debian/control in %s' % build_dir)
+        self.source = paragraphs[0].get('Source')
+        self.binaries = set(p['Package'] for p in paragraphs[1:] if 'Package' in p)
+        self.build_depends = relation_names(control.build_depends(paragraphs[0]))
+
+    def __repr__(self):
+        return 'Package(%r)' % self.build_dir
+
+
+def build_graph(packages):
+    """
+    Map each of packages to the set of packages among them whose binaries it
+    build-depends on. Raises DbuildException on dependency cycles.
+    """
+    providers = {}
+    for pkg in packages:
+        for binary in pkg.binaries:
+            providers[binary] = pkg
+    graph = {}
+    for pkg in packages:
+        graph[pkg] = set(providers[name] for name in pkg.build_depends
+                         if name in providers and providers[name] is not pkg)
+    topological_order(graph)
+    return graph
+
+
+def topological_order(graph):
+    """ Packages of graph, each after everything it depends on """
+    remaining = dict((pkg, set(deps)) for pkg, deps in graph.items())
+    order = []
+    while remaining:
+        ready = [pkg for pkg, deps in remaining.items() if not deps]
+        if not ready:
+            raise exceptions.DbuildException(
+                'Build dependency cycle between: %s' % ', '.join(
+                    sorted(pkg.build_dir for pkg in remaining)))
+        for pkg in sorted(ready, key=lambda p: p.build_dir):
+            order.append(pkg)
+            del remaining[pkg]
+        for deps in remaining.values():
+            deps.difference_update(ready)
+    return order
+
+
+class LocalRepo(object):
+    """
+    A flat apt repository in a local directory, fed with the packages built
+    so far. Like build_dir, its path needs to exist on the docker host.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self._lock = threading.Lock()
+
+    def digest(self):
+        """ Hash of the repository index """
+        try:
+            with open(os.path.join(self.path, 'Packages'), 'rb') as fp:
+                return hashlib.sha256(fp.read()).hexdigest()
+        except IOError:
+            return ''
+
+    def publish(self, build_dir, image, docker_url='unix://var/run/docker.sock', client=None):
+        """
+        Copy the binary packages in build_dir into the repository and update
+        its index, using dpkg-scanpackages in a container of image.
+        """
+        c = client or dbuild.docker_client(docker_url)
+        with self._lock:
+            for pattern in ('*.deb', '*.udeb'):
+                for path in glob.glob(os.path.join(build_dir, pattern)):
+                    shutil.copy(path, self.path)
+
+            command = ('cd %s && dpkg-scanpackages . /dev/null > Packages.tmp && '
+                       'mv Packages.tmp Packages' % LOCAL_REPO_PATH)
+            container = dbuild.create_container(c, image, command=['bash', '-c', command],
+                                                shared_volumes={self.path: LOCAL_REPO_PATH},
+                                                labels=dbuild.container_labels('localrepo'))
+            dbuild.start_container(c, container)
+            rv = dbuild.wait_container(c, container)
+            dbuild.remove_container(c, container, force=True)
+            if rv != 0:
+                raise exceptions.DbuildException('Updating the local repository index FAILED')
+
+    def write_repos_file(self, build_dir, extra_repos_file='repos'):
+        """
+        Write a repos file into build_dir with the contents of its
+        extra_repos_file plus the local repository, and return its name.
+        The index digest in it makes cached apt and build dependency images
+        keyed on the repos file follow the repository contents.
+        """
+        path = os.path.join(build_dir, extra_repos_file)
+        repos = b''
+        if os.path.exists(path):
+            with open(path, 'rb') as fp:
+                repos = fp.read().rstrip(b'\n') + b'\n'
+        with open(os.path.join(build_dir, GRAPH_REPOS_FILE), 'wb') as fp:
+            fp.write(repos)
+            fp.write(('# dbuild local repository, index %s\n'
+                      'deb [trusted=yes] file:%s ./\n' % (self.digest(), LOCAL_REPO_PATH)).encode('utf-8'))
+        return GRAPH_REPOS_FILE
+
+
+def graph_build(build_dirs, repo_dir, workers=None, log_dir=None, hosts=None,
+                source_dir='source', **build_args):
+    """
+    Build the packages in build_dirs in the order of their build
+    dependencies on each other, running independent packages concurrently.
+    Each finished package is published into the local repository repo_dir,
+    which the builds of packages depending on it get as an extra repo.
+    Packages depending on a failed build are not built.
+
+    Arguments are as for batch.batch_build. Returns a list of
+    batch.BuildResult, in the order of build_dirs.
+    """
+    packages = [Package(build_dir, source_dir) for build_dir in build_dirs]
+    graph = build_graph(packages)
+    repo = LocalRepo(repo_dir)
+
+    if log_dir is not None and not os.path.isdir(log_dir):
+        os.makedirs(log_dir)
+    results = dict((pkg, batch.BuildResult(pkg.build_dir, batch.log_path(log_dir, i, pkg.build_dir)))
+                   for i, pkg in enumerate(packages))
+    if not packages:
+        return []
+
+    if hosts is not None:
+        build_args.pop('docker_url', None)
+        build_args.pop('client', None)
+    if workers is None:
+        workers = hosts.slots if hosts is not None else 1
+    build_args = batch.share_resources(
+        batch.prepare_shared_image(dict(build_args, source_dir=source_dir), hosts), workers, hosts)
+    image = dbuild.image_tag(build_args.get('dist', 'ubuntu'), build_args.get('release', 'trusty'),
+                             build_args.get('proxy', ''), bool(build_args.get('ccache_dir')))
+
+    dependents = dict((pkg, set()) for pkg in packages)
+    for pkg, deps in graph.items():
+        for dep in deps:
+            dependents[dep].add(pkg)
+    waiting = dict((pkg, set(deps)) for pkg, deps in graph.items())
+    unfinished = set(packages)
+    ready = queue.Queue()
+    lock = threading.Lock()
+
+    def job_args(pkg):
+        if not graph[pkg]:
+            return build_args
+        # The apt layer is made by docker build, where the local repository
+        # can't be mounted, so these builds update apt themselves.
+        args = dict(build_args, apt_layer_ttl=None,
+                    extra_volumes={repo.path: LOCAL_REPO_PATH})
+        args['extra_repos_file'] = repo.write_repos_file(
+            pkg.build_dir, build_args.get('extra_repos_file', 'repos'))
+        return args
+
+    def finish(pkg):
+        # Called with lock held
+        unfinished.discard(pkg)
+        for dependent in dependents[pkg]:
+            if dependent not in unfinished:
+                continue
+            if results[pkg].success:
+                waiting[dependent].discard(pkg)
+                if not waiting[dependent]:
+                    ready.put(dependent)
+            else:
+                result = results[dependent]
+                result.success = False
+                result.error = 'Not built, build dependency %s failed' % pkg.build_dir
+                finish(dependent)
+        if not unfinished:
+            for _ in range(workers):
+                ready.put(None)
+
+    def worker():
+        while True:
+            pkg = ready.get()
+            if pkg is None:
+                return
+            result = results[pkg]
+            try:
+                args = job_args(pkg)
+            except Exception as e:
+                # Such as the repos file not being writable; the package
+                # still has to finish, or its dependents wait forever
+                result.success = False
+                result.error = 'Preparing the build failed: %s: %s' % (type(e).__name__, e)
+            else:
+                batch.run_job(result, args, hosts)
+            if result.success:
+                try:
+                    if hosts is not None:
+                        hosts.run(repo.publish, pkg.build_dir, image)
+                    else:
+                        repo.publish(pkg.build_dir, image,
+                                     docker_url=build_args.get('docker_url',
+                                                               'unix://var/run/docker.sock'))
+                except Exception as e:
+                    result.success = False
+                    result.error = 'Publishing to the local repository failed: %s' % e
+            with lock:
+                print('%s %s (%.1fs, log: %s)' % ('OK    ' if result.success else 'FAILED',
+                                                  result.build_dir, result.duration or 0,
+                                                  result.log_file))
+                finish(pkg)
+
+    for pkg in packages:
+        if not graph[pkg]:
+            ready.put(pkg)
+    threads = [threading.Thread(target=worker) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return [results[pkg] for pkg in packages]
+
+
+def main(argv):
+    ap = argparse.ArgumentParser(
+        prog='dbuild graph',
+        description='Build a set of debian packages in the order of their build '
+                    'dependencies on each other, feeding each build the '
+                    'packages built before it through a local repository')
+    ap.add_argument('--repo-dir', type=str, required=True,
+                    help='Directory for the local repository of built packages')
+    batch.add_batch_arguments(ap)
+    args = ap.parse_args(argv)
+
+    with proxy.from_args(batch.batch_arguments(args), args) as build_args:
+        results = graph_build(args.build_dirs, args.repo_dir, **build_args)
+    return batch.report(results, args.results)
@@ -0,0 +1,205 @@
+import codecs
+import collections
+import gzip
+import io
+import sys
+import threading
+
+import six
+
+from dbuild import exceptions
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class LogSink(object):
+    """
+    Destination for build log text. write() is always given whole lines,
+    and is only ever called from the dispatcher thread of a LogPipeline.
+    """
+
+    def write(self, text):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class NullSink(LogSink):
+    """ Discards the log """
+
+    def write(self, text):
+        pass
+
+
+class StreamSink(LogSink):
+    """
+    Writes to a text stream, stdout by default, flushing after every batch
+    of lines so that a terminal follows the build. The stream is not closed.
+    """
+
+    def __init__(self, stream=None):
+        if stream is None:
+            stream = sys.stdout
+            if six.PY2:
+                stream = codecs.getwriter('utf-8')(stream)
+        self.stream = stream
+
+    def write(self, text):
+        self.stream.write(text)
+        self.stream.flush()
+
+
+class FileSink(LogSink):
+    """ Appends to a plain log file through a large write buffer """
+
+    def __init__(self, path, buffer_size=1 << 16):
+        self.path = path
+        self._fp = io.open(path, 'ab', buffering=buffer_size)
+
+    def write(self, text):
+        self._fp.write(text.encode('utf-8'))
+
+    def close(self):
+        self._fp.close()
+
+
+class GzipSink(FileSink):
+    """ Appends a gzip member with the log to path """
+
+    def __init__(self, path, level=6):
+        self.path = path
+        self._fp = gzip.open(path, 'ab', level)
+
+
+class ZstdSink(FileSink):
+    """ Appends a zstd frame with the log to path, needs the zstandard module """
+
+    def __init__(self, path, level=3):
+        if zstandard is None:
+            raise exceptions.DbuildException(
+                'The zstandard module is needed to write %s' % path)
+        self.path = path
+        self._raw = open(path, 'ab')
+        self._fp = zstandard.ZstdCompressor(level=level).stream_writer(self._raw)
+
+    def close(self):
+        self._fp.close()
+        if not self._raw.closed:
+            self._raw.close()
+
+
+def file_sink(path):
+    """ Sink for log file path, compressed if it ends in .gz or .zst """
+    if path.endswith('.gz'):
+        return GzipSink(path)
+    if path.endswith('.zst'):
+        return ZstdSink(path)
+    return FileSink(path)
+
+
+class LogPipeline(object):
+    """
+    Turns the raw chunks of a container's output stream into lines of text
+    for a set of sinks.
+
+    Reading the stream only queues each chunk. A separate thread takes
+    everything queued whenever flush_size bytes have come in, and at least
+    every flush_interval seconds otherwise, cuts it after the last complete
+    line, decodes that in one go and hands it to every sink as one block.
+    Splitting at newline bytes is safe for UTF-8, so characters and lines
+    split across chunks come out whole. A slow sink never holds up the
+    reader.
+
+    Use as a context manager, or call start() and close(). Errors raised by
+    a sink are raised again from close().
+    """
+
+    def __init__(self, sinks, flush_size=1 << 16, flush_interval=0.1):
+        self.sinks = list(sinks)
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.lines = 0
+        self.bytes = 0
+        self._chunks = collections.deque()
+        self._unflushed = 0
+        self._partial = b''
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._thread = None
+        self._failed = []
+        self._error = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._dispatch)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def feed(self, chunk):
+        """ Add a chunk of bytes read from the container """
+        # deque.append is atomic, no lock needed against the dispatcher
+        self._chunks.append(chunk)
+        self._unflushed += len(chunk)
+        if self._unflushed >= self.flush_size:
+            self.bytes += self._unflushed
+            self._unflushed = 0
+            self._wakeup.set()
+
+    def close(self):
+        """ Pass on the rest of the log and wait for the sinks """
+        self.bytes += self._unflushed
+        self._unflushed = 0
+        self._closed = True
+        self._wakeup.set()
+        self._thread.join()
+        for sink in self.sinks:
+            sink.close()
+        if self._error is not None:
+            raise self._error
+
+    def _dispatch(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            # Read before draining, so nothing fed before close() is missed
+            closed = self._closed
+            chunks = [self._partial]
+            try:
+                while True:
+                    chunks.append(self._chunks.popleft())
+            except IndexError:
+                pass
+            data = b''.join(chunks)
+            if closed:
+                if data and not data.endswith(b'\n'):
+                    data += b'\n'
+                end = len(data)
+            else:
+                end = data.rfind(b'\n') + 1
+            self._partial = data[end:]
+            if end:
+                self.lines += data.count(b'\n', 0, end)
+                self._write(data[:end].decode('utf-8', 'replace'))
+            if closed:
+                return
+
+    def _write(self, text):
+        for sink in self.sinks:
+            if sink in self._failed:
+                continue
+            try:
+                sink.write(text)
+            except Exception as e:
+                # Keep feeding the other sinks, report it on close
+                self._failed.append(sink)
+                self._error = self._error or e
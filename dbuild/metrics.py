@@ -0,0 +1,135 @@
+import contextlib
+import json
+import os
+import re
+import tempfile
+import time
+
+from dbuild import cache
+from dbuild import logs
+
+# Build containers print this, a phase name and the time when they enter a
+# phase of the build
+PHASE_MARKER = '@@dbuild-phase'
+PHASE_RE = re.compile(r'%s (\S+) (\d+(?:\.\d+)?)' % PHASE_MARKER)
+
+
+def phase_marker(name):
+    """ Shell command prefix announcing that the build enters phase name """
+    return 'echo "%s %s $(date +%%s.%%N)" && ' % (PHASE_MARKER, name)
+
+
+def exit_marker():
+    """ Shell command prefix which marks the end of the last phase on exit """
+    return "trap 'echo \"%s end $(date +%%s.%%N)\"' EXIT; " % PHASE_MARKER
+
+
+class PhaseTimer(object):
+    """ Durations of the phases of a build, in the order they finished """
+
+    def __init__(self):
+        self.phases = []
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, started, time.time())
+
+    def add(self, name, started, finished, where='host'):
+        self.phases.append({'name': name, 'where': where, 'started': started,
+                            'finished': finished, 'duration': finished - started})
+
+
+@contextlib.contextmanager
+def timed(timer, name):
+    """ timer.phase(name), or nothing if timer is None """
+    if timer is None:
+        yield
+    else:
+        with timer.phase(name):
+            yield
+
+
+class PhaseSink(logs.LogSink):
+    """
+    Log sink picking up the phase markers printed by a build container.
+    Times come from the container's clock, so only their differences mean
+    anything.
+    """
+
+    def __init__(self):
+        self.marks = []
+
+    def write(self, text):
+        if PHASE_MARKER in text:
+            self.marks.extend((m.group(1), float(m.group(2))) for m in PHASE_RE.finditer(text))
+
+    def add_phases(self, timer):
+        """ Add the phases seen to timer, each lasting up to the next mark """
+        for (name, started), (_, finished) in zip(self.marks, self.marks[1:]):
+            if name != 'end':
+                timer.add(name, started, finished, where='container')
+
+
+def write_record(path, record):
+    """ Atomically write a JSON metrics record to path """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.tmp-')
+    with os.fdopen(fd, 'w') as fp:
+        json.dump(record, fp, indent=2, sort_keys=True)
+    os.rename(tmp, path)
+
+
+def _labels(**labels):
+    return ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                    for k, v in sorted(labels.items()))
+
+
+def render_textfile(totals):
+    """ Prometheus text exposition of accumulated build metrics """
+    lines = ['# HELP dbuild_builds_total Builds run, by build type and result',
+             '# TYPE dbuild_builds_total counter']
+    for key, count in sorted(totals.get('builds', {}).items()):
+        build_type, result = key.split('/')
+        lines.append('dbuild_builds_total{%s} %d' % (_labels(build_type=build_type, result=result),
+                                                     count))
+    lines += ['# HELP dbuild_phase_seconds_total Time spent in each build phase',
+              '# TYPE dbuild_phase_seconds_total counter']
+    for key, seconds in sorted(totals.get('seconds', {}).items()):
+        build_type, phase = key.split('/')
+        lines.append('dbuild_phase_seconds_total{%s} %f' % (_labels(build_type=build_type, phase=phase),
+                                                            seconds))
+    lines += ['# HELP dbuild_phase_runs_total Times each build phase was run',
+              '# TYPE dbuild_phase_runs_total counter']
+    for key, count in sorted(totals.get('runs', {}).items()):
+        build_type, phase = key.split('/')
+        lines.append('dbuild_phase_runs_total{%s} %d' % (_labels(build_type=build_type, phase=phase),
+                                                         count))
+    return '\n'.join(lines) + '\n'
+
+
+def update_textfile(path, record, cache_dir=None):
+    """
+    Add record to the totals kept for the Prometheus textfile path under
+    cache_dir, and rewrite the textfile from them. Concurrent builds
+    serialise on the totals' lock, so none of them gets lost.
+    """
+    path = os.path.abspath(path)
+    index = cache.JSONIndex(cache.index_path(cache_dir, 'metrics.json'))
+    with index.update() as data:
+        totals = data.setdefault(path, {})
+        builds = totals.setdefault('builds', {})
+        key = '%s/%s' % (record['build_type'], 'success' if record['success'] else 'failure')
+        builds[key] = builds.get(key, 0) + 1
+        seconds = totals.setdefault('seconds', {})
+        runs = totals.setdefault('runs', {})
+        for phase in record['phases']:
+            key = '%s/%s' % (record['build_type'], phase['name'])
+            seconds[key] = seconds.get(key, 0) + phase['duration']
+            runs[key] = runs.get(key, 0) + 1
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        with os.fdopen(fd, 'w') as fp:
+            fp.write(render_textfile(totals))
+        os.rename(tmp, path)
@@ -0,0 +1,205 @@
+from __future__ import print_function
+
+import threading
+import time
+
+import dbuild
+from dbuild import exceptions
+from dbuild import logs
+
+# Run by idle pool containers until they are handed a build
+IDLE_COMMAND = ['sleep', 'infinity']
+
+# Run in each new pool container before it counts as ready
+WARM_COMMAND = ('export DEBIAN_FRONTEND=noninteractive; '
+                'apt-get -y update && apt-get -y dist-upgrade')
+
+
+def build_volumes(build_args):
+    """
+    Host paths which the build containers of build_args, docker_build
+    arguments, mount besides the build directory, to their path in the
+    container: the shared_volumes a pool for those builds needs
+    """
+    volumes = dict(build_args.get('extra_volumes') or {})
+    if build_args.get('apt_archive_cache'):
+        volumes[build_args['apt_archive_cache']] = dbuild.APT_ARCHIVE_DIR
+    return volumes
+
+
+class PooledContainer(object):
+    """ A started pool container, and how old it is """
+
+    def __init__(self, container, image):
+        self.container = container
+        self.image = image
+        self.created = time.time()
+
+    def expired(self, max_age):
+        return time.time() - self.created >= max_age
+
+
+class ContainerPool(object):
+    """
+    Keeps size started, idle containers per image, with fresh apt indexes,
+    waiting to run builds with docker exec. A build skips creating and
+    starting its container and, when it uses the default apt sources,
+    updating them.
+
+    Idle containers run sleep and are labelled like any dbuild container.
+    Each image gets containers once a build asked for it, or warm() was
+    called for it. Containers handed out are replaced in the background.
+    Each runs one build only, since a build leaves its dependencies and apt
+    sources installed, and idle ones are retired max_age seconds after they
+    were created.
+
+    The containers can't bind mount a build directory they were created
+    before, so builds using a pool go through the archive transport, and
+    only get the pool's shared_volumes.
+    """
+
+    def __init__(self, client, size=2, max_age=3600, shared_volumes=None, output=None):
+        self.client = client
+        self.size = size
+        self.max_age = max_age
+        self.shared_volumes = dict(shared_volumes or {})
+        self.output = output
+        self._idle = {}
+        self._pending = {}
+        self._errors = {}
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def serves(self, build_args):
+        """
+        Whether builds with build_args can run in the pool's containers.
+        Those with a tmpfs scratch workspace, or a ccache cache, which is
+        per package, need containers of their own.
+        """
+        if build_args.get('scratch') == 'tmpfs' or build_args.get('ccache_dir'):
+            return False
+        return all(self.shared_volumes.get(path) == target
+                   for path, target in build_volumes(build_args).items())
+
+    def warm(self, image):
+        """ Start filling the pool for image """
+        with self._lock:
+            self._idle.setdefault(image, [])
+        self._fill(image)
+
+    def acquire(self, image):
+        """
+        A ready container of image, from the pool or, if it is empty, made
+        right away. The pool is topped up in the background.
+        """
+        expired = []
+        pooled = None
+        with self._lock:
+            idle = self._idle.setdefault(image, [])
+            while idle and pooled is None:
+                candidate = idle.pop(0)
+                if candidate.expired(self.max_age):
+                    expired.append(candidate)
+                else:
+                    pooled = candidate
+        for candidate in expired:
+            self._remove(candidate)
+        if pooled is None:
+            pooled = self._spawn(image)
+            with self._lock:
+                self._errors.pop(image, None)
+        self._fill(image)
+        return pooled
+
+    def release(self, pooled, keep=False):
+        """
+        Hand back a container after a build. It is removed, unless keep is
+        True, as for the container of a failed build kept for inspection.
+        """
+        if keep:
+            return
+        self._remove(pooled)
+        self._fill(pooled.image)
+
+    def run(self, pooled, command, cwd='/', sinks=()):
+        """
+        Run command in the pooled container, passing its output to the log
+        sinks, and return its exit code
+        """
+        sinks = list(sinks) or [logs.NullSink()]
+        exec_id = self.client.exec_create(pooled.container,
+                                          ['bash', '-c', 'cd %s && %s' % (cwd, command)])
+        with logs.LogPipeline(sinks) as pipeline:
+            for chunk in self.client.exec_start(exec_id, stream=True):
+                pipeline.feed(chunk)
+        return self.client.exec_inspect(exec_id).get('ExitCode')
+
+    def idle(self, image=None):
+        """ Number of idle containers, of image or in total """
+        with self._lock:
+            if image is not None:
+                return len(self._idle.get(image, ()))
+            return sum(len(idle) for idle in self._idle.values())
+
+    def close(self):
+        """ Remove the idle containers and stop refilling """
+        with self._lock:
+            self._closed = True
+            idle = [pooled for pooled_list in self._idle.values() for pooled in pooled_list]
+            self._idle.clear()
+        for pooled in idle:
+            self._remove(pooled)
+
+    def _spawn(self, image):
+        container = dbuild.create_container(self.client, image, command=IDLE_COMMAND,
+                                            shared_volumes=self.shared_volumes or None,
+                                            labels=dbuild.container_labels('pool'))
+        pooled = PooledContainer(container, image)
+        try:
+            dbuild.start_container(self.client, container)
+            rv = self.run(pooled, WARM_COMMAND)
+        except Exception:
+            self._remove(pooled)
+            raise
+        if rv != 0:
+            self._remove(pooled)
+            raise exceptions.DbuildException(
+                'Preparing a pool container of %s failed with exit code %s' % (image, rv))
+        return pooled
+
+    def _fill(self, image):
+        """ Start making containers until image has size of them, ready or pending """
+        with self._lock:
+            if self._closed or image in self._errors:
+                return
+            missing = (self.size - len(self._idle.get(image, ())) -
+                       self._pending.get(image, 0))
+            self._pending[image] = self._pending.get(image, 0) + max(missing, 0)
+        for _ in range(missing):
+            thread = threading.Thread(target=self._add, args=(image,))
+            thread.daemon = True
+            thread.start()
+
+    def _add(self, image):
+        pooled = None
+        try:
+            pooled = self._spawn(image)
+        except Exception as e:
+            print('Pool container for %s failed: %s' % (image, e), file=self.output)
+            with self._lock:
+                # Builds still get containers made on demand, and retry
+                self._errors[image] = e
+        with self._lock:
+            self._pending[image] -= 1
+            if pooled is not None and not self._closed:
+                self._idle.setdefault(image, []).append(pooled)
+                pooled = None
+        if pooled is not None:
+            self._remove(pooled)
+
+    def _remove(self, pooled):
+        try:
+            dbuild.remove_container(self.client, pooled.container, force=True)
+        except Exception as e:
+            print('Removing pool container %s failed: %s' % (pooled.container.get('Id'), e),
+                  file=self.output)
@@ -0,0 +1,289 @@
+from __future__ import print_function
+
+import contextlib
+import hashlib
+import os
+import posixpath
+import select
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+from six.moves import BaseHTTPServer
+from six.moves import socketserver
+from six.moves.urllib import error as urllib_error
+from six.moves.urllib import request as urllib_request
+from six.moves.urllib.parse import urlparse
+
+import dbuild
+from dbuild import cache
+from dbuild import exceptions
+
+# Where apt-cacher-ng listens too, so firewall rules for it carry over
+DEFAULT_PORT = 3142
+
+# Files which never change under their URL, and apt indexes, which do
+IMMUTABLE_PATTERNS = ('/pool/', '/by-hash/')
+IMMUTABLE_SUFFIXES = ('.deb', '.udeb', '.dsc', '.diff.gz')
+INDEX_NAMES = ('Release', 'InRelease', 'Release.gpg')
+INDEX_PREFIXES = ('Packages', 'Sources', 'Translation-', 'Contents-')
+
+
+class AptCache(object):
+    """
+    Files fetched through the proxy, on disk under path, at most max_size
+    bytes of them. The least recently used go first when that is exceeded.
+
+    fetch() gets a URL from the cache or upstream. Concurrent fetches of a
+    URL which isn't cached are coalesced: one of them downloads it, the
+    others wait for it and are then served from the cache.
+    """
+
+    def __init__(self, path, max_size=10 << 30, index_ttl=60, opener=None):
+        self.path = path
+        self.max_size = max_size
+        self.index_ttl = index_ttl
+        self.opener = opener or urllib_request.build_opener(urllib_request.ProxyHandler({}))
+        self.hits = self.misses = 0
+        self._entries = {}
+        self._inflight = {}
+        self._lock = threading.Lock()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for name in os.listdir(path):
+            if not name.startswith('.'):
+                st = os.stat(os.path.join(path, name))
+                self._entries[name] = [st.st_size, st.st_atime, st.st_mtime]
+
+    def max_age(self, url):
+        """ How long url may be served from the cache, None if it mustn't be """
+        path = urlparse(url).path
+        name = posixpath.basename(path)
+        if (any(p in path for p in IMMUTABLE_PATTERNS) or path.endswith(IMMUTABLE_SUFFIXES) or
+                '.tar.' in name):
+            return float('inf')
+        if name in INDEX_NAMES or name.startswith(INDEX_PREFIXES):
+            return self.index_ttl
+        return None
+
+    def _key(self, url):
+        return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+    def _fresh(self, key, max_age):
+        entry = self._entries.get(key)
+        return entry is not None and time.time() - entry[2] <= max_age
+
+    def fetch(self, url, max_age):
+        """
+        Path of the cached copy of url, fetched upstream if it isn't cached
+        or is older than max_age seconds. Raises urllib's HTTPError for
+        upstream errors, which are not cached.
+        """
+        key = self._key(url)
+        while True:
+            with self._lock:
+                if self._fresh(key, max_age):
+                    self.hits += 1
+                    self._entries[key][1] = time.time()
+                    return os.path.join(self.path, key)
+                waiting = self._inflight.get(key)
+                if waiting is None:
+                    self._inflight[key] = threading.Event()
+            if waiting is None:
+                break
+            # Someone else is downloading it, then look again
+            waiting.wait()
+
+        try:
+            self._download(url, key)
+        finally:
+            with self._lock:
+                self._inflight.pop(key).set()
+        self._evict(keep=key)
+        return os.path.join(self.path, key)
+
+    def _download(self, url, key):
+        response = self.opener.open(url, timeout=60)
+        fd, tmp = tempfile.mkstemp(dir=self.path, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                shutil.copyfileobj(response, fp, 1 << 16)
+            os.rename(tmp, os.path.join(self.path, key))
+        except Exception:
+            os.unlink(tmp)
+            raise
+        finally:
+            response.close()
+        now = time.time()
+        with self._lock:
+            self.misses += 1
+            self._entries[key] = [os.path.getsize(os.path.join(self.path, key)), now, now]
+
+    def _evict(self, keep=None):
+        """ Remove the least recently used files beyond max_size, but not keep """
+        with self._lock:
+            victims = cache.lru_victims([(key, entry[0], entry[1])
+                                         for key, entry in self._entries.items()
+                                         if key != keep and key not in self._inflight],
+                                        self.max_size - self._entries[keep][0])
+            for key in victims:
+                del self._entries[key]
+        for key in victims:
+            try:
+                os.unlink(os.path.join(self.path, key))
+            except OSError:
+                pass
+
+    def size(self):
+        with self._lock:
+            return sum(entry[0] for entry in self._entries.values())
+
+
+class ProxyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    HTTP proxy requests from apt: cacheable files are served through the
+    AptCache, anything else is passed through, and CONNECT, for https
+    sources, is tunnelled as is.
+    """
+
+    protocol_version = 'HTTP/1.0'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        url = self.path
+        if not url.startswith('http://'):
+            return self.send_error(400, 'Not a proxy request: %s' % url)
+        apt_cache = self.server.cache
+        max_age = apt_cache.max_age(url)
+        try:
+            if max_age is None:
+                response = apt_cache.opener.open(url, timeout=60)
+                try:
+                    self._send(response, response.info().get('Content-Length'))
+                finally:
+                    response.close()
+                return
+            path = apt_cache.fetch(url, max_age)
+        except urllib_error.HTTPError as e:
+            return self.send_error(e.code, str(e.reason))
+        except (urllib_error.URLError, socket.error) as e:
+            return self.send_error(502, 'Fetching %s failed: %s' % (url, e))
+        with open(path, 'rb') as fp:
+            self._send(fp, os.fstat(fp.fileno()).st_size)
+
+    def _send(self, fp, length):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        if length is not None:
+            self.send_header('Content-Length', str(length))
+        self.end_headers()
+        shutil.copyfileobj(fp, self.wfile, 1 << 16)
+
+    def do_CONNECT(self):
+        host, _, port = self.path.rpartition(':')
+        try:
+            upstream = socket.create_connection((host, int(port)), timeout=60)
+        except (ValueError, socket.error) as e:
+            return self.send_error(502, 'Connecting to %s failed: %s' % (self.path, e))
+        self.send_response(200, 'Connection established')
+        self.end_headers()
+        self.wfile.flush()
+        sockets = [self.connection, upstream]
+        try:
+            while True:
+                readable, _, _ = select.select(sockets, [], [], 60)
+                if not readable:
+                    return
+                for sock in readable:
+                    data = sock.recv(1 << 16)
+                    if not data:
+                        return
+                    (upstream if sock is self.connection else self.connection).sendall(data)
+        finally:
+            upstream.close()
+
+
+class ProxyServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class AptProxy(object):
+    """
+    A caching apt proxy for build containers, run in threads of this
+    process. Upstream requests go through upstream, an http proxy URL, if
+    given.
+    """
+
+    def __init__(self, path, max_size=10 << 30, port=DEFAULT_PORT, upstream=None,
+                 index_ttl=60):
+        handlers = {'http': upstream} if upstream else {}
+        self.cache = AptCache(path, max_size, index_ttl,
+                              urllib_request.build_opener(urllib_request.ProxyHandler(handlers)))
+        self.port = port
+        self.server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://%s:%d' % (host, port)
+
+    def start(self, host='127.0.0.1'):
+        """ Listen on host, and the port, or any port if it is 0 """
+        self.server = ProxyServer((host, self.port), ProxyHandler)
+        self.server.cache = self.cache
+        self._thread = threading.Thread(target=self.server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self._thread.join()
+
+
+def bridge_gateway(docker_client):
+    """ Address of this host on the default docker bridge network """
+    for config in docker_client.inspect_network('bridge').get('IPAM', {}).get('Config') or []:
+        if config.get('Gateway'):
+            return config['Gateway'].split('/')[0]
+    raise exceptions.DbuildException('The docker bridge network has no gateway')
+
+
+@contextlib.contextmanager
+def managed_proxy(build_args, path, max_size=10 << 30, port=DEFAULT_PORT, client=None):
+    """
+    Run an AptProxy caching in path for the builds of build_args, and yield
+    build_args with their proxy pointed at it. The proxy listens on the
+    docker bridge, so the docker host must be this one; a proxy in
+    build_args becomes the proxy's upstream.
+    """
+    docker_url = build_args.get('docker_url', 'unix://var/run/docker.sock')
+    if not docker_url.startswith('unix://'):
+        raise exceptions.DbuildException(
+            'The apt proxy needs the docker host to be local, not %s' % docker_url)
+    client = client or build_args.get('client') or dbuild.docker_client(docker_url)
+    proxy = AptProxy(path, max_size, port, upstream=build_args.get('proxy') or None)
+    proxy.start(bridge_gateway(client))
+    try:
+        yield dict(build_args, proxy=proxy.url)
+    finally:
+        proxy.stop()
+        print('apt proxy: %d hits, %d misses, %d bytes cached' % (
+            proxy.cache.hits, proxy.cache.misses, proxy.cache.size()), file=build_args.get('output'))
+
+
+@contextlib.contextmanager
+def from_args(build_args, args):
+    """ managed_proxy for build_args if the --apt-proxy-cache options ask for one """
+    if not args.apt_proxy_cache:
+        yield build_args
+        return
+    with managed_proxy(build_args, args.apt_proxy_cache, args.apt_proxy_cache_size,
+                       args.apt_proxy_port) as build_args:
+        yield build_args
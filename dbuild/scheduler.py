@@ -0,0 +1,302 @@
+import threading
+import time
+
+from requests.exceptions import ConnectionError, Timeout
+
+import dbuild
+from dbuild import exceptions
+
+# Labels recording what a build container was allocated, so that dbuild
+# processes sharing a docker host account for each other's builds
+CPUS_LABEL = 'dbuild.cpus'
+CPUSET_LABEL = 'dbuild.cpuset'
+MEMORY_LABEL = 'dbuild.memory'
+
+# Errors which mean a docker host is down, or too slow to count on
+HOST_ERRORS = (ConnectionError, Timeout)
+
+
+class DockerHost(object):
+    """ A docker endpoint which can run up to slots builds at once """
+
+    def __init__(self, url, slots=1):
+        self.url = url
+        self.slots = slots
+        # Builds this scheduler has placed on the host
+        self.assigned = 0
+        self.down_until = 0
+
+    def __repr__(self):
+        return 'DockerHost(%r, slots=%d)' % (self.url, self.slots)
+
+    @classmethod
+    def parse(cls, spec):
+        """ Parse a URL[=SLOTS] host spec """
+        url, _, slots = spec.rpartition('=')
+        if url and slots.isdigit():
+            return cls(url, int(slots))
+        return cls(spec)
+
+
+class HostPool(object):
+    """
+    Places builds on the least loaded of several docker hosts.
+
+    The load of a host is the number of builds this pool has placed on it
+    plus the running dbuild containers started there by other processes,
+    relative to its slots. Builds wait when every host is full. A host whose
+    connection fails or times out is skipped for retry_down seconds and the
+    build is retried elsewhere.
+
+    client_factory is called with a docker url to create the client for a
+    host, dbuild.docker_client by default.
+    """
+
+    def __init__(self, hosts, client_factory=None, retry_down=60, poll_interval=5):
+        self.hosts = list(hosts)
+        self.client_factory = client_factory or dbuild.docker_client
+        self.retry_down = retry_down
+        self.poll_interval = poll_interval
+        self._clients = {}
+        self._cond = threading.Condition()
+
+    @property
+    def slots(self):
+        return sum(host.slots for host in self.hosts)
+
+    def client(self, host):
+        with self._cond:
+            if host.url not in self._clients:
+                self._clients[host.url] = self.client_factory(host.url)
+            return self._clients[host.url]
+
+    def mark_down(self, host):
+        with self._cond:
+            host.down_until = time.time() + self.retry_down
+            self._cond.notify_all()
+
+    def foreign_builds(self, host):
+        """
+        Number of running dbuild containers on host which were not started by
+        this process, None if the host is unreachable.
+        """
+        owner = dbuild.container_labels(None)[dbuild.OWNER_LABEL]
+        try:
+            containers = self.client(host).containers(
+                filters={'label': dbuild.CONTAINER_LABEL, 'status': 'running'})
+        except HOST_ERRORS:
+            self.mark_down(host)
+            return None
+        return len([c for c in containers
+                    if (c.get('Labels') or {}).get(dbuild.OWNER_LABEL) != owner])
+
+    def acquire(self, exclude=()):
+        """ Wait for a free slot and return the least loaded host """
+        if not self.hosts:
+            raise exceptions.DbuildException('No docker hosts to build on')
+        while True:
+            with self._cond:
+                now = time.time()
+                candidates = [h for h in self.hosts if h.down_until <= now and h not in exclude]
+                if not candidates:
+                    candidates = [h for h in self.hosts if h.down_until <= now]
+                if not candidates:
+                    # Everything is down, wait for the first host to come back
+                    self._cond.wait(min(h.down_until for h in self.hosts) - now)
+                    continue
+
+            # Asking the hosts takes a round trip each, without the lock so
+            # that a slow host doesn't hold up every acquire and release
+            foreign = [(host, self.foreign_builds(host)) for host in candidates]
+
+            with self._cond:
+                loads = []
+                for host, builds in foreign:
+                    if builds is None:
+                        continue
+                    load = builds + host.assigned
+                    if load < host.slots:
+                        loads.append((float(load) / host.slots, host))
+                if loads:
+                    host = min(loads, key=lambda load: load[0])[1]
+                    host.assigned += 1
+                    return host
+                self._cond.wait(self.poll_interval)
+
+    def release(self, host):
+        with self._cond:
+            host.assigned -= 1
+            self._cond.notify_all()
+
+    def run(self, fn, *args, **kwargs):
+        """
+        Call fn(*args, docker_url=..., client=..., **kwargs) on the least
+        loaded host, retrying on another host if the connection fails.
+        """
+        failed = []
+        while True:
+            host = self.acquire(exclude=failed)
+            try:
+                return fn(*args, docker_url=host.url, client=self.client(host), **kwargs)
+            except HOST_ERRORS:
+                self.mark_down(host)
+                failed.append(host)
+                if len(failed) >= len(self.hosts):
+                    raise exceptions.DbuildException(
+                        'Could not reach any docker host for the build: %s' % (
+                            ', '.join(h.url for h in failed)))
+            finally:
+                self.release(host)
+
+
+class Allocation(object):
+    """ CPUs, and optionally memory, granted to one build on a docker host """
+
+    def __init__(self, docker_url, cpu_ids, memory=None):
+        self.docker_url = docker_url
+        self.cpu_ids = cpu_ids
+        self.memory = memory
+
+    def __repr__(self):
+        return 'Allocation(%r, cpus=%s, memory=%s)' % (self.docker_url, self.cpuset, self.memory)
+
+    @property
+    def cpus(self):
+        return len(self.cpu_ids)
+
+    @property
+    def cpuset(self):
+        return ','.join(str(i) for i in self.cpu_ids)
+
+    def host_config(self):
+        """ create_host_config arguments enforcing the allocation """
+        config = {'cpuset_cpus': self.cpuset}
+        if self.memory is not None:
+            # No swap on top, a build beyond its memory fails instead of thrashing
+            config.update(mem_limit=self.memory, memswap_limit=self.memory)
+        return config
+
+    def labels(self):
+        labels = {CPUS_LABEL: str(self.cpus), CPUSET_LABEL: self.cpuset}
+        if self.memory is not None:
+            labels[MEMORY_LABEL] = str(self.memory)
+        return labels
+
+
+class ResourceAllocator(object):
+    """
+    Hands out the CPUs and memory of docker hosts to builds, so that
+    concurrent builds neither oversubscribe a host nor leave it idle.
+
+    A build asks for a number of CPUs, or 'auto' for its share of the host:
+    its CPUs divided among the running builds plus this one, or among
+    concurrency builds if more are expected, as in a batch. It gets that
+    many CPUs pinned with a cpuset and, with memory_per_cpu, a memory
+    limit in proportion. A build which doesn't fit waits until enough is
+    free. Running dbuild containers of other processes count with the
+    resources their labels record, or one CPU if they have none. A
+    fraction memory_reserve of the host's memory is never handed out.
+    """
+
+    def __init__(self, concurrency=None, memory_reserve=0.1, poll_interval=5):
+        self.concurrency = concurrency
+        self.memory_reserve = memory_reserve
+        self.poll_interval = poll_interval
+        self._capacity = {}
+        self._allocations = []
+        self._cond = threading.Condition()
+
+    def capacity(self, client, docker_url):
+        """ CPUs and memory of a docker host """
+        if docker_url not in self._capacity:
+            info = client.info()
+            self._capacity[docker_url] = (int(info.get('NCPU') or 1), int(info.get('MemTotal') or 0))
+        return self._capacity[docker_url]
+
+    def _running(self, client):
+        """ The running dbuild containers on a host """
+        return client.containers(filters={'label': dbuild.CONTAINER_LABEL, 'status': 'running'})
+
+    def _usage(self, docker_url, containers):
+        """
+        CPU ids, CPU count and memory used by dbuild builds on a host, given
+        its running containers, and how many of the builds are other
+        processes'
+        """
+        cpu_ids = set()
+        cpus = memory = foreign = 0
+        for allocation in self._allocations:
+            if allocation.docker_url == docker_url:
+                cpu_ids.update(allocation.cpu_ids)
+                cpus += allocation.cpus
+                memory += allocation.memory or 0
+        owner = dbuild.container_labels(None)[dbuild.OWNER_LABEL]
+        for container in containers:
+            labels = container.get('Labels') or {}
+            if labels.get(dbuild.OWNER_LABEL) == owner or labels.get(dbuild.CONTAINER_LABEL) == 'pool':
+                # Builds of this process are in self._allocations already,
+                # and idle pool containers use next to nothing
+                continue
+            cpus += int(labels.get(CPUS_LABEL, 1))
+            memory += int(labels.get(MEMORY_LABEL, 0))
+            if labels.get(CPUSET_LABEL):
+                cpu_ids.update(int(i) for i in labels[CPUSET_LABEL].split(','))
+            foreign += 1
+        return cpu_ids, cpus, memory, foreign
+
+    def _try(self, docker_url, capacity, containers, parallel, memory_per_cpu):
+        total_cpus, total_memory = capacity
+        used_ids, used_cpus, used_memory, foreign = self._usage(docker_url, containers)
+        mine = len([a for a in self._allocations if a.docker_url == docker_url])
+        if parallel == 'auto':
+            wanted = max(1, total_cpus // max(self.concurrency or 1, foreign + mine + 1))
+        else:
+            wanted = min(int(parallel), total_cpus)
+        usable_memory = total_memory * (1 - self.memory_reserve)
+        if memory_per_cpu and total_memory:
+            # Never wait for more than the host could give even when idle
+            wanted = min(wanted, max(1, int(usable_memory // memory_per_cpu)))
+        free_ids = [i for i in range(total_cpus) if i not in used_ids]
+        cpus = min(wanted, total_cpus - used_cpus, len(free_ids))
+        if memory_per_cpu and total_memory:
+            cpus = min(cpus, int((usable_memory - used_memory) // memory_per_cpu))
+        if cpus < 1 or (parallel != 'auto' and cpus < wanted):
+            return None
+        memory = cpus * memory_per_cpu if memory_per_cpu and total_memory else None
+        return Allocation(docker_url, free_ids[:cpus], memory)
+
+    def acquire(self, client, docker_url, parallel='auto', memory_per_cpu=None):
+        """
+        Wait until the build fits on the docker host and return its
+        Allocation. The host is asked what runs on it without the lock
+        held, so a slow host doesn't hold up the builds of others; its
+        HOST_ERRORS are raised as they are, for a HostPool to try another
+        host.
+        """
+        while True:
+            capacity = self.capacity(client, docker_url)
+            containers = self._running(client)
+            with self._cond:
+                allocation = self._try(docker_url, capacity, containers, parallel, memory_per_cpu)
+                if allocation is not None:
+                    self._allocations.append(allocation)
+                    return allocation
+                self._cond.wait(self.poll_interval)
+
+    def release(self, allocation):
+        with self._cond:
+            self._allocations.remove(allocation)
+            self._cond.notify_all()
+
+
+_default_allocator = None
+_default_allocator_lock = threading.Lock()
+
+
+def default_allocator():
+    """ The ResourceAllocator shared by the builds of this process """
+    global _default_allocator
+    with _default_allocator_lock:
+        if _default_allocator is None:
+            _default_allocator = ResourceAllocator()
+        return _default_allocator
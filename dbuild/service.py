@@ -0,0 +1,447 @@
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import uuid
+
+import six
+from six.moves import BaseHTTPServer
+from six.moves import queue
+from six.moves import socketserver
+from six.moves.urllib.parse import parse_qs, urlparse
+
+import dbuild
+from dbuild import batch
+from dbuild import cache
+from dbuild import exceptions
+from dbuild import proxy
+from dbuild import scheduler
+from dbuild.pool import ContainerPool, build_volumes
+from dbuild.session import DbuildSession
+
+# States of a job; jobs in the last three are done
+QUEUED, RUNNING, SUCCEEDED, FAILED, CANCELLED = (
+    'queued', 'running', 'succeeded', 'failed', 'cancelled')
+
+# Addresses which only this host can connect to
+LOOPBACK_HOSTS = ('127.0.0.1', 'localhost', '::1')
+
+
+def _name(value):
+    return (isinstance(value, six.string_types) and
+            re.match(r'[A-Za-z0-9][A-Za-z0-9._/-]*\Z', value) is not None)
+
+
+def _flag(value):
+    return isinstance(value, bool)
+
+
+def _seconds(value):
+    return value is None or (isinstance(value, six.integer_types + (float,)) and
+                             not isinstance(value, bool) and value >= 0)
+
+
+def _parallel(value):
+    return value == 'auto' or (isinstance(value, six.integer_types) and
+                               not isinstance(value, bool) and value > 0)
+
+
+def _scratch_size(value):
+    return isinstance(value, six.string_types) and re.match(r'[0-9]+[kmgKMG]?\Z', value) is not None
+
+
+# The build options a job may override, and what their values may be. Host
+# paths, which are created and bind mounted into the build containers, and
+# anything else ending up on a host or in a shell command, stay as the
+# service was started with.
+JOB_OPTIONS = {
+    'dist': _name,
+    'release': _name,
+    'parallel': _parallel,
+    'pipeline': _flag,
+    'force_rm': _flag,
+    'build_cache': _flag,
+    'no_default_sources': _flag,
+    'include_timestamps': _flag,
+    'apt_layer_ttl': _seconds,
+    'builddep_cache': _flag,
+    'result_cache': _flag,
+    'write_metrics': _flag,
+    'scratch': lambda value: value is None or value in dbuild.SCRATCH_KINDS,
+    'scratch_size': _scratch_size,
+    'resume': _flag,
+    'timeout': _seconds,
+    'stall_timeout': _seconds,
+}
+
+
+class Job(batch.BuildResult):
+    """ A build submitted to the service """
+
+    def __init__(self, id, build_dir, log_file, options=None, created=None):
+        super(Job, self).__init__(build_dir, log_file)
+        self.id = id
+        self.options = options or {}
+        self.state = QUEUED
+        self.created = created or time.time()
+
+    @property
+    def done(self):
+        return self.state in (SUCCEEDED, FAILED, CANCELLED)
+
+    def as_dict(self):
+        data = super(Job, self).as_dict()
+        data.update(id=self.id, options=self.options, state=self.state, created=self.created)
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        job = cls(data['id'], data['build_dir'], data['log_file'], data['options'],
+                  data['created'])
+        for key in ('state', 'success', 'failed_phase', 'error', 'started', 'finished'):
+            setattr(job, key, data.get(key))
+        return job
+
+
+class BuildService(object):
+    """
+    Runs submitted builds, up to workers at a time, in one long-lived
+    process, so the docker clients, the view of the images on the docker
+    hosts and, with pool_size, a pool of warm containers are shared by all
+    jobs.
+
+    Every job is kept as a JSON file in state_dir/jobs, and its build log
+    in state_dir/logs. Jobs queued or running when the service stopped are
+    queued again when it starts.
+
+    build_args are the build_package arguments of every job; a job's
+    options can override those in JOB_OPTIONS, but not add others. With
+    build_root, only build directories under it are accepted.
+    """
+
+    def __init__(self, state_dir, build_args=None, workers=1, session=None, pool_size=0,
+                 build_root=None):
+        self.state_dir = state_dir
+        self.build_root = build_root and os.path.realpath(build_root)
+        self.build_args = dict(build_args or {})
+        self.workers = workers
+        self.session = session or DbuildSession(
+            self.build_args.get('docker_url', 'unix://var/run/docker.sock'))
+        # Shares the CPUs of the docker hosts among the workers' builds
+        # with parallel='auto'
+        self.allocator = scheduler.ResourceAllocator(concurrency=workers)
+        self.pool = None
+        if pool_size:
+            self.pool = ContainerPool(self.session.client(), size=pool_size,
+                                      shared_volumes=build_volumes(self.build_args))
+        self.jobs = {}
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._threads = []
+        for name in ('jobs', 'logs'):
+            if not os.path.isdir(os.path.join(state_dir, name)):
+                os.makedirs(os.path.join(state_dir, name))
+        self._load()
+
+    def _job_file(self, job_id):
+        return os.path.join(self.state_dir, 'jobs', '%s.json' % job_id)
+
+    def _save(self, job):
+        fd, tmp = tempfile.mkstemp(dir=os.path.join(self.state_dir, 'jobs'), prefix='.tmp-')
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(job.as_dict(), fp, indent=2, sort_keys=True)
+        os.rename(tmp, self._job_file(job.id))
+
+    def _load(self):
+        jobs = []
+        for name in os.listdir(os.path.join(self.state_dir, 'jobs')):
+            if name.endswith('.json') and not name.startswith('.'):
+                with open(os.path.join(self.state_dir, 'jobs', name), 'r') as fp:
+                    jobs.append(Job.from_dict(json.load(fp)))
+        for job in sorted(jobs, key=lambda job: job.created):
+            self.jobs[job.id] = job
+            if not job.done:
+                # Interrupted by a restart, run it again
+                job.state, job.started = QUEUED, None
+                self._save(job)
+                self._queue.put(job.id)
+
+    def submit(self, build_dir, options=None):
+        """ Queue a build of build_dir and return its Job """
+        options = dict(options or {})
+        unknown = sorted(set(options) - set(self.build_args) - set(JOB_OPTIONS))
+        if unknown:
+            raise exceptions.DbuildException('Unknown build options: %s' % ', '.join(unknown))
+        fixed = sorted(set(options) - set(JOB_OPTIONS))
+        if fixed:
+            raise exceptions.DbuildException('Build options jobs can not set: %s' % ', '.join(fixed))
+        invalid = sorted(name for name, value in options.items() if not JOB_OPTIONS[name](value))
+        if invalid:
+            raise exceptions.DbuildException('Invalid build options: %s' % ', '.join(
+                '%s=%r' % (name, options[name]) for name in invalid))
+        if self.build_root is not None and not os.path.realpath(build_dir).startswith(
+                os.path.join(self.build_root, '')):
+            raise exceptions.DbuildException('%s is not under %s' % (build_dir, self.build_root))
+        job_id = uuid.uuid4().hex[:16]
+        job = Job(job_id, os.path.abspath(build_dir),
+                  os.path.join(self.state_dir, 'logs', '%s.log' % job_id), options)
+        with self._lock:
+            self.jobs[job.id] = job
+            self._save(job)
+        self._queue.put(job.id)
+        return job
+
+    def cancel(self, job_id):
+        """ Cancel a queued job. Returns whether it was still queued. """
+        with self._lock:
+            job = self.jobs[job_id]
+            if job.state != QUEUED:
+                return False
+            job.state = CANCELLED
+            self._save(job)
+        return True
+
+    def get(self, job_id):
+        return self.jobs[job_id]
+
+    def list(self):
+        return sorted(self.jobs.values(), key=lambda job: job.created)
+
+    def start(self):
+        """ Start the worker threads """
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self):
+        """ Let the running jobs finish and stop the workers """
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        if self.pool is not None:
+            self.pool.close()
+
+    def wait(self, job_id, timeout=None):
+        """ Wait for a job to be done, returns whether it is """
+        deadline = None if timeout is None else time.time() + timeout
+        while not self.jobs[job_id].done:
+            if deadline is not None and time.time() > deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def _work(self):
+        while True:
+            job_id = self._queue.get()
+            if job_id is None:
+                return
+            with self._lock:
+                job = self.jobs[job_id]
+                if job.state != QUEUED:
+                    continue
+                job.state = RUNNING
+                self._save(job)
+            build_args = dict(self.build_args, **job.options)
+            docker_url = build_args.get('docker_url')
+            build_args.update(client=self.session.client(docker_url), session=self.session)
+            # Jobs the pool can't serve get containers of their own
+            if (self.pool is not None and docker_url in (None, self.session.docker_url) and
+                    self.pool.serves(build_args)):
+                build_args['pool'] = self.pool
+            if build_args.get('parallel') == 'auto':
+                build_args['allocator'] = self.allocator
+            batch.run_job(job, build_args)
+            with self._lock:
+                job.state = SUCCEEDED if job.success else FAILED
+                self._save(job)
+
+
+class ServiceHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    HTTP API of a BuildService:
+
+    POST /jobs               {"build_dir": ..., "options": {...}}, queue a job
+    GET /jobs                all jobs
+    GET /jobs/ID             a job
+    DELETE /jobs/ID          cancel a queued job
+    GET /jobs/ID/log         its build log; with ?follow=1, streamed until the
+                             job is done, from byte ?offset=N
+    """
+
+    JOB_RE = re.compile(r'^/jobs/([0-9a-f]+)(/log)?$')
+
+    @property
+    def service(self):
+        return self.server.service
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def _send_json(self, status, data):
+        body = json.dumps(data, indent=2, sort_keys=True).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _job(self):
+        """ The job and whether its log was asked for, or None after a 404 """
+        match = self.JOB_RE.match(urlparse(self.path).path)
+        if match is None or match.group(1) not in self.service.jobs:
+            self._send_json(404, {'error': 'Not found: %s' % self.path})
+            return None, False
+        return self.service.get(match.group(1)), bool(match.group(2))
+
+    def do_GET(self):
+        if urlparse(self.path).path == '/jobs':
+            return self._send_json(200, [job.as_dict() for job in self.service.list()])
+        job, log = self._job()
+        if job is None:
+            return
+        if not log:
+            return self._send_json(200, job.as_dict())
+        query = parse_qs(urlparse(self.path).query)
+        self._send_log(job, int(query.get('offset', ['0'])[0]),
+                       query.get('follow', ['0'])[0] not in ('0', ''))
+
+    def _send_log(self, job, offset, follow):
+        # Without a length, the log ends when the connection closes
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        while True:
+            done = job.done
+            if os.path.exists(job.log_file):
+                with open(job.log_file, 'rb') as fp:
+                    fp.seek(offset)
+                    for chunk in iter(lambda: fp.read(1 << 16), b''):
+                        self.wfile.write(chunk)
+                        offset += len(chunk)
+                self.wfile.flush()
+            if not follow or done:
+                return
+            time.sleep(self.server.poll_interval)
+
+    def do_POST(self):
+        if urlparse(self.path).path != '/jobs':
+            return self._send_json(404, {'error': 'Not found: %s' % self.path})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                                 .decode('utf-8'))
+            job = self.service.submit(request['build_dir'], request.get('options'))
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            return self._send_json(400, {'error': 'Bad job request: %s' % e})
+        except exceptions.DbuildException as e:
+            return self._send_json(400, {'error': str(e)})
+        self._send_json(201, job.as_dict())
+
+    def do_DELETE(self):
+        job, log = self._job()
+        if job is None:
+            return
+        if log or not self.service.cancel(job.id):
+            return self._send_json(409, {'error': 'Job %s is %s' % (job.id, job.state)})
+        self._send_json(200, job.as_dict())
+
+
+class _ServerMixin(socketserver.ThreadingMixIn):
+    daemon_threads = True
+    verbose = False
+    poll_interval = 0.2
+
+
+class HTTPServer(_ServerMixin, BaseHTTPServer.HTTPServer):
+    pass
+
+
+class UnixHTTPServer(_ServerMixin, socketserver.UnixStreamServer):
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        socketserver.UnixStreamServer.server_bind(self)
+        self.server_name, self.server_port = 'localhost', 0
+
+
+def make_server(service, listen, allow_remote=False):
+    """
+    HTTP server for service listening on listen: HOST:PORT, or the path of
+    a unix socket, optionally prefixed with unix://. Anyone who can submit
+    jobs can run builds as root on the docker host, so HOST must be a
+    loopback address unless allow_remote is True.
+    """
+    if listen.startswith('unix://') or '/' in listen:
+        server = UnixHTTPServer(listen[len('unix://'):] if listen.startswith('unix://') else listen,
+                                ServiceHandler)
+    else:
+        host, _, port = listen.rpartition(':')
+        if host.strip('[]') not in LOOPBACK_HOSTS + ('',) and not allow_remote:
+            raise exceptions.DbuildException(
+                'Refusing to listen on %s without --allow-remote, the API has no '
+                'authentication' % listen)
+        server = HTTPServer((host or '127.0.0.1', int(port)), ServiceHandler)
+    server.service = service
+    return server
+
+
+def main(argv):
+    ap = argparse.ArgumentParser(
+        prog='dbuild serve',
+        description='Run builds submitted over an HTTP API, keeping docker '
+                    'state warm between them')
+    ap.add_argument('--state-dir', type=str, default=None, metavar='DIR',
+                    help='Directory for the job queue and logs (default: '
+                         'service under the cache dir)')
+    ap.add_argument('--listen', type=str, default=None, metavar='ADDRESS',
+                    help='HOST:PORT, or the path of a unix socket (default: '
+                         'dbuild.sock in the state dir)')
+    ap.add_argument('--workers', '-w', type=int, default=1,
+                    help='how many builds to run concurrently (default: 1)')
+    ap.add_argument('--pool-size', type=int, default=0, metavar='N',
+                    help='Keep N warm containers per image to run builds in')
+    ap.add_argument('--allow-remote', action='store_true', default=False,
+                    help='Allow --listen on an address other hosts can reach; '
+                         'the API has no authentication')
+    ap.add_argument('--build-root', type=str, default=None, metavar='DIR',
+                    help='Only accept build directories under DIR')
+    ap.add_argument('--verbose', '-v', action='store_true', default=False,
+                    help='Log every request')
+    dbuild.add_build_arguments(ap)
+    args = ap.parse_args(argv)
+
+    state_dir = args.state_dir or cache.index_path(args.cache_dir, 'service')
+    with proxy.from_args(dbuild.build_arguments(args), args) as build_args:
+        service = BuildService(state_dir, build_args, workers=args.workers,
+                               pool_size=args.pool_size, build_root=args.build_root)
+        server = make_server(service,
+                             args.listen or 'unix://' + os.path.join(state_dir, 'dbuild.sock'),
+                             args.allow_remote)
+        service.start()
+        server.verbose = args.verbose
+        print('dbuild serving on %s, %d jobs queued' % (
+            server.server_address or args.listen,
+            len([job for job in service.list() if job.state == QUEUED])))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            service.stop()
+    return True
@@ -0,0 +1,119 @@
+import threading
+import time
+
+import dbuild
+
+
+class DbuildSession(object):
+    """
+    State kept across many builds by a program using dbuild as a library.
+
+    A session holds one docker client per docker url, shared by all threads
+    (the client's connection pool makes that safe), and a memoized view of
+    the image tags present on each docker host. The view is fetched with a
+    single images call, updated as dbuild builds or pulls images, and
+    fetched again once it is image_ttl seconds old, since other processes
+    may remove images meanwhile.
+
+    The module level functions of dbuild which take a docker client are
+    available as methods taking a docker_url instead, the session's
+    docker_url by default.
+    """
+
+    def __init__(self, docker_url='unix://var/run/docker.sock', client_factory=None,
+                 image_ttl=300):
+        self.docker_url = docker_url
+        self.client_factory = client_factory or dbuild.docker_client
+        self.image_ttl = image_ttl
+        self._clients = {}
+        self._images = {}
+        self._lock = threading.Lock()
+
+    def client(self, docker_url=None):
+        """ The docker client for docker_url """
+        docker_url = docker_url or self.docker_url
+        with self._lock:
+            if docker_url not in self._clients:
+                self._clients[docker_url] = self.client_factory(docker_url)
+            return self._clients[docker_url]
+
+    def _image_tags(self, docker_url):
+        with self._lock:
+            known = self._images.get(docker_url)
+            if known is not None and time.time() - known[0] < self.image_ttl:
+                return known[1]
+        tags = set()
+        for image in self.client(docker_url).images():
+            tags.update(t for t in image.get('RepoTags') or () if t != '<none>:<none>')
+        with self._lock:
+            self._images[docker_url] = (time.time(), tags)
+        return tags
+
+    def image_exists(self, tag, docker_url=None):
+        """ Whether image tag exists on the docker host, as far as known """
+        return tag in self._image_tags(docker_url or self.docker_url)
+
+    def add_image(self, tag, docker_url=None):
+        """ Record that image tag exists now """
+        with self._lock:
+            known = self._images.get(docker_url or self.docker_url)
+            if known is not None:
+                known[1].add(tag)
+
+    def invalidate(self, docker_url=None):
+        """ Forget the images of docker_url, or of all docker hosts """
+        with self._lock:
+            if docker_url is None:
+                self._images.clear()
+            else:
+                self._images.pop(docker_url, None)
+
+    def pull(self, repository, tag=None, docker_url=None):
+        """ Pull an image, returning the progress messages """
+        try:
+            return list(self.client(docker_url).pull(repository, tag=tag, stream=True,
+                                                     decode=True))
+        finally:
+            self.invalidate(docker_url or self.docker_url)
+
+    def build_image(self, path, tag, nocache=False, docker_url=None):
+        try:
+            for line in dbuild.build_image(self.client(docker_url), path, tag, nocache):
+                yield line
+        finally:
+            self.invalidate(docker_url or self.docker_url)
+
+    def create_container(self, image, docker_url=None, **kwargs):
+        return dbuild.create_container(self.client(docker_url), image, **kwargs)
+
+    def start_container(self, container, docker_url=None):
+        return dbuild.start_container(self.client(docker_url), container)
+
+    def wait_container(self, container, docker_url=None):
+        return dbuild.wait_container(self.client(docker_url), container)
+
+    def container_logs(self, container, include_timestamps=True, docker_url=None):
+        return dbuild.container_logs(self.client(docker_url), container, include_timestamps)
+
+    def print_container_logs(self, container, include_timestamps=True, output=None,
+                             sinks=(), docker_url=None):
+        return dbuild.print_container_logs(self.client(docker_url), container,
+                                           include_timestamps, output, sinks)
+
+    def remove_container(self, container, force=False, docker_url=None):
+        return dbuild.remove_container(self.client(docker_url), container, force)
+
+    def prepare_image(self, dist, release, docker_url=None, **kwargs):
+        docker_url = docker_url or self.docker_url
+        return dbuild.prepare_image(self.client(docker_url), dist, release,
+                                    docker_url=docker_url, session=self, **kwargs)
+
+    def docker_build(self, build_dir, build_type, docker_url=None, **kwargs):
+        docker_url = docker_url or self.docker_url
+        return dbuild.docker_build(build_dir, build_type, docker_url=docker_url,
+                                   client=self.client(docker_url), session=self, **kwargs)
+
+    def build_package(self, build_dir, docker_url=None, **kwargs):
+        docker_url = docker_url or self.docker_url
+        return dbuild.build_package(build_dir, docker_url=docker_url,
+                                    client=self.client(docker_url), session=self, **kwargs)
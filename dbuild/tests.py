@@ -1,13 +1,24 @@
+import argparse
+import fcntl
+import gzip
+import io
+import json
 import os
 import os.path
 import shutil
+import socket
+import subprocess
 import tarfile
 import tempfile
+import threading
+import time
 import types
 from unittest import TestCase
 
 import mock
 
+import six
+
 import dbuild
 
 
@@ -51,7 +62,8 @@ class DbuildTests(TestCase):
         docker_client.create_container.assert_called_with(image='imagename', name=None,
                                                           command=None, environment=None,
                                                           network_disabled=False, volumes=None,
-                                                          working_dir=None, host_config=None)
+                                                          working_dir=None, host_config=None,
+                                                          labels=None)
 
     def test_create_container_shared_volumes(self):
         docker_client = mock.MagicMock()
@@ -63,7 +75,8 @@ class DbuildTests(TestCase):
         docker_client.create_container.assert_called_with(image='imagename', name=None,
                                                           command=None, environment=None,
                                                           network_disabled=False, volumes=['/else'],
-                                                          working_dir=None, host_config=host_config)
+                                                          working_dir=None, host_config=host_config,
+                                                          labels=None)
 
     def test_start_container(self):
         docker_client = mock.MagicMock()
@@ -119,6 +132,472 @@ class DbuildTests(TestCase):
         finally:
             shutil.rmtree(tmpdir)
 
+    def test_render_dockerfile(self):
+        with open(os.path.join(os.path.dirname(__file__), 'test_data', 'Dockerfile1'), 'r') as fp:
+            expected_content = fp.read()
+
+        self.assertEquals(expected_content, dbuild.render_dockerfile('ubuntu', 'trusty'))
+
+    def test_build_context(self):
+        context = dbuild.build_context('ubuntu', 'trusty')
+        self.assertIs(context, dbuild.build_context('ubuntu', 'trusty'))
+        self.assertIsNot(context, dbuild.build_context('ubuntu', 'trusty', ccache=True))
+
+        with tarfile.open(fileobj=io.BytesIO(context)) as tar:
+            self.assertEquals(['Dockerfile', 'scripts/pbuilder-satisfydepends',
+                               'scripts/pbuilder-satisfydepends-checkparams',
+                               'scripts/pbuilder-satisfydepends-funcs'], tar.getnames())
+            self.assertEquals(dbuild.render_dockerfile('ubuntu', 'trusty').encode('utf-8'),
+                              tar.extractfile('Dockerfile').read())
+            self.assertTrue(tar.getmember('scripts/pbuilder-satisfydepends').mode & 0o100)
+            # Nothing depends on when or by whom it was made
+            self.assertEquals((0, 0), (tar.getmember('Dockerfile').mtime,
+                                       tar.getmember('Dockerfile').uid))
+
+    def test_image_tag_is_content_addressed(self):
+        tag = dbuild.image_tag('ubuntu', 'trusty')
+        self.assertTrue(tag.startswith('dbuild-ubuntu/trusty:'))
+        self.assertEquals(tag, dbuild.image_tag('ubuntu', 'trusty'))
+        self.assertNotEquals(tag, dbuild.image_tag('ubuntu', 'trusty', proxy='http://proxy:3128'))
+        self.assertNotEquals(tag, dbuild.image_tag('ubuntu', 'xenial'))
+
+    def test_prepare_image_records_built_image(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            index = dbuild.cache.ImageIndex(os.path.join(tmpdir, 'images.json'))
+            docker_client = mock.MagicMock()
+            docker_client.build.return_value = iter([{'stream': 'line1'}])
+
+            tag = dbuild.prepare_image(docker_client, 'ubuntu', 'trusty', image_index=index)
+
+            self.assertEquals(dbuild.image_tag('ubuntu', 'trusty'), tag)
+            self.assertEquals(1, docker_client.build.call_count)
+            self.assertIn(('unix://var/run/docker.sock', tag), index)
+            self.assertNotIn(('tcp://otherhost:2375', tag), index)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_prepare_image_skips_build_when_indexed(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            index = dbuild.cache.ImageIndex(os.path.join(tmpdir, 'images.json'))
+            index.add('unix://var/run/docker.sock', dbuild.image_tag('ubuntu', 'trusty'))
+            docker_client = mock.MagicMock()
+
+            with mock.patch('dbuild.build_context') as build_context:
+                dbuild.prepare_image(docker_client, 'ubuntu', 'trusty', image_index=index)
+                self.assertFalse(build_context.called)
+            self.assertFalse(docker_client.build.called)
+
+            docker_client.build.return_value = iter([])
+            dbuild.prepare_image(docker_client, 'ubuntu', 'trusty', build_cache=False,
+                                 image_index=index)
+            self.assertTrue(docker_client.build.call_args[1]['nocache'])
+            self.assertTrue(docker_client.build.call_args[1]['custom_context'])
+            self.assertEquals(dbuild.build_context('ubuntu', 'trusty'),
+                              docker_client.build.call_args[1]['fileobj'].getvalue())
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_apt_layer_tag_follows_repos_and_keys(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            tag = dbuild.apt_layer_tag('base:1', 'ubuntu', 'trusty', tmpdir)
+            self.assertTrue(tag.startswith('dbuild-ubuntu/trusty-apt:'))
+            self.assertNotEquals(tag, dbuild.apt_layer_tag('base:2', 'ubuntu', 'trusty', tmpdir))
+            self.assertNotEquals(tag, dbuild.apt_layer_tag('base:1', 'ubuntu', 'trusty', tmpdir,
+                                                           no_default_sources=True))
+
+            with open(os.path.join(tmpdir, 'repos'), 'w') as fp:
+                fp.write('deb http://example.com/ubuntu trusty main\n')
+            repos_tag = dbuild.apt_layer_tag('base:1', 'ubuntu', 'trusty', tmpdir)
+            self.assertNotEquals(tag, repos_tag)
+
+            with open(os.path.join(tmpdir, 'repos'), 'w') as fp:
+                fp.write('deb http://example.com/ubuntu trusty universe\n')
+            self.assertNotEquals(repos_tag, dbuild.apt_layer_tag('base:1', 'ubuntu', 'trusty', tmpdir))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_prepare_apt_layer_refreshes_after_ttl(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            index = dbuild.cache.ImageIndex(os.path.join(tmpdir, 'images.json'))
+            with open(os.path.join(tmpdir, 'keys'), 'w') as fp:
+                fp.write('some key')
+            docker_client = mock.MagicMock()
+            docker_client.build.side_effect = lambda **kwargs: iter([])
+
+            tag = dbuild.prepare_apt_layer(docker_client, 'base:1', 'ubuntu', 'trusty', tmpdir,
+                                           ttl=3600, image_index=index)
+            self.assertEquals(1, docker_client.build.call_count)
+            self.assertEquals(tag, docker_client.build.call_args[1]['tag'])
+
+            dbuild.prepare_apt_layer(docker_client, 'base:1', 'ubuntu', 'trusty', tmpdir,
+                                     ttl=3600, image_index=index)
+            self.assertEquals(1, docker_client.build.call_count)
+
+            with mock.patch('dbuild.time.time', return_value=dbuild.time.time() + 7200):
+                dbuild.prepare_apt_layer(docker_client, 'base:1', 'ubuntu', 'trusty', tmpdir,
+                                         ttl=3600, image_index=index)
+            self.assertEquals(2, docker_client.build.call_count)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def _mock_docker_build(self, build_dir, rv=0, log_chunks=(), **kwargs):
+        docker_client = mock.MagicMock()
+        docker_client.build.side_effect = lambda **kw: iter([])
+        docker_client.logs.side_effect = lambda **kw: iter(log_chunks)
+        docker_client.wait.return_value = rv
+        docker_client.inspect_image.return_value = {'Size': 0}
+        docker_client.version.return_value = {'Arch': 'amd64'}
+        with mock.patch('dbuild.docker_client', return_value=docker_client):
+            dbuild.docker_build(build_dir, cache_dir=os.path.join(build_dir, 'cache'), **kwargs)
+        return docker_client
+
+    def test_build_with_apt_layer(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            docker_client = self._mock_docker_build(tmpdir, build_type='source')
+            command = docker_client.create_container.call_args[1]['command'][2]
+            self.assertIn('apt-get -y update', command)
+
+            docker_client = self._mock_docker_build(tmpdir, build_type='source', apt_layer_ttl=3600)
+            command = docker_client.create_container.call_args[1]['command'][2]
+            self.assertNotIn('apt-get -y update', command)
+            image = docker_client.create_container.call_args[1]['image']
+            self.assertTrue(image.startswith('dbuild-ubuntu/trusty-apt:'))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_parse_signed_dsc(self):
+        paragraphs = dbuild.control.parse_deb822(
+            '-----BEGIN PGP SIGNED MESSAGE-----\n'
+            'Hash: SHA256\n'
+            '\n'
+            'Format: 3.0 (native)\n'
+            'Source: pkg\n'
+            'Build-Depends: debhelper (>= 9),\n'
+            ' python-all\n'
+            'Build-Depends-Indep: python-setuptools\n'
+            '\n'
+            '-----BEGIN PGP SIGNATURE-----\n'
+            '\n'
+            'abcdef\n'
+            '-----END PGP SIGNATURE-----\n')
+        self.assertEquals(1, len(paragraphs))
+        self.assertEquals('pkg', paragraphs[0]['Source'])
+        self.assertEquals(['debhelper (>= 9)', 'python-all', 'python-setuptools'],
+                          dbuild.control.build_depends(paragraphs[0]))
+
+    def test_build_depends_are_normalized(self):
+        fields = dbuild.control.read_control(os.path.join(os.path.dirname(__file__), 'test_data',
+                                                          'pkg1', 'debian', 'control'))
+        self.assertEquals(['debhelper (>= 9.0.0)', 'dh-python', 'python-all', 'python-setuptools'],
+                          dbuild.control.build_depends(fields))
+        self.assertEquals(dbuild.control.build_depends({'Build-Depends': 'b ( >= 1 ),a|c, b (>= 1)'}),
+                          dbuild.control.build_depends({'Build-Depends': 'a | c,\nb (>= 1)'}))
+
+    def test_prepare_builddep_image(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            index = dbuild.cache.ImageIndex(os.path.join(tmpdir, 'builddeps.json'))
+            docker_client = mock.MagicMock()
+            docker_client.create_container.return_value = {'Id': 'abc'}
+            docker_client.logs.side_effect = lambda **kw: iter([])
+            docker_client.wait.return_value = 0
+            docker_client.inspect_image.side_effect = lambda tag: {'Size': 300 if tag == 'base' else 1300}
+
+            tag = dbuild.prepare_builddep_image(docker_client, 'base', 'ubuntu', 'trusty', tmpdir,
+                                                ['debhelper', 'python-all'], image_index=index)
+
+            self.assertTrue(tag.startswith('dbuild-ubuntu/trusty-deps:'))
+            self.assertIn('python-all', docker_client.create_container.call_args[1]['command'][2])
+            repository, version = tag.split(':')
+            docker_client.commit.assert_called_with('abc', repository=repository, tag=version)
+            self.assertEquals(1000, index.get('unix://var/run/docker.sock', tag)['size'])
+
+            docker_client.reset_mock()
+            self.assertEquals(tag, dbuild.prepare_builddep_image(docker_client, 'base', 'ubuntu',
+                                                                 'trusty', tmpdir,
+                                                                 ['debhelper', 'python-all'],
+                                                                 image_index=index))
+            self.assertFalse(docker_client.create_container.called)
+
+            # A newer base image invalidates it
+            dbuild.prepare_builddep_image(docker_client, 'base', 'ubuntu', 'trusty', tmpdir,
+                                          ['debhelper', 'python-all'], image_index=index,
+                                          base_built=dbuild.time.time() + 1)
+            self.assertTrue(docker_client.create_container.called)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_prepare_builddep_image_failure(self):
+        docker_client = mock.MagicMock()
+        docker_client.logs.side_effect = lambda **kw: iter([])
+        docker_client.wait.return_value = 100
+        self.assertRaises(dbuild.exceptions.DbuildBinaryBuildFailedException,
+                          dbuild.prepare_builddep_image, docker_client, 'base', 'ubuntu', 'trusty',
+                          '/some/dir', ['debhelper'])
+        self.assertFalse(docker_client.commit.called)
+
+    def test_evict_builddep_images(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            index = dbuild.cache.ImageIndex(os.path.join(tmpdir, 'builddeps.json'))
+            url = 'unix://var/run/docker.sock'
+            with index.update() as data:
+                data[url] = {'old': {'built': 1, 'used': 10, 'size': 100},
+                             'older': {'built': 1, 'used': 5, 'size': 100},
+                             'new': {'built': 1, 'used': 20, 'size': 100},
+                             'current': {'built': 1, 'used': 1, 'size': 100}}
+            docker_client = mock.MagicMock()
+
+            dbuild.evict_builddep_images(docker_client, index, 250, keep=['current'])
+
+            self.assertEquals([mock.call('older'), mock.call('old')],
+                              docker_client.remove_image.call_args_list)
+            self.assertEquals(['current', 'new'], sorted(index.load()[url]))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_binary_build_with_builddep_cache(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(tmpdir, 'pkg_1.0.dsc'), 'w') as fp:
+                fp.write('Source: pkg\nBuild-Depends: debhelper\n')
+            docker_client = self._mock_docker_build(tmpdir, build_type='binary', builddep_cache=True)
+            deps_create, build_create = docker_client.create_container.call_args_list
+            self.assertIn('pbuilder-satisfydepends', deps_create[1]['command'][2])
+            self.assertNotIn('pbuilder-satisfydepends', build_create[1]['command'][2])
+            self.assertNotIn('apt-get -y update', build_create[1]['command'][2])
+            self.assertTrue(build_create[1]['image'].startswith('dbuild-ubuntu/trusty-deps:'))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_prune_apt_archive(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for i, name in enumerate(['a_1_all.deb', 'b_1_all.deb', 'c_1_all.deb']):
+                path = os.path.join(tmpdir, name)
+                with open(path, 'wb') as fp:
+                    fp.write(b'x' * 100)
+                os.utime(path, (1000 + i, 1000 + i))
+            os.mkdir(os.path.join(tmpdir, 'partial'))
+
+            # A build container copying packages into the archive
+            with open(os.path.join(tmpdir, dbuild.cache.APT_ARCHIVE_LOCK), 'a') as turns:
+                fcntl.flock(turns, fcntl.LOCK_EX)
+                self.assertEquals([], dbuild.cache.prune_apt_archive(tmpdir, 150))
+
+            self.assertEquals(['a_1_all.deb', 'b_1_all.deb'],
+                              dbuild.cache.prune_apt_archive(tmpdir, 150))
+            self.assertEquals(['.dbuild-lock', 'c_1_all.deb', 'partial'],
+                              sorted(os.listdir(tmpdir)))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_build_with_apt_archive_cache(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            archive = os.path.join(tmpdir, 'archives')
+            with mock.patch('dbuild.cache.prune_apt_archive') as prune_apt_archive:
+                docker_client = self._mock_docker_build(tmpdir, build_type='source',
+                                                        apt_archive_cache=archive,
+                                                        apt_archive_cache_size=1024)
+                prune_apt_archive.assert_called_with(archive, 1024)
+            self.assertTrue(os.path.isdir(archive))
+            self.assertEquals(sorted(['%s:/build' % tmpdir, '%s:/var/cache/dbuild/apt-archives' % archive]),
+                              sorted(docker_client.create_host_config.call_args[1]['binds']))
+            self.assertIn('Keep-Downloaded-Packages',
+                          docker_client.create_container.call_args[1]['command'][2])
+
+            # Containers run apt on archives of their own, seeded from the
+            # shared one, and only take turns copying what they downloaded
+            # into it
+            with mock.patch('dbuild.cache.prune_apt_archive'):
+                docker_client = self._mock_docker_build(tmpdir, build_type='binary',
+                                                        apt_archive_cache=archive)
+            command = docker_client.create_container.call_args[1]['command'][2]
+            self.assertEquals(0, subprocess.call(['bash', '-n', '-c', command]))
+            self.assertIn('exec 9>/var/cache/dbuild/apt-archives/.dbuild-lock && '
+                          "find /var/cache/dbuild/apt-archives -maxdepth 1 -name '*.deb' "
+                          '-exec ln -sf -t /var/cache/apt/archives {} + && ', command)
+            publish = ("{ flock 9 && find /var/cache/apt/archives -maxdepth 1 -type f -name '*.deb' "
+                       '-exec cp -n -t /var/cache/dbuild/apt-archives {} + ; flock -u 9 ; true ; } && ')
+            self.assertIn('apt-get -y dist-upgrade && ' + publish, command)
+            self.assertIn('/usr/lib/pbuilder/pbuilder-satisfydepends && ' + publish, command)
+            self.assertEquals(2, command.count('flock 9'))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_build_as_owner(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            self.assertEquals((1000, os.stat(tmpdir).st_gid), dbuild.owner_ids(1000, tmpdir))
+            self.assertEquals((1000, 50), dbuild.owner_ids('1000:50', tmpdir))
+            self.assertEquals(None, dbuild.owner_ids('user1', tmpdir))
+
+            docker_client = self._mock_docker_build(tmpdir, build_type='pipeline',
+                                                    build_owner='1000:50')
+            command = docker_client.create_container.call_args[1]['command'][2]
+            self.assertNotIn('chown -R', command)
+            self.assertIn('useradd -u 1000 -g 50', command)
+            as_owner = "chroot --userspec=1000:50 / env HOME=/tmp bash -c 'cd %s && %s'"
+            self.assertIn(as_owner % ('/build/source', 'dpkg-buildpackage -S -I -nc -uc -us'), command)
+            self.assertIn(as_owner % ('/build', 'dpkg-source -x /build/*.dsc /build/pkgbuild/'), command)
+            self.assertIn(as_owner % ('/build/pkgbuild', 'dpkg-buildpackage -b -uc -us -j1'), command)
+            # Installing build dependencies needs root
+            self.assertIn('&& /usr/lib/pbuilder/pbuilder-satisfydepends &&', command)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_build_in_scratch(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            docker_client = self._mock_docker_build(tmpdir, build_type='pipeline', scratch='tmpfs',
+                                                    scratch_size='2g')
+            host_config = docker_client.create_host_config.call_args[1]
+            self.assertEquals({'/scratch': 'rw,exec,mode=1777,size=2g'}, host_config['tmpfs'])
+            command = docker_client.create_container.call_args[1]['command'][2]
+            self.assertIn('cd /scratch && mkdir -p source && cp -a /build/source/. source/ && ' +
+                          dbuild.link_orig_command('/build', '/scratch'), command)
+            self.assertIn('cd /scratch/source && dpkg-buildpackage -S', command)
+            self.assertIn('dpkg-source -x /scratch/*.dsc /scratch/pkgbuild/', command)
+            self.assertIn(dbuild.copy_back_command('/scratch', '/build'), command)
+            self.assertTrue(command.endswith('|| { [ $rv -ne 0 ] || rv=2 ; } ; exit $rv'))
+            self.assertNotIn('/build/pkgbuild', command)
+
+            docker_client = self._mock_docker_build(tmpdir, build_type='binary', scratch='disk')
+            self.assertNotIn('tmpfs', docker_client.create_host_config.call_args[1])
+            command = docker_client.create_container.call_args[1]['command'][2]
+            self.assertIn('dpkg-source -x /build/*.dsc /scratch/pkgbuild/', command)
+
+            # Only the artifacts get copied back
+            scratch = os.path.join(tmpdir, 'scratch')
+            os.makedirs(os.path.join(scratch, 'pkgbuild'))
+            for name in ['pkg_1.0.dsc', 'pkg_1.0.tar.gz', 'pkg_1.0_amd64.deb', 'pkg_1.0_amd64.build']:
+                open(os.path.join(scratch, name), 'w').close()
+            out = os.path.join(tmpdir, 'out')
+            os.mkdir(out)
+            subprocess.check_call(['bash', '-c', dbuild.copy_back_command(scratch, out)])
+            self.assertEquals(['pkg_1.0.dsc', 'pkg_1.0.tar.gz', 'pkg_1.0_amd64.deb'],
+                              sorted(os.listdir(out)))
+
+            # A 3.0 (quilt) source tree in scratch gets its upstream
+            # tarballs next to it, and they aren't copied back
+            build = os.path.join(tmpdir, 'quilt')
+            os.makedirs(os.path.join(build, 'source', 'debian', 'source'))
+            with open(os.path.join(build, 'source', 'debian', 'source', 'format'), 'w') as fp:
+                fp.write('3.0 (quilt)\n')
+            for name in ['pkg_1.0.orig.tar.gz', 'pkg_1.0.orig-doc.tar.xz', 'other_1.0.tar.gz']:
+                open(os.path.join(build, name), 'w').close()
+            scratch = os.path.join(tmpdir, 'quilt-scratch')
+            os.mkdir(scratch)
+            subprocess.check_call(['bash', '-c', dbuild.link_orig_command(build, scratch)])
+            self.assertEquals(['pkg_1.0.orig-doc.tar.xz', 'pkg_1.0.orig.tar.gz'], sorted(os.listdir(scratch)))
+            self.assertEquals(os.path.join(build, 'pkg_1.0.orig.tar.gz'),
+                              os.readlink(os.path.join(scratch, 'pkg_1.0.orig.tar.gz')))
+            out = os.path.join(tmpdir, 'quilt-out')
+            subprocess.check_call(['bash', '-c', dbuild.copy_back_command(scratch, out)])
+            self.assertEquals([], os.listdir(out))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_checkpoint_and_resume(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(tmpdir, 'pkg_1.0.dsc'), 'w') as fp:
+                fp.write('Source: pkg\nBuild-Depends: debhelper\n')
+            docker_client = self._mock_docker_build(tmpdir, build_type='binary', output=six.StringIO())
+            command = docker_client.create_container.call_args[1]['command'][2]
+            self.assertIn('pbuilder-satisfydepends && echo @@dbuild-checkpoint && ', command)
+            self.assertFalse(docker_client.commit.called)
+
+            # A build failing after installing its dependencies leaves a checkpoint
+            self.assertRaises(dbuild.exceptions.DbuildBinaryBuildFailedException,
+                              self._mock_docker_build, tmpdir, build_type='binary', rv=2,
+                              log_chunks=[b'@@dbuild-checkpoint\n'], output=six.StringIO())
+            tag = dbuild.checkpoint.checkpoint_tag('ubuntu', 'trusty', ['debhelper'],
+                                                   dbuild.sources_digest(tmpdir))
+            repository, _, version = tag.rpartition(':')
+            self.assertTrue(repository.endswith('-checkpoint'))
+
+            docker_client = self._mock_docker_build(tmpdir, build_type='binary', resume=True,
+                                                    output=six.StringIO())
+            self.assertEquals(tag, docker_client.create_container.call_args[1]['image'])
+            command = docker_client.create_container.call_args[1]['command'][2]
+            self.assertNotIn('pbuilder-satisfydepends', command)
+            self.assertNotIn('apt-get -y update', command)
+
+            # Builds which can't resume say why
+            output = six.StringIO()
+            docker_client = self._mock_docker_build(tmpdir, build_type='binary', resume=True,
+                                                    checkpoint_keep=0, output=output)
+            self.assertIn('Not resuming, checkpoints are disabled', output.getvalue())
+            command = docker_client.create_container.call_args[1]['command'][2]
+            self.assertIn('pbuilder-satisfydepends', command)
+
+            index = dbuild.cache.ImageIndex(os.path.join(tmpdir, 'cache', 'checkpoints.json'))
+            index.add('unix://var/run/docker.sock', 'dbuild-ubuntu/trusty-checkpoint:other')
+            self.assertEquals([tag], dbuild.checkpoint.prune(docker_client, index, keep=1))
+            self.assertEquals(['dbuild-ubuntu/trusty-checkpoint:other'],
+                              dbuild.checkpoint.prune(docker_client, index, keep=1, ttl=-1))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_pipeline_build(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            docker_client = self._mock_docker_build(tmpdir, build_type='pipeline', parallel=3,
+                                                    build_owner='user1')
+            self.assertEquals(1, docker_client.create_container.call_count)
+            command = docker_client.create_container.call_args[1]['command'][2]
+            self.assertIn('dpkg-buildpackage -S', command)
+            self.assertIn('dpkg-source -x', command)
+            self.assertIn('dpkg-buildpackage -b -uc -us -j3', command)
+            self.assertTrue(command.endswith('chown -R user1 /build ; exit $rv'))
+
+            self.assertRaises(dbuild.exceptions.DbuildSourceBuildFailedException,
+                              self._mock_docker_build, tmpdir, build_type='pipeline',
+                              rv=dbuild.PIPELINE_SOURCE_FAILED)
+            self.assertRaises(dbuild.exceptions.DbuildBinaryBuildFailedException,
+                              self._mock_docker_build, tmpdir, build_type='pipeline',
+                              rv=dbuild.PIPELINE_BINARY_FAILED)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_binary_build_with_ccache(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(tmpdir, 'pkg_1.0.dsc'), 'w') as fp:
+                fp.write('Source: pkg\nBuild-Depends: debhelper\n')
+            ccache_dir = os.path.join(tmpdir, 'ccache')
+            docker_client = self._mock_docker_build(tmpdir, build_type='binary', ccache_dir=ccache_dir,
+                                                    ccache_size='2G', build_owner=1000)
+
+            ccache_path = os.path.join(ccache_dir, 'pkg_ubuntu_trusty_amd64')
+            self.assertTrue(os.path.isdir(ccache_path))
+            self.assertIn('%s:/ccache' % ccache_path, docker_client.create_host_config.call_args[1]['binds'])
+            command = docker_client.create_container.call_args[1]['command'][2]
+            self.assertTrue(command.startswith('export PATH=/usr/lib/ccache:$PATH CCACHE_DIR=/ccache && '))
+            # ccache makes its directories as the build's user, after the
+            # cache was handed over to it
+            chown = 'find /ccache ! -user 1000 -exec chown 1000:%d {} + && ' % os.stat(tmpdir).st_gid
+            limit = "chroot --userspec=1000:%d / env HOME=/tmp bash -c 'cd / && ccache -M 2G' && " % (
+                os.stat(tmpdir).st_gid)
+            self.assertIn(chown + limit, command)
+            self.assertIn("bash -c 'cd / && ccache -s' ; exit $rv", command)
+            self.assertEquals(0, subprocess.call(['bash', '-n', '-c', command]))
+            self.assertEquals(dbuild.image_tag('ubuntu', 'trusty', ccache=True),
+                              docker_client.create_container.call_args[1]['image'])
+            self.assertIn(' ccache ;', dbuild.render_dockerfile('ubuntu', 'trusty', ccache=True))
+
+            docker_client = self._mock_docker_build(tmpdir, build_type='source', ccache_dir=ccache_dir)
+            self.assertNotIn('ccache', docker_client.create_container.call_args[1]['command'][2])
+        finally:
+            shutil.rmtree(tmpdir)
+
     def test_build(self):
         tmpdir = tempfile.mkdtemp()
         try:
@@ -193,11 +672,990 @@ class DbuildTests(TestCase):
                                      docker_url='unix://var/run/docker.sock', extra_repo_keys_file='keys',
                                      extra_repos_file='repos', force_rm=False, proxy='', release='trusty',
                                      source_dir='source', no_default_sources=False,
-                                     include_timestamps=False),
+                                     include_timestamps=False, cache_dir=None,
+                                     apt_layer_ttl=None, builddep_cache=False,
+                                     builddep_cache_size=None, apt_archive_cache=None,
+                                     apt_archive_cache_size=None, ccache_dir=None,
+                                     ccache_size='5G', log_archive=None, write_metrics=False,
+                                     metrics_textfile=None, scratch=None, scratch_size='8g',
+                                     transport='bind', resume=False, checkpoint_keep=5,
+                                     checkpoint_ttl=259200, memory_per_cpu=2 << 30,
+                                     timeout=None, stall_timeout=None),
                            mock.call(build_cache=True, build_dir='/some/dir', build_owner=None,
                                      build_type='binary', dist='ubuntu',
                                      docker_url='unix://var/run/docker.sock',
                                      extra_repo_keys_file='keys', extra_repos_file='repos',
                                      force_rm=False, proxy='', parallel=1, release='trusty',
                                      source_dir='source', no_default_sources=False,
-                                     include_timestamps=False)])
+                                     include_timestamps=False, cache_dir=None,
+                                     apt_layer_ttl=None, builddep_cache=False,
+                                     builddep_cache_size=None, apt_archive_cache=None,
+                                     apt_archive_cache_size=None, ccache_dir=None,
+                                     ccache_size='5G', log_archive=None, write_metrics=False,
+                                     metrics_textfile=None, scratch=None, scratch_size='8g',
+                                     transport='bind', resume=False, checkpoint_keep=5,
+                                     checkpoint_ttl=259200, memory_per_cpu=2 << 30,
+                                     timeout=None, stall_timeout=None)])
+
+    @mock.patch('dbuild.docker_build')
+    def test_build_cli_pipeline(self, docker_build):
+        self.assertTrue(dbuild.main(['--pipeline', '-j4', '/some/dir']))
+        self.assertEquals(1, docker_build.call_count)
+        self.assertEquals('pipeline', docker_build.call_args[1]['build_type'])
+        self.assertEquals(4, docker_build.call_args[1]['parallel'])
+
+        docker_build.side_effect = dbuild.exceptions.DbuildBinaryBuildFailedException()
+        self.assertFalse(dbuild.main(['--pipeline', '/some/dir']))
+
+    @mock.patch('dbuild.prepare_image')
+    @mock.patch('dbuild.docker_client')
+    def test_batch_build(self, docker_client, prepare_image):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            running = []
+            concurrency = []
+            lock = dbuild.batch.threading.Lock()
+
+            def build_package(build_dir, output, **kwargs):
+                with lock:
+                    running.append(build_dir)
+                    concurrency.append(len(running))
+                output.write(u'building %s\n' % build_dir)
+                dbuild.batch.time.sleep(0.05)
+                with lock:
+                    running.remove(build_dir)
+                self.assertTrue(kwargs['build_cache'])
+                if build_dir == 'pkg2':
+                    raise dbuild.exceptions.DbuildBinaryBuildFailedException('Binary build FAILED')
+
+            log_dir = os.path.join(tmpdir, 'logs')
+            with mock.patch('dbuild.build_package', side_effect=build_package):
+                results = dbuild.batch.batch_build(['pkg1', 'pkg2', 'pkg3'], workers=3,
+                                                   log_dir=log_dir, build_cache=False)
+
+            self.assertEquals(1, prepare_image.call_count)
+            self.assertFalse(prepare_image.call_args[1]['build_cache'])
+            self.assertTrue(max(concurrency) > 1)
+            self.assertEquals(['pkg1', 'pkg2', 'pkg3'], [r.build_dir for r in results])
+            self.assertEquals([True, False, True], [r.success for r in results])
+            self.assertEquals('binary', results[1].failed_phase)
+            with open(results[2].log_file) as fp:
+                self.assertEquals('building pkg3\n', fp.read())
+
+            summary = dbuild.batch.format_summary(results)
+            self.assertIn('3 builds, 2 succeeded, 1 failed', summary)
+            self.assertIn('FAILED pkg2', summary)
+
+            # The image is prepared with the client the jobs are given
+            client = mock.MagicMock()
+            docker_client.reset_mock()
+            with mock.patch('dbuild.build_package'):
+                dbuild.batch.batch_build(['pkg1'], log_dir=log_dir, client=client)
+            self.assertFalse(docker_client.called)
+            self.assertIs(client, prepare_image.call_args[0][0])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @mock.patch('dbuild.batch.batch_build')
+    def test_batch_cli(self, batch_build):
+        batch_build.return_value = []
+        self.assertTrue(dbuild.main(['batch', '-w', '8', '--pipeline', '/dir1', '/dir2']))
+        args, kwargs = batch_build.call_args
+        self.assertEquals((['/dir1', '/dir2'],), args)
+        self.assertEquals(8, kwargs['workers'])
+        self.assertTrue(kwargs['pipeline'])
+
+    def _host_pool(self, running, **kwargs):
+        clients = {}
+
+        def client_factory(url):
+            clients[url] = mock.MagicMock()
+            clients[url].containers.return_value = [{}] * running[url]
+            return clients[url]
+
+        hosts = [dbuild.scheduler.DockerHost.parse(spec) for spec in
+                 ['tcp://a:2375=2', 'tcp://b:2375=4']]
+        return dbuild.scheduler.HostPool(hosts, client_factory=client_factory, **kwargs), clients
+
+    def test_host_pool_places_on_least_loaded_host(self):
+        pool, clients = self._host_pool({'tcp://a:2375': 1, 'tcp://b:2375': 1})
+        self.assertEquals(6, pool.slots)
+
+        host = pool.acquire()
+        self.assertEquals('tcp://b:2375', host.url)
+        clients['tcp://b:2375'].containers.assert_called_with(
+            filters={'label': 'dbuild', 'status': 'running'})
+
+        self.assertEquals('tcp://a:2375', pool.acquire().url)
+
+        # Containers started by this process are already counted as placed
+        own = {'Labels': dbuild.container_labels('binary')}
+        clients['tcp://b:2375'].containers.return_value = [{}, own, own]
+        self.assertEquals('tcp://b:2375', pool.acquire().url)
+        self.assertEquals('tcp://b:2375', pool.acquire().url)
+        pool.release(host)
+        self.assertEquals(2, host.assigned)
+
+    def test_host_pool_waits_for_free_slot(self):
+        pool, clients = self._host_pool({'tcp://a:2375': 2, 'tcp://b:2375': 3}, poll_interval=0.01)
+        host = pool.acquire()
+        self.assertEquals('tcp://b:2375', host.url)
+
+        acquired = []
+        thread = dbuild.scheduler.threading.Thread(target=lambda: acquired.append(pool.acquire()))
+        thread.start()
+        thread.join(0.1)
+        self.assertEquals([], acquired)
+
+        clients['tcp://a:2375'].containers.return_value = [{}]
+        thread.join(5)
+        self.assertEquals('tcp://a:2375', acquired[0].url)
+
+    def test_host_pool_retries_on_other_host(self):
+        pool, clients = self._host_pool({'tcp://a:2375': 1, 'tcp://b:2375': 0})
+
+        def build(build_dir, docker_url, client, output):
+            if docker_url == 'tcp://b:2375':
+                raise dbuild.scheduler.ConnectionError('connection refused')
+            self.assertIs(clients[docker_url], client)
+            return True
+
+        self.assertTrue(pool.run(build, 'pkg', output=None))
+        self.assertTrue(pool.hosts[1].down_until > dbuild.scheduler.time.time())
+        self.assertEquals([0, 0], [h.assigned for h in pool.hosts])
+
+        def unreachable(**kwargs):
+            raise dbuild.scheduler.ConnectionError('connection refused')
+
+        pool, clients = self._host_pool({'tcp://a:2375': 0, 'tcp://b:2375': 0})
+        self.assertRaises(dbuild.exceptions.DbuildException, pool.run, unreachable)
+
+        # A host timing out counts as down too, and is asked without the
+        # pool's lock held
+        pool, clients = self._host_pool({'tcp://a:2375': 0, 'tcp://b:2375': 0})
+        unlocked = []
+
+        def try_lock():
+            unlocked.append(pool._cond.acquire(False))
+            if unlocked[-1]:
+                pool._cond.release()
+
+        def slow_containers(**kwargs):
+            thread = dbuild.scheduler.threading.Thread(target=try_lock)
+            thread.start()
+            thread.join()
+            raise dbuild.scheduler.Timeout('read timed out')
+
+        pool.client(pool.hosts[1]).containers.side_effect = slow_containers
+        self.assertEquals('tcp://a:2375', pool.acquire().url)
+        self.assertEquals([True], unlocked)
+        self.assertTrue(pool.hosts[1].down_until > dbuild.scheduler.time.time())
+
+    @mock.patch('dbuild.prepare_image')
+    def test_batch_build_on_host_pool(self, prepare_image):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            pool, clients = self._host_pool({'tcp://a:2375': 0, 'tcp://b:2375': 0})
+            urls = []
+            with mock.patch('dbuild.build_package',
+                            side_effect=lambda build_dir, docker_url, **kw: urls.append(docker_url)):
+                results = dbuild.batch.batch_build(['pkg1', 'pkg2'], log_dir=tmpdir, hosts=pool,
+                                                   docker_url='unix://var/run/docker.sock')
+            self.assertEquals([True, True], [r.success for r in results])
+            self.assertEquals(['tcp://a:2375', 'tcp://b:2375'],
+                              sorted(c[1]['docker_url'] for c in prepare_image.call_args_list))
+            self.assertTrue(set(urls) <= set(['tcp://a:2375', 'tcp://b:2375']))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def _graph_packages(self, tmpdir, controls):
+        build_dirs = []
+        for name, content in controls:
+            debian = os.path.join(tmpdir, name, 'source', 'debian')
+            os.makedirs(debian)
+            with open(os.path.join(debian, 'control'), 'w') as fp:
+                fp.write(content)
+            build_dirs.append(os.path.join(tmpdir, name))
+        return build_dirs
+
+    def test_build_graph(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            build_dirs = self._graph_packages(tmpdir, [
+                ('app', 'Source: app\nBuild-Depends: debhelper, libfoo-dev (>= 1.0) | libbar-dev\n\n'
+                        'Package: app\n'),
+                ('foo', 'Source: foo\nBuild-Depends: debhelper\n\n'
+                        'Package: libfoo1\n\nPackage: libfoo-dev\n'),
+                ('other', 'Source: other\nBuild-Depends: python:any\n\nPackage: other\n')])
+            app, foo, other = packages = [dbuild.graph.Package(d) for d in build_dirs]
+            self.assertEquals(set(['libfoo1', 'libfoo-dev']), foo.binaries)
+            self.assertEquals(set(['python']), other.build_depends)
+
+            graph = dbuild.graph.build_graph(packages)
+            self.assertEquals({app: set([foo]), foo: set(), other: set()}, graph)
+            order = dbuild.graph.topological_order(graph)
+            self.assertTrue(order.index(foo) < order.index(app))
+
+            graph[foo].add(app)
+            self.assertRaises(dbuild.exceptions.DbuildException, dbuild.graph.topological_order, graph)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @mock.patch('dbuild.graph.LocalRepo.publish')
+    @mock.patch('dbuild.batch.prepare_shared_image', side_effect=lambda args, hosts: args)
+    def test_graph_build(self, prepare_shared_image, publish):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            build_dirs = self._graph_packages(tmpdir, [
+                ('app', 'Source: app\nBuild-Depends: libfoo-dev\n\nPackage: app\n'),
+                ('foo', 'Source: foo\nBuild-Depends: debhelper\n\nPackage: libfoo-dev\n'),
+                ('bar', 'Source: bar\nBuild-Depends: debhelper\n\nPackage: libbar-dev\n'),
+                ('baz', 'Source: baz\nBuild-Depends: libbar-dev\n\nPackage: baz\n')])
+            with open(os.path.join(build_dirs[0], 'repos'), 'w') as fp:
+                fp.write('deb http://example.com/ubuntu trusty main\n')
+            built = []
+
+            def build_package(build_dir, output, **kwargs):
+                built.append((build_dir, kwargs))
+                if build_dir.endswith('bar'):
+                    raise dbuild.exceptions.DbuildBinaryBuildFailedException('Binary build FAILED')
+
+            repo_dir = os.path.join(tmpdir, 'repo')
+            with mock.patch('dbuild.build_package', side_effect=build_package):
+                results = dbuild.graph.graph_build(build_dirs, repo_dir, workers=2,
+                                                   log_dir=os.path.join(tmpdir, 'logs'),
+                                                   apt_layer_ttl=3600)
+
+            self.assertEquals([True, True, False, False], [r.success for r in results])
+            self.assertIn('build dependency %s failed' % build_dirs[2], results[3].error)
+            order = [b[0] for b in built]
+            self.assertEquals(3, len(order))
+            self.assertTrue(order.index(build_dirs[1]) < order.index(build_dirs[0]))
+            self.assertEquals([mock.call(build_dirs[1], mock.ANY, docker_url=mock.ANY),
+                               mock.call(build_dirs[0], mock.ANY, docker_url=mock.ANY)],
+                              publish.call_args_list)
+
+            app_args = dict(built)[build_dirs[0]]
+            self.assertEquals(dbuild.graph.GRAPH_REPOS_FILE, app_args['extra_repos_file'])
+            self.assertEquals({os.path.abspath(repo_dir): '/dbuild-localrepo'}, app_args['extra_volumes'])
+            self.assertEquals(None, app_args['apt_layer_ttl'])
+            with open(os.path.join(build_dirs[0], dbuild.graph.GRAPH_REPOS_FILE)) as fp:
+                repos = fp.read()
+            self.assertTrue(repos.startswith('deb http://example.com/ubuntu trusty main\n'))
+            self.assertIn('deb [trusted=yes] file:/dbuild-localrepo ./', repos)
+            self.assertEquals(3600, dict(built)[build_dirs[1]]['apt_layer_ttl'])
+
+            # A build which can't even be set up fails on its own
+            with mock.patch('dbuild.build_package', side_effect=build_package), \
+                    mock.patch('dbuild.graph.LocalRepo.write_repos_file',
+                               side_effect=IOError('Permission denied')):
+                results = dbuild.graph.graph_build(build_dirs, repo_dir, workers=2,
+                                                   log_dir=os.path.join(tmpdir, 'logs'))
+            self.assertEquals([False, True, False, False], [r.success for r in results])
+            self.assertIn('Permission denied', results[0].error)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_fingerprint_store_rehashes_changed_files_only(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            tree = os.path.join(tmpdir, 'tree')
+            shutil.copytree(os.path.join(os.path.dirname(__file__), 'test_data', 'pkg1'), tree)
+            os.mkdir(os.path.join(tree, '.git'))
+            store = dbuild.cache.FingerprintStore(os.path.join(tmpdir, 'fingerprints.json'))
+
+            digest = store.tree_digest(tree)
+            with mock.patch('dbuild.cache.file_digest') as file_digest:
+                self.assertEquals(digest, store.tree_digest(tree))
+                self.assertFalse(file_digest.called)
+
+            with open(os.path.join(tree, '.git', 'HEAD'), 'w') as fp:
+                fp.write('ignored')
+            self.assertEquals(digest, store.tree_digest(tree))
+
+            with open(os.path.join(tree, 'setup.py'), 'a') as fp:
+                fp.write('# changed\n')
+            real_file_digest = dbuild.cache.file_digest
+            with mock.patch('dbuild.cache.file_digest', side_effect=real_file_digest) as file_digest:
+                self.assertNotEquals(digest, store.tree_digest(tree))
+                file_digest.assert_called_once_with(os.path.join(tree, 'setup.py'))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_result_cache(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            build_dir = os.path.join(tmpdir, 'build')
+            shutil.copytree(os.path.join(os.path.dirname(__file__), 'test_data', 'pkg1'),
+                            os.path.join(build_dir, 'source'))
+            cache_dir = os.path.join(tmpdir, 'cache')
+
+            def build_package(build_dir, build_type, **kwargs):
+                for name in {'source': ['pkg_1.dsc', 'pkg_1.tar.gz'],
+                             'binary': ['pkg_1_all.deb', 'pkg_1_amd64.changes']}[build_type]:
+                    with open(os.path.join(build_dir, name), 'w') as fp:
+                        fp.write(name)
+                return True
+
+            client = mock.MagicMock()
+            client.version.return_value = {'Arch': 'amd64'}
+            with open(os.path.join(build_dir, 'unrelated.deb'), 'w') as fp:
+                fp.write('not built')
+            with mock.patch('dbuild.docker_build', side_effect=build_package) as docker_build:
+                dbuild.build_package(build_dir, result_cache=True, cache_dir=cache_dir, client=client)
+                self.assertEquals(2, docker_build.call_count)
+
+            results = dbuild.cache.ResultCache(os.path.join(cache_dir, 'results'))
+            self.assertEquals({'hits': 0, 'misses': 1}, results.stats())
+
+            for name in os.listdir(build_dir):
+                if name != 'source':
+                    os.unlink(os.path.join(build_dir, name))
+            with mock.patch('dbuild.docker_build') as docker_build:
+                self.assertTrue(dbuild.build_package(build_dir, result_cache=True, cache_dir=cache_dir,
+                                                     client=client))
+                self.assertFalse(docker_build.called)
+            self.assertEquals(['pkg_1.dsc', 'pkg_1.tar.gz', 'pkg_1_all.deb', 'pkg_1_amd64.changes',
+                               'source'], sorted(os.listdir(build_dir)))
+            self.assertEquals({'hits': 1, 'misses': 1}, results.stats())
+
+            # Changing the dist, or building on a host of another
+            # architecture, makes it a miss
+            with mock.patch('dbuild.docker_build', side_effect=build_package) as docker_build:
+                dbuild.build_package(build_dir, result_cache=True, cache_dir=cache_dir, client=client,
+                                     release='xenial')
+                self.assertEquals(2, docker_build.call_count)
+            client.version.return_value = {'Arch': 'arm64'}
+            with mock.patch('dbuild.docker_build', side_effect=build_package) as docker_build:
+                dbuild.build_package(build_dir, result_cache=True, cache_dir=cache_dir, client=client)
+                self.assertEquals(2, docker_build.call_count)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_result_cache_evicts_least_recently_used(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            results = dbuild.cache.ResultCache(os.path.join(tmpdir, 'results'), max_size=250)
+            for i, key in enumerate(['a', 'b', 'c']):
+                with open(os.path.join(tmpdir, 'pkg.deb'), 'wb') as fp:
+                    fp.write(b'x' * 100)
+                with mock.patch('time.time', return_value=1000 + i):
+                    results.store(key, tmpdir, ['pkg.deb'])
+            self.assertEquals(['b', 'c'], sorted(results.index.load()['entries']))
+            self.assertFalse(os.path.exists(os.path.join(tmpdir, 'results', 'a')))
+            self.assertEquals(None, results.restore('a', tmpdir))
+            self.assertEquals(['pkg.deb'], results.restore('b', tmpdir))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_log_pipeline(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            stream = io.StringIO()
+            archive = os.path.join(tmpdir, 'build.log.gz')
+            pipeline = dbuild.logs.LogPipeline([dbuild.logs.StreamSink(stream),
+                                                dbuild.logs.file_sink(archive)], flush_size=4)
+            text = u'line 1\nd\xe9j\xe0 vu\n\nlast'
+            data = text.encode('utf-8')
+            with pipeline:
+                # Split inside lines and inside multibyte characters
+                for i in range(0, len(data), 3):
+                    pipeline.feed(data[i:i + 3])
+            self.assertEquals(text + u'\n', stream.getvalue())
+            self.assertEquals(4, pipeline.lines)
+            self.assertEquals(len(data), pipeline.bytes)
+            with gzip.open(archive, 'rb') as fp:
+                self.assertEquals(data + b'\n', fp.read())
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_log_pipeline_reports_sink_errors(self):
+        broken = mock.MagicMock()
+        broken.write.side_effect = IOError('disk full')
+        stream = io.StringIO()
+        pipeline = dbuild.logs.LogPipeline([broken, dbuild.logs.StreamSink(stream)])
+        pipeline.start()
+        pipeline.feed(b'one\n')
+        pipeline.feed(b'two\n')
+        self.assertRaises(IOError, pipeline.close)
+        self.assertEquals(u'one\ntwo\n', stream.getvalue())
+        broken.close.assert_called_with()
+
+    def test_build_log_archive(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            output = six.StringIO()
+            self._mock_docker_build(tmpdir, build_type='source', output=output,
+                                    log_chunks=[b'2015 building\n2015 do', b'ne\n'],
+                                    log_archive='dbuild.log.gz')
+            self.assertIn(u'2015 building\n2015 done\n', output.getvalue())
+            with gzip.open(os.path.join(tmpdir, 'dbuild.log.gz'), 'rb') as fp:
+                self.assertEquals(b'2015 building\n2015 done\n', fp.read())
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_build_metrics(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(tmpdir, 'pkg_1.0.dsc'), 'w') as fp:
+                fp.write('Source: pkg\n')
+            textfile = os.path.join(tmpdir, 'dbuild.prom')
+            build_args = dict(build_type='binary', force_rm=True, write_metrics=True,
+                              metrics_textfile=textfile,
+                              log_chunks=[b'2015 @@dbuild-phase apt-update 100.0\n',
+                                          b'2015 @@dbuild-phase apt-upgrade 102.5\n'
+                                          b'@@dbuild-phase binary-build 110.0\n',
+                                          b'@@dbuild-phase end 130.0\n'])
+            docker_client = self._mock_docker_build(tmpdir, **build_args)
+
+            command = docker_client.create_container.call_args[1]['command'][2]
+            self.assertTrue(command.startswith("trap 'echo \"@@dbuild-phase end"))
+            for phase in ('apt-update', 'apt-upgrade', 'unpack-source', 'build-deps', 'binary-build'):
+                self.assertIn('echo "@@dbuild-phase %s $(date +%%s.%%N)" && ' % phase, command)
+
+            with open(os.path.join(tmpdir, 'dbuild-binary.metrics.json'), 'r') as fp:
+                record = json.load(fp)
+            self.assertEquals(('pkg', 0, True), (record['source'], record['exit_code'], record['success']))
+            phases = dict((p['name'], p) for p in record['phases'])
+            self.assertEquals(2.5, phases['apt-update']['duration'])
+            self.assertEquals(20.0, phases['binary-build']['duration'])
+            self.assertEquals('container', phases['binary-build']['where'])
+            for phase in ('render-dockerfile', 'build-image', 'create-container', 'start-container',
+                          'run-container', 'remove-container'):
+                self.assertEquals('host', phases[phase]['where'])
+
+            self.assertRaises(dbuild.exceptions.DbuildBinaryBuildFailedException,
+                              self._mock_docker_build, tmpdir, rv=2, **build_args)
+            with open(textfile, 'r') as fp:
+                prom = fp.read()
+            self.assertIn('dbuild_builds_total{build_type="binary",result="success"} 1\n', prom)
+            self.assertIn('dbuild_builds_total{build_type="binary",result="failure"} 1\n', prom)
+            self.assertIn('dbuild_phase_seconds_total{build_type="binary",phase="binary-build"} 40.0', prom)
+            self.assertIn('dbuild_phase_runs_total{build_type="binary",phase="apt-update"} 2\n', prom)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_fake_docker_client_build(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            client = dbuild.fakedocker.FakeDockerClient(log_lines=3, artifacts=['pkg_1.0.dsc'])
+            output = six.StringIO()
+            args = dict(cache_dir=os.path.join(tmpdir, 'cache'), client=client, output=output)
+            self.assertTrue(dbuild.docker_build(tmpdir, 'source', **args))
+            self.assertIn('x' * 79 + '\n', output.getvalue())
+            self.assertTrue(os.path.exists(os.path.join(tmpdir, 'pkg_1.0.dsc')))
+            self.assertEquals({}, client.containers_by_id)
+
+            # An image removed behind dbuild's back gets built again
+            client.image_store.clear()
+            self.assertTrue(dbuild.docker_build(tmpdir, 'source', **args))
+            self.assertEquals(2, client.calls.count('build'))
+
+            client.exit_code = 1
+            self.assertRaises(dbuild.exceptions.DbuildSourceBuildFailedException,
+                              dbuild.docker_build, tmpdir, 'source', **args)
+            self.assertEquals(1, len(client.containers_by_id))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_build_with_archive_transport(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(tmpdir, 'source', 'debian'))
+            os.makedirs(os.path.join(tmpdir, 'source', '.git'))
+            for name in ['source/debian/control', 'source/.git/HEAD', 'repos', 'pkg_0.9.deb']:
+                with open(os.path.join(tmpdir, name), 'w') as fp:
+                    fp.write('Source: pkg\n')
+            client = dbuild.fakedocker.FakeDockerClient(artifacts=['pkg_1.0.dsc', 'pkg_1.0_amd64.deb'])
+            args = dict(cache_dir=os.path.join(tmpdir, 'cache'), client=client, output=six.StringIO(),
+                        transport='archive', build_owner=1000)
+            self.assertTrue(dbuild.docker_build(tmpdir, 'pipeline', **args))
+
+            self.assertEquals({}, client.containers_by_id)
+            self.assertEquals(['/build', '/build/repos', '/build/source', '/build/source/debian',
+                               '/build/source/debian/control'], sorted(client.uploaded))
+            for name in ['pkg_1.0.dsc', 'pkg_1.0_amd64.deb']:
+                self.assertTrue(os.path.exists(os.path.join(tmpdir, name)))
+            self.assertEquals(['repos', 'pkg_1.0.dsc'],
+                              dbuild.transport.archive_members(tmpdir, 'binary', extra_files=['repos']))
+
+            # A non-native package's upstream tarballs go with its source tree
+            for name in ['pkg_1.0.orig.tar.gz', 'pkg_1.0.orig-doc.tar.xz', 'other_2.0.tar.gz']:
+                open(os.path.join(tmpdir, name), 'w').close()
+            os.makedirs(os.path.join(tmpdir, 'nested', 'source'))
+            open(os.path.join(tmpdir, 'nested', 'pkg_1.0.orig.tar.bz2'), 'w').close()
+            self.assertEquals(['pkg_1.0.orig-doc.tar.xz', 'pkg_1.0.orig.tar.gz', 'source', 'source/debian',
+                               'source/debian/control'],
+                              dbuild.transport.archive_members(tmpdir, 'source'))
+            self.assertEquals(['nested', 'nested/pkg_1.0.orig.tar.bz2', 'nested/source'],
+                              dbuild.transport.archive_members(tmpdir, 'pipeline', 'nested/source'))
+            client.uploaded = []
+            self.assertTrue(dbuild.docker_build(tmpdir, 'source', **args))
+            self.assertIn('/build/pkg_1.0.orig.tar.gz', client.uploaded)
+
+            output = six.StringIO()
+            self.assertTrue(dbuild.docker_build(tmpdir, 'pipeline', **dict(args, resume=True, output=output)))
+            self.assertIn('Not resuming, checkpoints need the bind transport', output.getvalue())
+
+            # A build failing before it made any artifacts
+            client.artifacts = []
+            client.exit_code = dbuild.PIPELINE_SOURCE_FAILED
+            self.assertRaises(dbuild.exceptions.DbuildSourceBuildFailedException,
+                              dbuild.docker_build, tmpdir, 'pipeline', **args)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_container_pool(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(tmpdir, 'source'))
+            client = dbuild.fakedocker.FakeDockerClient(artifacts=['pkg_1.0.dsc'])
+            pool = dbuild.ContainerPool(client, size=2)
+            args = dict(cache_dir=os.path.join(tmpdir, 'cache'), pool=pool, output=six.StringIO())
+            image = dbuild.image_tag('ubuntu', 'trusty')
+
+            def settle(idle, creates):
+                for _ in range(500):
+                    if pool.idle(image) == idle and client.calls.count('create_container') == creates:
+                        return
+                    time.sleep(0.01)
+                self.fail('pool has %d idle containers, %d created' % (
+                    pool.idle(image), client.calls.count('create_container')))
+
+            # The first build waits for a container, then the pool fills up
+            self.assertTrue(dbuild.docker_build(tmpdir, 'source', **args))
+            self.assertTrue(os.path.exists(os.path.join(tmpdir, 'pkg_1.0.dsc')))
+            settle(2, 3)
+            builds = [e['cmd'][2] for e in client.execs.values() if 'dpkg-buildpackage' in e['cmd'][2]]
+            self.assertEquals(1, len(builds))
+            self.assertNotIn('apt-get -y update', builds[0])
+            self.assertIn('apt-get -y update', dbuild.pool.WARM_COMMAND)
+
+            # The next takes a warm one, which gets replaced
+            self.assertTrue(dbuild.docker_build(tmpdir, 'source', **args))
+            settle(2, 4)
+            self.assertEquals(2, len(client.containers_by_id))
+            # Containers which ran a build never go back to the pool
+            built_in = set(e['container'].id for e in client.execs.values()
+                           if 'dpkg-buildpackage' in e['cmd'][2])
+            self.assertEquals(2, len(built_in))
+            self.assertFalse(built_in & set(client.containers_by_id))
+
+            self.assertRaises(dbuild.exceptions.DbuildException, dbuild.docker_build, tmpdir,
+                              'source', scratch='tmpfs', **args)
+            self.assertRaises(dbuild.exceptions.DbuildException, dbuild.docker_build, tmpdir,
+                              'source', extra_volumes={'/srv': '/srv'}, **args)
+            pool.close()
+            self.assertEquals({}, client.containers_by_id)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_resource_allocator(self):
+        client = dbuild.fakedocker.FakeDockerClient(cpus=8, memory=16 << 30)
+        allocator = dbuild.scheduler.ResourceAllocator(concurrency=2, poll_interval=0.01)
+
+        # Each build gets its share of the host, with memory in proportion
+        first = allocator.acquire(client, 'fake://', 'auto', memory_per_cpu=1 << 30)
+        self.assertEquals([0, 1, 2, 3], first.cpu_ids)
+        self.assertEquals({'cpuset_cpus': '0,1,2,3', 'mem_limit': 4 << 30,
+                           'memswap_limit': 4 << 30}, first.host_config())
+        second = allocator.acquire(client, 'fake://', 'auto')
+        self.assertEquals([4, 5, 6, 7], second.cpu_ids)
+        self.assertEquals({'cpuset_cpus': '4,5,6,7'}, second.host_config())
+
+        # A build which doesn't fit waits for one to finish
+        third = []
+        thread = threading.Thread(target=lambda: third.append(allocator.acquire(client, 'fake://', 3)))
+        thread.start()
+        time.sleep(0.05)
+        self.assertEquals([], third)
+        allocator.release(first)
+        thread.join()
+        self.assertEquals([0, 1, 2], third[0].cpu_ids)
+        allocator.release(second)
+        allocator.release(third[0])
+
+        # Memory limits how many CPUs are worth handing out
+        self.assertEquals(3, allocator.acquire(client, 'fake://', 8, memory_per_cpu=4 << 30).cpus)
+
+        # Builds of other dbuild processes count with what their labels say
+        client = dbuild.fakedocker.FakeDockerClient(cpus=8)
+        client.image_store['other'] = {'Id': 'other', 'Size': 0}
+        other = client.create_container('other', labels={
+            dbuild.CONTAINER_LABEL: 'binary', dbuild.OWNER_LABEL: 'elsewhere:1',
+            dbuild.scheduler.CPUS_LABEL: '2', dbuild.scheduler.CPUSET_LABEL: '0,1'})
+        client.run_latency = 60
+        client.start(other)
+        allocator = dbuild.scheduler.ResourceAllocator()
+        self.assertEquals([2, 3, 4, 5], allocator.acquire(client, 'fake://', 'auto').cpu_ids)
+
+        # Hosts are asked without the allocator's lock held, and an
+        # unreachable one doesn't leave it taken
+        unlocked = []
+
+        def try_lock():
+            unlocked.append(allocator._cond.acquire(False))
+            if unlocked[-1]:
+                allocator._cond.release()
+
+        def slow_containers(**kwargs):
+            thread = threading.Thread(target=try_lock)
+            thread.start()
+            thread.join()
+            raise dbuild.scheduler.Timeout('read timed out')
+
+        slow = mock.MagicMock()
+        slow.info.return_value = {'NCPU': 4, 'MemTotal': 0}
+        slow.containers.side_effect = slow_containers
+        self.assertRaises(dbuild.scheduler.HOST_ERRORS, allocator.acquire, slow, 'tcp://slow:2375')
+        self.assertEquals([True], unlocked)
+        self.assertTrue(allocator._cond.acquire(False))
+        allocator._cond.release()
+
+    def test_build_watchdog(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(tmpdir, 'source'))
+            # Logs a line, then hangs
+            client = dbuild.fakedocker.FakeDockerClient(run_latency=60, log_lines=1)
+            args = dict(client=client, cache_dir=os.path.join(tmpdir, 'cache'))
+            output = six.StringIO()
+            started = time.time()
+            self.assertRaises(dbuild.exceptions.DbuildBuildTimeoutException, dbuild.docker_build,
+                              tmpdir, 'source', stall_timeout=0.2, output=output, **args)
+            self.assertLess(time.time() - started, 10)
+            self.assertIn('Build stalled, no output for 0.2s, killed container', output.getvalue())
+            # Kept for inspection like any failed build
+            container, = client.containers_by_id.values()
+            self.assertTrue(container.killed)
+
+            self.assertRaises(dbuild.exceptions.DbuildBuildTimeoutException, dbuild.docker_build,
+                              tmpdir, 'source', timeout=0.2, force_rm=True, output=output, **args)
+            self.assertEquals([container.id], list(client.containers_by_id))
+            self.assertEquals(1, client.calls.count('remove_container'))
+
+            # The container installing the build dependencies is watched too
+            with open(os.path.join(tmpdir, 'pkg_1.0.dsc'), 'w') as fp:
+                fp.write('Source: pkg\nBuild-Depends: debhelper\n')
+            started = time.time()
+            self.assertRaises(dbuild.exceptions.DbuildBuildTimeoutException, dbuild.docker_build,
+                              tmpdir, 'binary', builddep_cache=True, stall_timeout=0.2, force_rm=True,
+                              output=output, **args)
+            self.assertLess(time.time() - started, 10)
+            self.assertEquals([container.id], list(client.containers_by_id))
+            self.assertEquals(0, client.calls.count('commit'))
+            self.assertEquals(2, output.getvalue().count('Build stalled, no output for 0.2s'))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_sweep_orphans(self):
+        client = dbuild.fakedocker.FakeDockerClient(run_latency=60)
+        client.image_store['img'] = {'Id': 'img', 'Size': 0}
+        dead = subprocess.Popen(['true'])
+        dead.wait()
+        hostname = socket.gethostname()
+
+        def container(owner, start=True):
+            created = client.create_container('img', labels={dbuild.CONTAINER_LABEL: 'binary',
+                                                             dbuild.OWNER_LABEL: owner})
+            if start:
+                client.start(created)
+            return created['Id']
+
+        orphan = container('%s:%d' % (hostname, dead.pid))
+        kept = container('%s:%d' % (hostname, dead.pid), start=False)
+        mine = container('%s:%d' % (hostname, os.getpid()))
+        remote = container('elsewhere:1')
+        client.containers_by_id[remote].created -= 3600
+
+        self.assertEquals([orphan], dbuild.watchdog.sweep(client))
+        self.assertEquals([kept], dbuild.watchdog.sweep(client, stopped=True))
+        self.assertEquals([remote], dbuild.watchdog.sweep(client, max_age=600))
+        self.assertEquals([mine], list(client.containers_by_id))
+
+    def test_build_parallel_auto(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(tmpdir, 'source'))
+            client = dbuild.fakedocker.FakeDockerClient(cpus=6, exit_code=dbuild.PIPELINE_BINARY_FAILED)
+            allocator = dbuild.scheduler.ResourceAllocator(concurrency=2)
+            self.assertRaises(dbuild.exceptions.DbuildBinaryBuildFailedException,
+                              dbuild.docker_build, tmpdir, 'pipeline', parallel='auto',
+                              allocator=allocator, memory_per_cpu=1 << 30, client=client,
+                              docker_url='fake://', cache_dir=os.path.join(tmpdir, 'cache'),
+                              output=six.StringIO())
+            container, = client.containers_by_id.values()
+            self.assertIn('-j3', container.command[2])
+            self.assertEquals('0,1,2', container.host_config['cpuset_cpus'])
+            self.assertEquals(3 << 30, container.host_config['mem_limit'])
+            self.assertEquals('3', container.labels[dbuild.scheduler.CPUS_LABEL])
+            # The allocation ends with the build
+            self.assertEquals(3, allocator.acquire(client, 'fake://', 'auto').cpus)
+
+            ap = argparse.ArgumentParser()
+            dbuild.add_build_arguments(ap)
+            self.assertEquals('auto', ap.parse_args(['-j', 'auto']).parallel)
+            self.assertEquals(4, ap.parse_args(['-j4']).parallel)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_apt_proxy(self):
+        tmpdir = tempfile.mkdtemp()
+        requests = []
+
+        class Mirror(six.moves.BaseHTTPServer.BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                requests.append(self.path)
+                # Slow enough for concurrent requests to overlap
+                time.sleep(0.1)
+                if 'missing' in self.path:
+                    return self.send_error(404)
+                body = self.path.encode('utf-8') * 100
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        mirror = six.moves.BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Mirror)
+        mirror_thread = threading.Thread(target=mirror.serve_forever)
+        mirror_thread.start()
+        proxy = dbuild.proxy.AptProxy(os.path.join(tmpdir, 'apt'), max_size=5000, port=0,
+                                      index_ttl=0).start()
+        try:
+            opener = six.moves.urllib.request.build_opener(
+                six.moves.urllib.request.ProxyHandler({'http': proxy.url}))
+            base = 'http://127.0.0.1:%d' % mirror.server_address[1]
+
+            def get(path):
+                return opener.open(base + path).read()
+
+            # Concurrent downloads of a package make one request upstream
+            bodies = []
+            threads = [threading.Thread(target=lambda: bodies.append(get('/pool/a_1.deb')))
+                       for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEquals([b'/pool/a_1.deb' * 100] * 4, bodies)
+            self.assertEquals(['/pool/a_1.deb'], requests)
+
+            # Indexes are fetched again once older than index_ttl, other
+            # files are passed through, errors aren't cached
+            get('/dists/trusty/InRelease')
+            time.sleep(0.01)
+            get('/dists/trusty/InRelease')
+            get('/status')
+            get('/status')
+            for _ in range(2):
+                self.assertRaises(six.moves.urllib.error.HTTPError, get, '/pool/missing.deb')
+            self.assertEquals(['/pool/a_1.deb'] + ['/dists/trusty/InRelease'] * 2 + ['/status'] * 2 +
+                              ['/pool/missing.deb'] * 2, requests)
+
+            # The least recently used files make room for new ones: packages
+            # are 1300 bytes here
+            for name in ('b', 'a', 'c', 'd', 'a', 'b'):
+                get('/pool/%s_1.deb' % name)
+            self.assertEquals(['/pool/b_1.deb', '/pool/c_1.deb', '/pool/d_1.deb', '/pool/b_1.deb'],
+                              requests[7:])
+            self.assertLessEqual(proxy.cache.size(), 5000)
+        finally:
+            proxy.stop()
+            mirror.shutdown()
+            mirror.server_close()
+            mirror_thread.join()
+            shutil.rmtree(tmpdir)
+
+        client = mock.MagicMock()
+        client.inspect_network.return_value = {'IPAM': {'Config': [{'Subnet': '172.17.0.0/16',
+                                                                    'Gateway': '172.17.0.1'}]}}
+        self.assertEquals('172.17.0.1', dbuild.proxy.bridge_gateway(client))
+        self.assertRaises(dbuild.exceptions.DbuildException, dbuild.proxy.managed_proxy(
+            {'docker_url': 'tcp://builder:2375'}, tmpdir).__enter__)
+
+    def _default_build_args(self, **overrides):
+        ap = argparse.ArgumentParser()
+        dbuild.add_build_arguments(ap)
+        return dict(dbuild.build_arguments(ap.parse_args([])), **overrides)
+
+    def test_build_service(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for name in ['pkg1', 'pkg2']:
+                os.makedirs(os.path.join(tmpdir, name, 'source'))
+            client = dbuild.fakedocker.FakeDockerClient(log_lines=2, artifacts=['pkg_1.0.dsc'])
+            build_args = self._default_build_args(cache_dir=os.path.join(tmpdir, 'cache'))
+            state_dir = os.path.join(tmpdir, 'state')
+
+            def make_service():
+                session = dbuild.DbuildSession(client_factory=lambda url: client)
+                return dbuild.service.BuildService(state_dir, build_args, workers=2,
+                                                   session=session)
+
+            # Jobs queued when the service stops survive until it runs again
+            service = make_service()
+            first = service.submit(os.path.join(tmpdir, 'pkg1'))
+            second = service.submit(os.path.join(tmpdir, 'pkg2'), {'pipeline': True})
+            self.assertTrue(service.cancel(second.id))
+            self.assertRaises(dbuild.exceptions.DbuildException, service.submit,
+                              os.path.join(tmpdir, 'pkg2'), {'no_such_option': 1})
+            # Jobs can't pick host paths, or smuggle shell commands in
+            for options in [{'cache_dir': '/etc'}, {'apt_archive_cache': '/'},
+                            {'parallel': '1; reboot'}, {'dist': 'ubuntu\nRUN reboot'},
+                            {'pipeline': 'yes'}]:
+                self.assertRaises(dbuild.exceptions.DbuildException, service.submit,
+                                  os.path.join(tmpdir, 'pkg2'), options)
+            allowed = service.submit(os.path.join(tmpdir, 'pkg2'),
+                                     {'parallel': 'auto', 'dist': 'debian', 'timeout': 3600})
+            self.assertTrue(service.cancel(allowed.id))
+            confined = dbuild.service.BuildService(os.path.join(tmpdir, 'confined'), build_args,
+                                                   build_root=os.path.join(tmpdir, 'pkg1'))
+            self.assertRaises(dbuild.exceptions.DbuildException, confined.submit,
+                              os.path.join(tmpdir, 'pkg1', '..', 'pkg2'))
+            confined.submit(os.path.join(tmpdir, 'pkg1', 'sub'))
+            self.assertRaises(dbuild.exceptions.DbuildException, dbuild.service.make_server,
+                              service, '0.0.0.0:0')
+
+            service = make_service().start()
+            try:
+                self.assertTrue(service.wait(first.id, timeout=10))
+                job = service.get(first.id)
+                self.assertEquals('succeeded', job.state)
+                self.assertTrue(os.path.exists(os.path.join(tmpdir, 'pkg1', 'pkg_1.0.dsc')))
+                with open(job.log_file) as fp:
+                    self.assertIn('x' * 79, fp.read())
+                self.assertEquals('cancelled', service.get(second.id).state)
+                # The dbuild image was built by the first job only
+                third = service.submit(os.path.join(tmpdir, 'pkg2'), {'pipeline': True})
+                self.assertTrue(service.wait(third.id, timeout=10))
+                self.assertEquals('succeeded', service.get(third.id).state)
+                self.assertEquals(1, client.calls.count('build'))
+            finally:
+                service.stop()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_build_service_pool(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(tmpdir, 'pkg', 'source'))
+            client = dbuild.fakedocker.FakeDockerClient(artifacts=['pkg_1.0.dsc'])
+            archive = os.path.join(tmpdir, 'archives')
+            build_args = self._default_build_args(cache_dir=os.path.join(tmpdir, 'cache'),
+                                                  apt_archive_cache=archive)
+            session = dbuild.DbuildSession(client_factory=lambda url: client)
+            service = dbuild.service.BuildService(os.path.join(tmpdir, 'state'), build_args,
+                                                  session=session, pool_size=1).start()
+            try:
+                # Pool containers mount what the service's builds do
+                self.assertEquals({archive: dbuild.APT_ARCHIVE_DIR}, service.pool.shared_volumes)
+                job = service.submit(os.path.join(tmpdir, 'pkg'), {'pipeline': True})
+                self.assertTrue(service.wait(job.id, timeout=10))
+                self.assertEquals('succeeded', service.get(job.id).state, service.get(job.id).error)
+                pooled = [e for e in client.execs.values() if 'dpkg-buildpackage' in e['cmd'][2]]
+                self.assertEquals(1, len(pooled))
+
+                # A tmpfs scratch workspace needs a container of its own
+                job = service.submit(os.path.join(tmpdir, 'pkg'), {'pipeline': True, 'scratch': 'tmpfs'})
+                self.assertTrue(service.wait(job.id, timeout=10))
+                self.assertEquals('succeeded', service.get(job.id).state, service.get(job.id).error)
+                self.assertEquals(pooled, [e for e in client.execs.values()
+                                           if 'dpkg-buildpackage' in e['cmd'][2]])
+            finally:
+                service.stop()
+
+            for value in ['trusty\n', 'trusty\nRUN reboot']:
+                self.assertRaises(dbuild.exceptions.DbuildException, service.submit,
+                                  os.path.join(tmpdir, 'pkg'), {'release': value})
+            self.assertRaises(dbuild.exceptions.DbuildException, service.submit,
+                              os.path.join(tmpdir, 'pkg'), {'scratch_size': '8g\n'})
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_build_service_http(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(tmpdir, 'pkg', 'source'))
+            client = dbuild.fakedocker.FakeDockerClient(log_lines=3)
+            session = dbuild.DbuildSession(client_factory=lambda url: client)
+            build_args = self._default_build_args(cache_dir=os.path.join(tmpdir, 'cache'))
+            service = dbuild.service.BuildService(os.path.join(tmpdir, 'state'), build_args,
+                                                  session=session).start()
+            socket_path = os.path.join(tmpdir, 'dbuild.sock')
+            server = dbuild.service.make_server(service, 'unix://' + socket_path)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+
+            def request(method, path, body=None):
+                conn = six.moves.http_client.HTTPConnection('localhost')
+                conn.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                conn.sock.connect(socket_path)
+                conn.request(method, path, body and json.dumps(body),
+                             {'Content-Type': 'application/json'})
+                response = conn.getresponse()
+                data = response.read()
+                conn.close()
+                return response.status, data
+
+            try:
+                status, data = request('POST', '/jobs', {'build_dir': os.path.join(tmpdir, 'pkg')})
+                self.assertEquals(201, status)
+                job_id = json.loads(data.decode('utf-8'))['id']
+                status, data = request('GET', '/jobs/%s/log?follow=1' % job_id)
+                self.assertEquals(200, status)
+                # Source and binary build
+                self.assertEquals(6, data.decode('utf-8').count('x' * 79 + '\n'))
+                status, data = request('GET', '/jobs/%s' % job_id)
+                self.assertEquals('succeeded', json.loads(data.decode('utf-8'))['state'])
+                status, data = request('GET', '/jobs')
+                self.assertEquals([job_id], [job['id'] for job in json.loads(data.decode('utf-8'))])
+                self.assertEquals(409, request('DELETE', '/jobs/%s' % job_id)[0])
+                self.assertEquals(404, request('GET', '/jobs/0123')[0])
+                self.assertEquals(400, request('POST', '/jobs', {'options': {}})[0])
+            finally:
+                server.shutdown()
+                server.server_close()
+                thread.join()
+                service.stop()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_bench_suite_compares_with_baseline(self):
+        results = dbuild.bench.run_suite(['orchestration', 'cache-hit'], repeat=1, builds=2,
+                                         files=3, hits=2)
+        self.assertEquals(['orchestration', 'cache-hit'], list(results))
+        self.assertEquals(1, results['cache-hit']['containers'])
+
+        baseline = {'orchestration': {'seconds': results['orchestration']['seconds'] / 2},
+                    'cache-hit': {'seconds': results['cache-hit']['seconds'] * 2}}
+        self.assertEquals([('orchestration', True), ('cache-hit', False)],
+                          [(name, regressed) for name, _, _, regressed
+                           in dbuild.bench.compare(results, baseline, tolerance=0.5)])
+
+    def test_session_reuses_clients_and_image_view(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            client = dbuild.fakedocker.FakeDockerClient()
+            factory = mock.MagicMock(return_value=client)
+            session = dbuild.DbuildSession('tcp://builder:2375', client_factory=factory)
+            # The image exists on the host, but this cache dir hasn't seen it
+            client.pull('dbuild-ubuntu/trusty', dbuild.image_tag('ubuntu', 'trusty').split(':')[1])
+            args = dict(cache_dir=os.path.join(tmpdir, 'cache'), output=six.StringIO())
+            for _ in range(3):
+                session.docker_build(tmpdir, 'source', **args)
+            factory.assert_called_once_with('tcp://builder:2375')
+            self.assertEquals(0, client.calls.count('build'))
+            self.assertEquals(1, client.calls.count('images'))
+
+            # Gone behind the session's back: built again, and looked up afresh
+            client.image_store.clear()
+            shutil.rmtree(os.path.join(tmpdir, 'cache'))
+            session.build_package(tmpdir, pipeline=True, **args)
+            self.assertEquals(1, client.calls.count('build'))
+            self.assertEquals(2, client.calls.count('images'))
+            self.assertTrue(session.image_exists(dbuild.image_tag('ubuntu', 'trusty')))
+        finally:
+            shutil.rmtree(tmpdir)
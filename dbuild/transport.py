@@ -0,0 +1,166 @@
+import fnmatch
+import io
+import os
+import posixpath
+import shutil
+import tarfile
+import threading
+
+from dbuild import cache
+
+# Where the archive transport unpacks the build directory in the container,
+# and where the build leaves the artifacts to fetch back
+BUILD_DIR = '/build'
+OUT_DIR = '/dbuild-out'
+
+# What a binary build needs of the build directory: the source package
+SOURCE_PACKAGE_PATTERNS = ('*.dsc', '*.tar.*', '*.diff.gz')
+
+
+def archive_members(build_dir, build_type, source_dir='source', extra_files=()):
+    """
+    Paths relative to build_dir which a build of build_type needs: the
+    source tree and any upstream tarballs next to it for source and
+    pipeline builds, the source package for binary builds, and those of
+    extra_files which exist. Parent directories come before their contents.
+    """
+    names = []
+    parents = set()
+
+    def add(name):
+        parent = posixpath.dirname(name)
+        if parent and parent not in parents:
+            add(parent)
+            parents.add(parent)
+        names.append(name)
+
+    for name in extra_files:
+        if os.path.isfile(os.path.join(build_dir, name)):
+            add(name)
+    if build_type == 'binary':
+        for name in sorted(os.listdir(build_dir)):
+            if (os.path.isfile(os.path.join(build_dir, name)) and
+                    any(fnmatch.fnmatch(name, p) for p in SOURCE_PACKAGE_PATTERNS)):
+                add(name)
+        return names
+    if build_type not in ('source', 'pipeline'):
+        return names
+
+    source_path = os.path.join(build_dir, source_dir)
+    if not os.path.isdir(source_path):
+        return names
+    # dpkg-source wants those of a non-native package next to the tree
+    parent = posixpath.dirname(source_dir)
+    for name in sorted(os.listdir(os.path.join(build_dir, parent))):
+        if (os.path.isfile(os.path.join(build_dir, parent, name)) and
+                any(fnmatch.fnmatch(name, p) for p in cache.ORIG_TARBALL_PATTERNS)):
+            add(posixpath.join(parent, name))
+    add(source_dir)
+    parents.add(source_dir)
+    for root, dirs, files in os.walk(source_path):
+        dirs[:] = sorted(d for d in dirs if d not in cache.VCS_DIRS)
+        rel = os.path.relpath(root, build_dir).replace(os.sep, '/')
+        for name in dirs + sorted(files):
+            names.append(posixpath.join(rel, name))
+    return names
+
+
+def stream_archive(build_dir, members, owner=None, chunk_size=1 << 16):
+    """
+    gzip compressed tar of members of build_dir under build/, as a
+    generator of chunks. A thread writes the archive into a pipe, so no
+    more than a chunk or so of it is ever held in memory. Entries belong to
+    owner, a (uid, gid) tuple, or root.
+    """
+    uid, gid = owner or (0, 0)
+
+    def reown(info):
+        info.uid, info.gid = uid, gid
+        info.uname = info.gname = ''
+        return info
+
+    read_fd, write_fd = os.pipe()
+    errors = []
+
+    def write():
+        try:
+            with os.fdopen(write_fd, 'wb') as fp:
+                tar = tarfile.open(fileobj=fp, mode='w|gz')
+                tar.add(build_dir, 'build', recursive=False, filter=reown)
+                for name in members:
+                    tar.add(os.path.join(build_dir, name), posixpath.join('build', name),
+                            recursive=False, filter=reown)
+                tar.close()
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=write)
+    thread.daemon = True
+    thread.start()
+    with os.fdopen(read_fd, 'rb') as fp:
+        while True:
+            chunk = fp.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    thread.join()
+    if errors:
+        raise errors[0]
+
+
+def put_build_dir(docker_client, container, build_dir, members, owner=None):
+    """ Stream members of build_dir into /build of the created container """
+    return docker_client.put_archive(container, posixpath.dirname(BUILD_DIR),
+                                     stream_archive(build_dir, members, owner))
+
+
+class IterStream(io.RawIOBase):
+    """ Readable file object over an iterator of byte chunks """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._rest = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._rest:
+            try:
+                self._rest = next(self._chunks)
+            except StopIteration:
+                return 0
+        n = min(len(b), len(self._rest))
+        b[:n] = self._rest[:n]
+        self._rest = self._rest[n:]
+        return n
+
+
+def get_artifacts(docker_client, container, build_dir, path=OUT_DIR):
+    """
+    Stream the files under path in the container into build_dir, keeping
+    their relative paths, and return those paths. Anything but regular
+    files, and paths leading out of build_dir, are skipped.
+    """
+    stream, _ = docker_client.get_archive(container, path)
+    if not hasattr(stream, 'read'):
+        stream = io.BufferedReader(IterStream(stream))
+    names = []
+    tar = tarfile.open(fileobj=stream, mode='r|*')
+    try:
+        for member in tar:
+            # Entries are named after the basename of path
+            name = member.name.partition('/')[2]
+            if (not member.isfile() or not name or name.startswith('/') or
+                    '..' in name.split('/')):
+                continue
+            dest = os.path.join(build_dir, *name.split('/'))
+            if not os.path.isdir(os.path.dirname(dest)):
+                os.makedirs(os.path.dirname(dest))
+            with open(dest, 'wb') as fp:
+                shutil.copyfileobj(tar.extractfile(member), fp)
+            os.utime(dest, (member.mtime, member.mtime))
+            names.append(name)
+    finally:
+        tar.close()
+    return names
@@ -0,0 +1,154 @@
+from __future__ import print_function
+
+import argparse
+import errno
+import os
+import socket
+import threading
+import time
+
+from docker import errors as docker_errors
+
+import dbuild
+from dbuild import logs
+
+
+class Watchdog(logs.LogSink):
+    """
+    Log sink which kills a build that runs for longer than timeout seconds,
+    or whose log stays silent for stall_timeout seconds.
+
+    It is fed the build's log like any sink, so every batch of output
+    counts as activity. A thread checks the deadlines and calls kill once
+    one has passed, which ends the log stream and the wait for the
+    container. reason then says which deadline it was.
+    """
+
+    def __init__(self, kill, timeout=None, stall_timeout=None):
+        self.kill = kill
+        self.timeout = timeout
+        self.stall_timeout = stall_timeout
+        self.reason = None
+        self.started = self.active = time.time()
+        deadlines = [t for t in (timeout, stall_timeout) if t]
+        self.poll_interval = min([1.0] + [t / 4.0 for t in deadlines])
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        self.started = self.active = time.time()
+        if self.timeout or self.stall_timeout:
+            self._thread = threading.Thread(target=self._watch)
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def write(self, text):
+        self.active = time.time()
+
+    def check(self, now=None):
+        """ Why the build is overdue, or None if it isn't """
+        now = now or time.time()
+        if self.timeout and now - self.started > self.timeout:
+            return 'Build timed out after %gs' % self.timeout
+        if self.stall_timeout and now - self.active > self.stall_timeout:
+            return 'Build stalled, no output for %gs' % self.stall_timeout
+        return None
+
+    def _watch(self):
+        while not self._stopped.wait(self.poll_interval):
+            reason = self.check()
+            if reason is not None:
+                self.reason = reason
+                self.kill()
+                return
+
+
+def kill_container(docker_client, container):
+    """ Kill a container, which may have exited already """
+    try:
+        docker_client.kill(container=container.get('Id'))
+    except docker_errors.APIError:
+        pass
+
+
+def owner_alive(owner, hostname=None):
+    """
+    Whether the dbuild process of an owner label, host:pid, still runs.
+    None if it is on another host, where this can't be told.
+    """
+    host, _, pid = owner.rpartition(':')
+    if host != (hostname or socket.gethostname()) or not pid.isdigit():
+        return None
+    try:
+        os.kill(int(pid), 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+def find_orphans(docker_client, stopped=False, max_age=None):
+    """
+    dbuild containers whose dbuild process is gone: those of processes of
+    this host which no longer run, and with max_age, those of any host
+    created more than max_age seconds ago. Only running containers unless
+    stopped is True, since failed builds are kept stopped on purpose.
+    """
+    filters = {'label': dbuild.CONTAINER_LABEL}
+    if not stopped:
+        filters['status'] = 'running'
+    now = time.time()
+    orphans = []
+    for container in docker_client.containers(all=stopped, filters=filters):
+        labels = container.get('Labels') or {}
+        alive = owner_alive(labels.get(dbuild.OWNER_LABEL, ''))
+        if alive is False or (max_age is not None and
+                              now - container.get('Created', now) > max_age):
+            orphans.append(container)
+    return orphans
+
+
+def sweep(docker_client, stopped=False, max_age=None, output=None):
+    """ Remove the containers find_orphans finds, returns their ids """
+    removed = []
+    for container in find_orphans(docker_client, stopped, max_age):
+        try:
+            dbuild.remove_container(docker_client, container, force=True)
+        except docker_errors.NotFound:
+            continue
+        print('Removed orphaned container %s (%s)' % (
+            container.get('Id'), (container.get('Labels') or {}).get(dbuild.OWNER_LABEL)),
+            file=output)
+        removed.append(container.get('Id'))
+    return removed
+
+
+def main(argv):
+    ap = argparse.ArgumentParser(
+        prog='dbuild sweep',
+        description='Remove dbuild containers left behind by dbuild processes '
+                    'which are gone')
+    ap.add_argument('--docker-url', type=str, default='unix://var/run/docker.sock',
+                    help='Docker url, it can be unix socket or tcp url')
+    ap.add_argument('--stopped', action='store_true', default=False,
+                    help='Also remove stopped containers, such as those of '
+                         'failed builds kept for inspection')
+    ap.add_argument('--max-age', type=int, default=None, metavar='SECONDS',
+                    help='Also remove dbuild containers of any host created '
+                         'longer ago than this')
+    args = ap.parse_args(argv)
+
+    removed = sweep(dbuild.docker_client(args.docker_url), args.stopped, args.max_age)
+    print('Removed %d orphaned containers' % len(removed))
+    return True